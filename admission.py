@@ -0,0 +1,230 @@
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+#--------------------------------------------------------
+# Admission control and load shedding.                  |
+#                                                       |
+# Requests that need a database connection pass a gate  |
+# for their class (reads or writes) first: at most      |
+# `limit` of them hold a connection at once, up to      |
+# `max_queue` more wait in line, and one that has       |
+# waited `timeout` seconds is turned away with a 503.   |
+# Requests answered from a cache never touch the gate.  |
+# Clients are also rate limited with a token bucket per |
+# client and class, over the limit they get a 429.      |
+# Both carry a Retry-After header. Limits apply per     |
+# worker process.                                       |
+#--------------------------------------------------------
+READS = 'reads'
+WRITES = 'writes'
+
+# Monitoring routes are never rate limited
+EXEMPT_PATHS = ('/', '/metrics', '/pool/stats', '/cache/stats', '/snapshot/stats')
+
+class Overloaded(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+    def response_data(self):
+        return {"error": str(self), "retryAfter": self.retry_after}
+
+    def headers(self):
+        return [('Retry-After', str(self.retry_after))]
+
+_request_class = contextvars.ContextVar('request_class', default=READS)
+
+def classify(method):
+    _request_class.set(READS if method in ('GET', 'HEAD') else WRITES)
+
+def request_class():
+    return _request_class.get()
+
+#--------------------------------------------------------
+# Concurrency limit with a FIFO wait queue. A leaving   |
+# request hands its slot straight to the oldest waiter. |
+# enter() blocks the thread, enter_async() the task.    |
+#--------------------------------------------------------
+class Gate:
+    def __init__(self, name, limit, max_queue=0, timeout=1.0):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.shed = {'queue_full': 0, 'timeout': 0}
+
+    def _try_enter(self):
+        # Called with the lock held, returns True if admitted right away
+        if self._active < self.limit and not self._waiters:
+            self._active += 1
+            self.admitted += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            self.shed['queue_full'] += 1
+            raise Overloaded(503, "server is busy, retry later", self.timeout)
+        self.queued += 1
+        return False
+
+    def _timed_out(self, waiter):
+        # Called with the lock held after a waiter gave up
+        self._waiters.remove(waiter)
+        self.shed['timeout'] += 1
+        return Overloaded(503, "server is busy, retry later", self.timeout)
+
+    def enter(self):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            if self._try_enter():
+                return
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        if waiter.wait(self.timeout):
+            return
+        with self._lock:
+            # The slot may have been handed over just as the wait ran out
+            if waiter.is_set():
+                return
+            raise self._timed_out(waiter)
+
+    async def enter_async(self):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            if self._try_enter():
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if waiter.done():
+                    return
+                waiter.cancel()
+                raise self._timed_out(waiter)
+        except BaseException:
+            # Cancelled while waiting: give back a slot already handed over
+            with self._lock:
+                handed = waiter.done() and not waiter.cancelled()
+                if not handed:
+                    waiter.cancel()
+                    self._waiters.remove(waiter)
+            if handed:
+                self.leave()
+            raise
+
+    def leave(self):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                self.admitted += 1
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                if not waiter.done():
+                    waiter.set_result(True)
+                    return
+                self.admitted -= 1
+            self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"limit": self.limit, "in flight": self._active, "queue": len(self._waiters),
+                    "max queue": self.max_queue, "admitted": self.admitted,
+                    "queued": self.queued, "shed": dict(self.shed)}
+
+#--------------------------------------------------------
+# Token buckets: each client gets `burst` tokens that   |
+# refill at `rate` per second, a request takes one. The |
+# least recently seen clients are forgotten past        |
+# max_clients.                                          |
+#--------------------------------------------------------
+class RateLimiter:
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.limited = 0
+
+    def take(self, client):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._buckets[client] = (tokens, now)
+                self.limited += 1
+                raise Overloaded(429, "rate limit exceeded", (1 - tokens) / self.rate)
+            self._buckets[client] = (tokens - 1, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+#--------------------------------------------------------
+# A gate and a rate limiter per request class           |
+#--------------------------------------------------------
+class AdmissionControl:
+    def __init__(self, read_limit, write_limit, max_queue, queue_timeout,
+                 read_rate=0.0, write_rate=0.0, burst=20):
+        self.gates = {
+            READS: Gate(READS, read_limit, max_queue, queue_timeout),
+            WRITES: Gate(WRITES, write_limit, max_queue, queue_timeout),
+        }
+        self.limiters = {
+            READS: RateLimiter(read_rate, burst),
+            WRITES: RateLimiter(write_rate, burst),
+        }
+
+    def gate(self):
+        return self.gates[request_class()]
+
+    def check_rate(self, client):
+        self.limiters[request_class()].take(client)
+
+    def stats(self):
+        return {name: dict(gate.stats(), **{"rate limited": self.limiters[name].limited})
+                for name, gate in self.gates.items()}
+
+    def metrics(self):
+        stats = self.stats()
+        return [
+            ('quotes_api_admission_in_flight', 'gauge',
+             "Requests holding a database connection, by class",
+             [({'class': name}, s['in flight']) for name, s in stats.items()]),
+            ('quotes_api_admission_queue_depth', 'gauge',
+             "Requests waiting for a database connection, by class",
+             [({'class': name}, s['queue']) for name, s in stats.items()]),
+            ('quotes_api_admission_admitted_total', 'counter',
+             "Requests let through to the database, by class",
+             [({'class': name}, s['admitted']) for name, s in stats.items()]),
+            ('quotes_api_admission_shed_total', 'counter',
+             "Requests turned away, by class and reason",
+             [({'class': name, 'reason': reason}, count) for name, s in stats.items()
+              for reason, count in sorted(dict(s['shed'], rate_limited=s['rate limited']).items())]),
+        ]
+
+#--------------------------------------------------------
+# The client a request is rate limited as: the first    |
+# address of `header` (e.g. X-Forwarded-For) when set,  |
+# else the peer address                                 |
+#--------------------------------------------------------
+def client_key(header_value, remote_addr):
+    if header_value:
+        return header_value.split(',')[0].strip()
+    return remote_addr or ''
@@ -1,15 +1,214 @@
-from flask import Flask, Response, request, abort, render_template
+from flask import Flask, Response, request, abort, render_template, stream_with_context
 from flask_cors import CORS
 import os
-import psycopg2
-from markupsafe import escape
 import json
+import io
+import hmac
+import logging
+import psycopg2
+import db
+import batch
+import bulk_load
+import counts
+import export
+import handlers
+import ingest
+import metrics
+import queries
+import serialize
+from db import get_db
+from sampler import QuoteSampler
+from names import Names
+from catalog import CatalogStore
+from dedupe import Deduper
+from pagination import Page
+from fields import ArgumentError, SEARCH_FIELDS, parse_fields, parse_ids
+from snapshot import SnapshotStore, SnapshotError
+from versions import create_versions
+from serialize import Compression, FragmentCache
+from cache import (create_cache, quote_tag, author_tag, author_name_tag,
+                   category_tag, category_name_tag)
 
 app = Flask(__name__)
 CORS(app)
 
 app.config['CONNECTION_STRING'] = os.environ.get('CONNECTION_STRING')
 
+# Connection pool settings (see db.py)
+app.config['DB_POOL_MIN_SIZE'] = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+app.config['DB_POOL_MAX_SIZE'] = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))
+app.config['DB_POOL_MAX_IDLE'] = float(os.environ.get('DB_POOL_MAX_IDLE', 300))
+app.config['DB_POOL_MAX_LIFETIME'] = float(os.environ.get('DB_POOL_MAX_LIFETIME', 3600))
+app.config['DB_POOL_HEALTH_CHECK'] = os.environ.get('DB_POOL_HEALTH_CHECK', '1') != '0'
+
+# Read replicas (see replicas.py): ";"-separated connection strings, the largest lag
+# in seconds a replica may have to serve reads, seconds between lag checks, and how
+# long after a write the writer's reads (and this worker's cache refills) use the primary
+app.config['REPLICA_CONNECTION_STRINGS'] = os.environ.get('REPLICA_CONNECTION_STRINGS', '')
+app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 5))
+app.config['REPLICA_CHECK_INTERVAL'] = float(os.environ.get('REPLICA_CHECK_INTERVAL', 2))
+app.config['REPLICA_CONNECT_TIMEOUT'] = float(os.environ.get('REPLICA_CONNECT_TIMEOUT', 2))
+app.config['READ_YOUR_WRITES_WINDOW'] = float(os.environ.get('READ_YOUR_WRITES_WINDOW', 5))
+
+# Admission control (see admission.py): requests of each class holding a connection at
+# once (0 for no limit), how many may wait for one and for how many seconds, and
+# requests per second each client may make (0 for no limit) with their burst size.
+# Clients are told apart by RATE_LIMIT_CLIENT_HEADER, or their address when unset.
+app.config['ADMISSION_READ_LIMIT'] = int(os.environ.get('ADMISSION_READ_LIMIT', app.config['DB_POOL_MAX_SIZE']))
+app.config['ADMISSION_WRITE_LIMIT'] = int(os.environ.get('ADMISSION_WRITE_LIMIT', max(app.config['DB_POOL_MAX_SIZE'] // 2, 1)))
+app.config['ADMISSION_QUEUE_SIZE'] = int(os.environ.get('ADMISSION_QUEUE_SIZE', 20))
+app.config['ADMISSION_QUEUE_TIMEOUT'] = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 1))
+app.config['RATE_LIMIT_READS'] = float(os.environ.get('RATE_LIMIT_READS', 0))
+app.config['RATE_LIMIT_WRITES'] = float(os.environ.get('RATE_LIMIT_WRITES', 0))
+app.config['RATE_LIMIT_BURST'] = int(os.environ.get('RATE_LIMIT_BURST', 20))
+app.config['RATE_LIMIT_CLIENT_HEADER'] = os.environ.get('RATE_LIMIT_CLIENT_HEADER')
+db.init_app(app)
+
+# Request and query metrics on GET /metrics (see metrics.py). Statements slower than
+# SLOW_QUERY_MS are logged (0 turns the log off), TRACE_HEADER names the request ID header.
+app.config['SLOW_QUERY_MS'] = float(os.environ.get('SLOW_QUERY_MS', 500))
+app.config['TRACE_HEADER'] = os.environ.get('TRACE_HEADER')
+metrics.register_queries(queries, batch, bulk_load, counts, ingest)
+metrics.init_app(app)
+
+# Random quote sampler (see sampler.py)
+app.config['RANDOM_SAMPLER_REFRESH'] = float(os.environ.get('RANDOM_SAMPLER_REFRESH', 30))
+app.config['RANDOM_SAMPLER_FULL_RELOAD'] = float(os.environ.get('RANDOM_SAMPLER_FULL_RELOAD', 3600))
+quote_sampler = QuoteSampler(app.config['RANDOM_SAMPLER_REFRESH'],
+                             app.config['RANDOM_SAMPLER_FULL_RELOAD'])
+
+# Serve the GET endpoints from a snapshot file instead of the database (see snapshot.py)
+app.config['SNAPSHOT_PATH'] = os.environ.get('SNAPSHOT_PATH')
+app.config['SNAPSHOT_CHECK_INTERVAL'] = float(os.environ.get('SNAPSHOT_CHECK_INTERVAL', 10))
+
+# Author/category catalog shared by the workers (see catalog.py), off when CATALOG_PATH
+# is empty. It is built when the app is loaded, so once by a server that loads the app
+# before forking its workers (see gunicorn.conf.py). Names added by the writes are
+# published to it at most every CATALOG_PUBLISH_INTERVAL seconds.
+app.config['CATALOG_PATH'] = os.environ.get('CATALOG_PATH', '')
+app.config['CATALOG_PUBLISH_INTERVAL'] = float(os.environ.get('CATALOG_PUBLISH_INTERVAL', 1))
+name_catalog = None
+if app.config['CATALOG_PATH'] and not app.config['SNAPSHOT_PATH']:
+    name_catalog = CatalogStore(app.config['CATALOG_PATH'], app.config['CATALOG_PUBLISH_INTERVAL'])
+    if app.config['CONNECTION_STRING']:
+        try:
+            conn = psycopg2.connect(app.config['CONNECTION_STRING'])
+            try:
+                name_catalog.build(conn)
+            finally:
+                conn.close()
+        except psycopg2.Error as e:
+            # Workers keep the catalog already published, names it lacks go to the database
+            logging.getLogger(__name__).warning("name catalog not built: %s", e)
+    app.before_request(name_catalog.check)
+
+# Author/category name to ID maps used by the writes (see names.py)
+name_resolvers = Names(name_catalog)
+
+# Duplicate detection for new quotes (see dedupe.py). A DEDUPE_NEAR_THRESHOLD above
+# 0 also rejects quotes at least that similar to a stored one (MinHash estimate).
+app.config['DEDUPE_NEAR_THRESHOLD'] = float(os.environ.get('DEDUPE_NEAR_THRESHOLD', 0))
+app.config['DEDUPE_MINHASH_PERMUTATIONS'] = int(os.environ.get('DEDUPE_MINHASH_PERMUTATIONS', 64))
+quote_duplicates = Deduper(app.config['DEDUPE_NEAR_THRESHOLD'],
+                           app.config['DEDUPE_MINHASH_PERMUTATIONS'])
+
+# Response cache (see cache.py), TTLs are in seconds per route
+app.config['CACHE_ENABLED'] = os.environ.get('CACHE_ENABLED', '1') != '0'
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'local')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+app.config['CACHE_DEFAULT_TTL'] = float(os.environ.get('CACHE_DEFAULT_TTL', 60))
+app.config['CACHE_TTLS'] = {
+    route: float(os.environ.get('CACHE_TTL_' + route.upper(), ttl))
+    for route, ttl in {
+        'quote': 300,
+        'quotes': 60,
+        'authors': 60,
+        'categories': 300,
+        'quotes_by_author': 60,
+        'quotes_by_category': 60,
+        'stats': 60,
+    }.items()
+}
+response_cache = create_cache(app)
+
+# Largest array accepted by POST /quotes
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('BATCH_MAX_SIZE', 1000))
+
+# Most IDs GET /quotes?ids= accepts at once
+app.config['MULTI_GET_MAX_IDS'] = int(os.environ.get('MULTI_GET_MAX_IDS', 100))
+
+# Rows per fetch of GET /quotes/export (see export.py)
+app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+
+# Token required by the /admin endpoints, they are disabled when unset
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN')
+
+snapshots = None
+if app.config['SNAPSHOT_PATH']:
+    snapshots = SnapshotStore(app.config['SNAPSHOT_PATH'], app.config['SNAPSHOT_CHECK_INTERVAL'])
+    # Answers come from memory already, caching them would only delay reloads
+    response_cache.enabled = False
+
+# Write-behind POST /quotes (see ingest.py): quotes are journaled in INGEST_DIR, answered
+# with 202 and a ticket, and committed in groups of up to INGEST_BATCH_SIZE at most
+# INGEST_MAX_DELAY seconds later. INGEST_FSYNC=0 leaves flushing the journal to the OS.
+# Ticket outcomes are kept INGEST_TICKET_TTL seconds.
+app.config['INGEST_ENABLED'] = os.environ.get('INGEST_ENABLED', '0') != '0'
+app.config['INGEST_DIR'] = os.environ.get('INGEST_DIR', 'ingest')
+app.config['INGEST_BATCH_SIZE'] = int(os.environ.get('INGEST_BATCH_SIZE', 500))
+app.config['INGEST_MAX_DELAY'] = float(os.environ.get('INGEST_MAX_DELAY', 0.05))
+app.config['INGEST_MAX_PENDING'] = int(os.environ.get('INGEST_MAX_PENDING', 10000))
+app.config['INGEST_FSYNC'] = os.environ.get('INGEST_FSYNC', '1') != '0'
+app.config['INGEST_TICKET_TTL'] = float(os.environ.get('INGEST_TICKET_TTL', 604800))
+ingest_queue = None
+if app.config['INGEST_ENABLED'] and not snapshots:
+    ingest_queue = ingest.IngestQueue(
+        app.config['INGEST_DIR'],
+        lambda entries: ingest.run_on_pool(db.get_pool(app), handlers.ingest_quotes(
+            entries, quote_sampler, response_cache, name_resolvers, quote_duplicates)),
+        lambda entry, result: ingest.run_on_pool(db.get_pool(app),
+                                                 ingest.store_failure(entry, result)),
+        lambda ttl: ingest.run_on_pool(db.get_pool(app), ingest.purge_tickets(ttl)),
+        batch_size=app.config['INGEST_BATCH_SIZE'],
+        max_delay=app.config['INGEST_MAX_DELAY'],
+        max_pending=app.config['INGEST_MAX_PENDING'],
+        fsync=app.config['INGEST_FSYNC'],
+        ticket_ttl=app.config['INGEST_TICKET_TTL'])
+    # Started by the first request of each worker, so journals left by a crash are replayed
+    app.before_request(ingest_queue.start)
+    metrics.registry.collectors.append(ingest_queue.metrics)
+
+# Cache-Control of the GET routes that send ETag/Last-Modified (see versions.py),
+# /quotes/random is always no-store
+app.config['CACHE_CONTROL_DEFAULT'] = os.environ.get('CACHE_CONTROL_DEFAULT', 'no-cache')
+app.config['CACHE_CONTROL'] = {
+    route: os.environ['CACHE_CONTROL_' + route.upper()]
+    for route in ('quote', 'quotes', 'authors', 'categories', 'quotes_by_author',
+                  'quotes_by_category', 'search', 'stats')
+    if 'CACHE_CONTROL_' + route.upper() in os.environ
+}
+data_versions = create_versions(app, snapshots)
+response_cache.versions = data_versions
+
+# Response serialization and compression (see serialize.py). JSON_ENCODER=orjson is
+# faster but doesn't produce byte for byte the same JSON as the default encoder.
+app.config['JSON_ENCODER'] = os.environ.get('JSON_ENCODER', 'json')
+app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1') != '0'
+app.config['COMPRESSION_MIN_SIZE'] = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+app.config['FRAGMENT_CACHE_MAX_ENTRIES'] = int(os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES', 100000))
+serialize.configure(app.config['JSON_ENCODER'])
+compression = Compression(app.config['COMPRESSION_ENABLED'], app.config['COMPRESSION_MIN_SIZE'])
+compression.init_app(app)
+response_cache.compression = compression
+# Pre-encoded quotes follow the response cache: same TTL, off when it is
+quote_fragments = None
+if response_cache.enabled and app.config['FRAGMENT_CACHE_MAX_ENTRIES'] > 0:
+    quote_fragments = FragmentCache(app.config['FRAGMENT_CACHE_MAX_ENTRIES'],
+                                    response_cache.ttl('quote'))
+response_cache.fragments = quote_fragments
+
 #--------------------------------------------------------
 # Endpoint 0                                            |
 #--------------------------------------------------------
@@ -17,13 +216,78 @@ app.config['CONNECTION_STRING'] = os.environ.get('CONNECTION_STRING')
 def index():
     return render_template('index.html')
 #--------------------------------------------------------
-# Returns an error, if limit is negative                |           
+# Returns the connection pool statistics                |
+#--------------------------------------------------------
+@app.route('/pool/stats', methods=['GET'])
+def get_pool_stats():
+    stats = db.get_pool(app).stats()
+    router = db.get_router(app)
+    if router:
+        stats["replicas"] = router.stats()
+    stats["admission"] = db.get_admission(app).stats()
+    if ingest_queue:
+        stats["ingest"] = ingest_queue.stats()
+    json_response = json.dumps(stats)
+    return Response(json_response, 200, content_type='application/json')
+
+#--------------------------------------------------------
+# Returns the response cache statistics                 |
 #--------------------------------------------------------
-def limit_error():
-    response_data = {"error": "limit cannot be negative"}
-    json_response = json.dumps(response_data)
-        
-    return Response(json_response, 404, content_type='application/json')
+@app.route('/cache/stats', methods=['GET'])
+def get_cache_stats():
+    json_response = json.dumps(cache_stats())
+    return Response(json_response, 200, content_type='application/json')
+
+def cache_stats():
+    stats = response_cache.stats()
+    stats["not modified"] = data_versions.not_modified
+    stats["names"] = name_resolvers.stats()
+    stats["duplicates"] = quote_duplicates.stats()
+    return stats
+
+def cache_metrics():
+    stats = response_cache.stats()
+    return [
+        ('quotes_api_cache_requests_total', 'counter', "Response cache lookups by result",
+         [({'result': 'hit'}, stats['hits']), ({'result': 'miss'}, stats['misses'])]),
+        ('quotes_api_not_modified_total', 'counter', "Conditional GETs answered with 304",
+         [({}, data_versions.not_modified)]),
+        ('quotes_api_name_lookups_total', 'counter',
+         "Author/category name lookups by result (coalesced misses waited for another request)",
+         [({'table': resolver.table, 'result': result}, getattr(resolver, result))
+          for resolver in (name_resolvers.authors, name_resolvers.categories)
+          for result in ('hits', 'misses', 'coalesced')]),
+    ]
+
+metrics.registry.collectors.append(cache_metrics)
+
+#--------------------------------------------------------
+# Runs a handler from handlers.py on this request's     |
+# connection and turns its result into a JSON response  |
+#--------------------------------------------------------
+def respond(handler):
+    status, response_data = queries.run(handler, get_db)
+    return json_response(status, response_data)
+
+def json_response(status, response_data):
+    return Response(serialize.dumps(response_data), status, content_type='application/json')
+
+# Writes are refused when serving a snapshot
+def read_only_error():
+    return json_response(405, {"error": "this instance serves a read-only snapshot"})
+
+# Invalid fields= or ids= arguments (see fields.py)
+@app.errorhandler(ArgumentError)
+def argument_error(error):
+    return json_response(400, {"error": str(error)})
+
+#--------------------------------------------------------
+# Paging arguments of a list route: limit, cursor and   |
+# count (see pagination.py)                             |
+#--------------------------------------------------------
+def page_args():
+    limit = request.args.get('limit', default=5, type=int)
+    return Page(request.path, request.args.items(multi=True), limit)
 
 #--------------------------------------------------------
 # Endpoint 1                                            |
@@ -31,71 +295,45 @@ def limit_error():
 #--------------------------------------------------------
 @app.route("/quotes/random", methods=['GET'])
 def get_random_quote():
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
     limit = request.args.get('limit', default=1, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    query = """
-    SELECT Quotes.text, Authors.name, Categories.name
-    FROM Quotes
-    JOIN Authors ON Quotes.authorID = Authors.ID
-    JOIN Categories ON Quotes.categoryID = Categories.ID
-    ORDER BY random()
-    LIMIT %s;
-    """
-    cursor = conn.cursor()
-    cursor.execute(query, (limit,))
-    response_keys = ['quote', 'author', 'category']
-    quotes = [dict(zip(response_keys, quote)) for quote in cursor.fetchall()]
-    cursor.close()
-    conn.close()
-    
-    response_data = {'randomQuotes': quotes}
-    json_response = json.dumps(response_data)
-    
-    return Response(json_response, 200, content_type='application/json')
+    fields = parse_fields(request.args.get('fields'))
+    if snapshots:
+        response = json_response(*snapshots.current().random_quotes(limit, fields))
+    else:
+        response = respond(handlers.random_quotes(quote_sampler, limit, quote_fragments, fields))
+    # Every call is meant to return something different
+    response.headers['Cache-Control'] = 'no-store'
+    return response
 
 #--------------------------------------------------------
 # Endpoint 2                                            |
 # Returns the quote data provided the ID of that quote  |
 #--------------------------------------------------------
 @app.route('/quotes/<int:quote_id_raw>', methods=['GET'])
+@data_versions.conditional('quote', tags=lambda quote_id_raw: [quote_tag(quote_id_raw)])
+@response_cache.cached('quote', tags=lambda quote_id_raw: [quote_tag(quote_id_raw)])
 def get_quote_by_id(quote_id_raw: int):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    quote_id = escape(quote_id_raw)
-    query = """
-    SELECT Quotes.text, Authors.name, Categories.name
-    FROM Quotes
-    JOIN Authors ON Quotes.authorID = Authors.ID
-    JOIN Categories ON Quotes.categoryID = Categories.ID
-    WHERE Quotes.ID = %s;
-    """
-    cursor = conn.cursor()
-    cursor.execute(query, (quote_id,))
-    
-    quote_data = cursor.fetchone()
-    
-    if not quote_data:
-        response_data = {"error": "Quote not found"}
-        json_response = json.dumps(response_data)
-        
-        return Response(json_response, 404, content_type='application/json')
-    
-    cursor.close()
-    conn.close()
-    
-    quote_text, author_name, category_name = quote_data
-    
-    response_data = {
-        "quote": quote_text, 
-        "author": author_name,
-        "category": category_name
-    }
-    
-    json_response = json.dumps(response_data)
-    return Response(json_response, 200, content_type='application/json')
+    fields = parse_fields(request.args.get('fields'))
+    if snapshots:
+        return json_response(*snapshots.current().quote_by_id(quote_id_raw, fields))
+    return respond(handlers.quote_by_id(quote_id_raw, quote_fragments, fields))
+
+#--------------------------------------------------------
+# Endpoint 2 (multi-get)                                |
+# Returns the quotes of ids=1,2,3 in that order, with   |
+# an error entry for every ID that has no quote. Any    |
+# new quote may fill one of those, so entries are       |
+# dropped on every write like the search results.       |
+#--------------------------------------------------------
+@app.route('/quotes', methods=['GET'])
+@data_versions.conditional('quotes', tags=lambda: ['quotes'])
+@response_cache.cached('quotes', tags=lambda: ['quotes'])
+def get_quotes_by_ids():
+    quote_ids = parse_ids(request.args.get('ids'), app.config['MULTI_GET_MAX_IDS'])
+    fields = parse_fields(request.args.get('fields'))
+    if snapshots:
+        return json_response(*snapshots.current().quotes_by_ids(quote_ids, fields))
+    return respond(handlers.quotes_by_ids(quote_ids, quote_fragments, fields))
 
 
 #--------------------------------------------------------
@@ -103,39 +341,12 @@ def get_quote_by_id(quote_id_raw: int):
 # Returns a list of Authors                             |
 #--------------------------------------------------------
 @app.route('/authors', methods=['GET'])
+@data_versions.conditional('authors', tags=lambda: ['authors'])
+@response_cache.cached('authors', tags=lambda: ['authors'])
 def get_all_authors():
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    limit = request.args.get('limit', default=5, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    count_query = "SELECT COUNT(name) FROM Authors;" 
-    cursor.execute(count_query)
-    authors_count = cursor.fetchone()
-    authors_count = authors_count[0]
-    
-    authors_query = "SELECT name FROM Authors ORDER BY name LIMIT %s;"
-    cursor.execute(authors_query, (limit,))
-    authors = [author[0] for author in cursor.fetchall()]
-    
-    cursor.close()
-    conn.close()
-    
-    if authors_count < 1:
-        response_data = {
-            "authors": []
-        }
-    else:
-        response_data =  {
-            "total number of authors": authors_count,
-            "number of authors returned": len(authors),
-            "authors": authors
-        }
-    
-    json_response = json.dumps(response_data)
-    return Response(json_response, 200, content_type='application/json')
+    if snapshots:
+        return json_response(*snapshots.current().authors_page(page_args()))
+    return respond(handlers.authors(page_args()))
 
 
 #--------------------------------------------------------
@@ -144,211 +355,43 @@ def get_all_authors():
 # unless the limit is provided as parameter             |
 #--------------------------------------------------------
 @app.route('/quotes/author/<string:author_name_raw>', methods=['GET'])
+@data_versions.conditional('quotes_by_author',
+                           tags=lambda author_name_raw: [author_name_tag(author_name_raw)])
+@response_cache.cached('quotes_by_author',
+                       tags=lambda author_name_raw: [author_name_tag(author_name_raw)])
 def get_quotes_by_author(author_name_raw: str):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    author_name = escape(author_name_raw)
-    limit = request.args.get('limit', default=5, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    # Returns the number of total quotes for the given author
-    count_query = """
-    SELECT COUNT(*) AS total_quotes
-    FROM Quotes
-    WHERE authorID = (
-        SELECT ID FROM Authors 
-        WHERE name ILIKE %s
-    );
-    """
-    
-    quotes_query = """
-    SELECT Quotes.text
-    FROM Quotes
-    WHERE authorID = (
-        SELECT Authors.ID FROM Authors
-        WHERE Authors.name ILIKE %s)
-    LIMIT %s;
-    """
-    
-    cursor.execute(count_query, (author_name,))
-    quote_count = cursor.fetchone()
-    
-    cursor.execute(quotes_query, (author_name, limit,))
-    quotes = [quote[0] for quote in cursor.fetchall()]
-    
-    cursor.close()
-    conn.close()
-    
-    # No quotes found
-    if quote_count[0] < 1:
-        response_data = {
-            "error": "quotes not found!"
-        }
-        json_response = json.dumps(response_data)
-        return Response(json_response, 404, content_type='application/json')
-    
-    author_name = author_name.title()
-    response_data = {
-        "total quotes available": quote_count[0],
-        "amount of quotes returned": len(quotes),
-        "author": author_name,
-        "quotes": quotes
-    }
-    
-    json_response = json.dumps(response_data)
-    return Response(json_response, 200, content_type='application/json')
+    if snapshots:
+        return json_response(*snapshots.current().quotes_by_author_name(author_name_raw, page_args()))
+    return respond(handlers.quotes_by_author_name(author_name_raw, page_args(), name_catalog))
 
-#--------------------------------------------------------
-# Returns the name of the author, given its ID          |
-#--------------------------------------------------------
-def get_author_name(author_id: int):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    
-    query = "SELECT name FROM Authors WHERE ID = %s;"
-    cursor.execute(query, (author_id,))
-    author_name = cursor.fetchone()
-    
-    if author_name:
-        return author_name[0]    
-    
-    return None
-    
 #--------------------------------------------------------
 # Endpoint 5                                            |
 # Returns a list of quotes belonging to a specific      |
 # author using the ID                                   |
 #--------------------------------------------------------
 @app.route('/quotes/author/<int:author_id_raw>', methods=['GET'])
+@data_versions.conditional('quotes_by_author',
+                           tags=lambda author_id_raw: [author_tag(author_id_raw)])
+@response_cache.cached('quotes_by_author', tags=lambda author_id_raw: [author_tag(author_id_raw)])
 def get_quotes_by_authorID(author_id_raw: int):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    author_id = escape(author_id_raw)
-    limit = request.args.get('limit', default=5, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    author_name = get_author_name(author_id)
-    
-    count_query = """
-    SELECT COUNT(text) AS total_quotes
-    FROM Quotes
-    WHERE authorID =  %s;
-    """
-    cursor.execute(count_query, (author_id,))
-    quote_count = cursor.fetchone()
-    quote_count = quote_count[0]
-    
-    quotes_query = """
-    SELECT Quotes.text 
-    FROM Quotes
-    WHERE Quotes.authorID = %s
-    LIMIT %s;
-    """
-    cursor.execute(quotes_query, (author_id, limit,))
-    quotes = [quote[0] for quote in cursor.fetchall()]
-    
-    cursor.close()
-    conn.close()
-    
-    if quote_count < 1:
-        response_data = {
-            "error": "quotes not found!"
-        }
-        json_response = json.dumps(response_data)
-        return Response(json_response, 404, content_type='application/json')
-    
-
-    response_data = {
-        "total quotes available": quote_count,
-        "amount of quotes returned": len(quotes),
-        "authorID": int(author_id),
-        "authorName": author_name,
-        "quotes": quotes
-    }
-    
-    json_response = json.dumps(response_data)
-    return Response(json_response, 200, content_type='application/json')
+    if snapshots:
+        return json_response(*snapshots.current().quotes_by_author_id(author_id_raw, page_args()))
+    return respond(handlers.quotes_by_author_id(author_id_raw, page_args()))
 
 #-------------------------------------------------------------
 # Endpoint 6                                                 |
 # Returns a list of quotes belonging to a specific category  |
 #-------------------------------------------------------------
 @app.route('/quotes/category/<string:category_name_raw>', methods=['GET'])
+@data_versions.conditional('quotes_by_category',
+                           tags=lambda category_name_raw: [category_name_tag(category_name_raw)])
+@response_cache.cached('quotes_by_category',
+                       tags=lambda category_name_raw: [category_name_tag(category_name_raw)])
 def get_quotes_by_categoryName(category_name_raw: str):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    category_name = escape(category_name_raw)
-    limit = request.args.get('limit', default=5, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    count_query = """
-    SELECT COUNT(*) AS total_quotes
-    FROM Quotes
-    WHERE categoryID = (
-        SELECT ID FROM Categories 
-        WHERE name ILIKE %s
-    );
-    """
-    
-    quotes_query = """
-    SELECT Quotes.text 
-    FROM Quotes
-    WHERE Quotes.categoryID = (
-        SELECT ID FROM Categories 
-        WHERE Categories.name ILIKE %s
-    )
-    LIMIT %s;
-    """
-    
-    cursor.execute(count_query, (category_name,))
-    quote_count = cursor.fetchone()
-    
-    cursor.execute(quotes_query, (category_name, limit,))
-    quotes = [quote[0] for quote in cursor.fetchall()]
-    
-    cursor.close()
-    conn.close()
-    
-    if quote_count[0] < 1:
-        response_data = {
-            "error": "quotes not found!"
-        }
-        json_response = json.dumps(response_data)
-        return Response(json_response, 404, content_type='application/json')
-    
-
-    category_name = category_name.title()
-    response_data = {
-        "total quotes available": quote_count[0],
-        "amount of quotes returned": len(quotes),
-        "category": category_name,
-        "quotes": quotes
-    }
-    
-    json_response = json.dumps(response_data)
-    return Response(json_response, 200, content_type='application/json')
-
-#--------------------------------------------------------
-# Returns the name of the category, given its ID        |
-#--------------------------------------------------------
-def get_category_name(category_id: int):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    
-    query = "SELECT name FROM Categories WHERE ID = %s;"
-    cursor.execute(query, (category_id,))
-    category_name = cursor.fetchone()
-    
-    if category_name:
-        return category_name[0]    
-    
-    return None
+    if snapshots:
+        return json_response(*snapshots.current().quotes_by_category_name(category_name_raw, page_args()))
+    return respond(handlers.quotes_by_category_name(category_name_raw, page_args(),
+                                                    name_catalog))
 
 #--------------------------------------------------------
 # Endpoint 7                                            |
@@ -356,162 +399,27 @@ def get_category_name(category_id: int):
 # category using the ID                                 |
 #--------------------------------------------------------
 @app.route('/quotes/category/<int:category_id_raw>', methods=['GET'])
+@data_versions.conditional('quotes_by_category',
+                           tags=lambda category_id_raw: [category_tag(category_id_raw)])
+@response_cache.cached('quotes_by_category',
+                       tags=lambda category_id_raw: [category_tag(category_id_raw)])
 def get_quotes_by_categoryID(category_id_raw: int):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    category_id = escape(category_id_raw)
-    limit = request.args.get('limit', default=5, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    category_name = get_category_name(category_id)
-    
-    count_query = """
-    SELECT COUNT(text) AS total_quotes
-    FROM Quotes
-    WHERE categoryID =  %s;
-    """
-    cursor.execute(count_query, (category_id,))
-    quote_count = cursor.fetchone()
-    quote_count = quote_count[0]
-    
-    quotes_query = """
-    SELECT Quotes.text 
-    FROM Quotes
-    WHERE Quotes.categoryID = %s
-    LIMIT %s;
-    """
-    cursor.execute(quotes_query, (category_id, limit,))
-    quotes = [quote[0] for quote in cursor.fetchall()]
-    
-    cursor.close()
-    conn.close()
-    
-    if quote_count < 1:
-        response_data = {
-            "error": "quotes not found!"
-        }
-        json_response = json.dumps(response_data)
-        return Response(json_response, 404, content_type='application/json')
-    
-
-    response_data = {
-        "total quotes available": quote_count,
-        "amount of quotes returned": len(quotes),
-        "categoryID": int(category_id),
-        "categoryName": category_name,
-        "quotes": quotes
-    }
-    
-    json_response = json.dumps(response_data)
-    return Response(json_response, 200, content_type='application/json')
+    if snapshots:
+        return json_response(*snapshots.current().quotes_by_category_id(category_id_raw, page_args()))
+    return respond(handlers.quotes_by_category_id(category_id_raw, page_args()))
 
 #--------------------------------------------------------
 # Endpoint 8                                          |
 # Returns a list of all categories for quotes           |
 #--------------------------------------------------------
 @app.route('/categories', methods=['GET'])
+@data_versions.conditional('categories', tags=lambda: ['categories'])
+@response_cache.cached('categories', tags=lambda: ['categories'])
 def get_all_categories():
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    limit = request.args.get('limit', default=5, type=int)
-    
-    if limit < 0:
-        return limit_error()
-    
-    count_query = "SELECT COUNT(name) FROM Categories;"
-    cursor.execute(count_query)
-    total_categories = cursor.fetchone()
-    total_categories = total_categories[0]
-    
-    categories_query = "SELECT name FROM Categories ORDER BY name LIMIT %s;"
-    cursor.execute(categories_query, (limit,))
-    categories = [category[0] for category in cursor.fetchall()]
-    
-    cursor.close()
-    conn.close()
-    
-    if total_categories < 1:
-        response_data = {
-            "categories": []
-        }
-    else:
-        response_data = {
-            "total number of categories": total_categories,
-            "amount of categories returned": len(categories),
-            "categories": categories
-        }
-        
-    json_response = json.dumps(response_data)    
-    return Response(json_response, 200, content_type='application/json')    
-
-#--------------------------------------------------------
-# Returns the ID of the Author, given the name          |
-#--------------------------------------------------------
-def get_id_from_author_name(author_name):
-    if not author_name:
-        return None
-    
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-
-    query = "SELECT ID FROM Authors WHERE name ILIKE %s"
-    cursor.execute(query, (author_name,))
-    author_id = cursor.fetchone()
-    
-    # If the author doesn't exist, add the author
-    if not author_id:
-        query = "INSERT INTO Authors (name) VALUES (%s) RETURNING id;"
-        try:
-            cursor.execute(query, (author_name,))
-            conn.commit()
-            author_id = cursor.fetchone()
-        except (Exception, psycopg2.DatabaseError) as error:
-            return {"error": error}, 500
-        
-    return author_id[0]
-
-
-#--------------------------------------------------------
-# Returns the ID of the category, given the name        |
-#--------------------------------------------------------
-def get_id_from_category_name(category_name):
-    if not category_name:
-        return None
-    
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
+    if snapshots:
+        return json_response(*snapshots.current().categories_page(page_args()))
+    return respond(handlers.categories(page_args()))
 
-    query = "SELECT ID FROM Categories WHERE name ILIKE %s"
-    cursor.execute(query, (category_name,))
-    category_id = cursor.fetchone()
-    
-    # If the category doesn't exist, add the category
-    if not category_id:
-        query = "INSERT INTO Categories (name) VALUES (%s) RETURNING id;"
-        try:
-            cursor.execute(query, (category_name,))
-            conn.commit()
-            category_id = cursor.fetchone()
-        except (Exception, psycopg2.DatabaseError) as error:
-            return {"error": error}, 500
-        
-    return category_id[0]
-
-#--------------------------------------------------------
-# Checks if the quote already exists                    |
-#--------------------------------------------------------
-def quote_exists(cursor, quote):
-    query = "SELECT ID FROM Quotes WHERE text ILIKE %s;"
-    cursor.execute(query, (quote,))
-    result = cursor.fetchone()
-    
-    if not result:
-        return None
-    
-    return result[0]
-    
 #--------------------------------------------------------
 # Endpoint 9                                            |
 # Adds a new quote to the database provided the         |
@@ -519,58 +427,45 @@ def quote_exists(cursor, quote):
 #--------------------------------------------------------
 @app.route('/quotes', methods=['POST'])
 def add_new_quote():
-    # Things needed to insert a new quote
-    # quote, authorID, categoryID
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    
+    if snapshots:
+        return read_only_error()
     data = request.json
-    text = data.get('quote')
-    author_name = data.get('author')
-    category_name = data.get('category')
-
-    # check for any missing parameters
-    missing_fields = []
-    if not text:
-        missing_fields.append("quote text")
-    if not author_name:
-        missing_fields.append("author name")
-    if not category_name:
-        missing_fields.append("category")
-    if missing_fields:
-        response_data = {"error": "couldn't add the quote", "missingFields": missing_fields}
-        json_response = json.dumps(response_data)
-        return Response(json_response, 400, content_type='application/json')
-    
-    #check if quote already exists
-    quote_already_exists = quote_exists(cursor, text)
-    if quote_already_exists is not None:
-        return {"error": "quote already exists", "quoteID": quote_already_exists, "quote": text}, 404
-    
-    author_id = get_id_from_author_name(author_name)
-    category_id = get_id_from_category_name(category_name)
-    
-    if author_id is None or category_id is None:
-        return {"error": "couldn't complete the request, try later"} # error while inserting author
-    
-    query = "INSERT INTO Quotes (text, authorID, categoryID) VALUES (%s, %s, %s) RETURNING ID;"
-    try:
-        cursor.execute(query, (text, author_id, category_id,))
-        conn.commit()
-        quote_id = cursor.fetchone()[0]
-        cursor.close()
-        conn.close()
-        response_data = {
-            "message": "successfully created a new quote",
-            "quoteID": quote_id,
-            "author": author_name,
-            "quote": text,
-            "category": category_name
-        }   
-        json_response = json.dumps(response_data)
-        return Response(json_response, 201, content_type='application/json')
-    except (Exception, psycopg2.DatabaseError) as error:
-            return {"error": error}, 500
+    if isinstance(data, list):
+        return add_quotes_batch(data)
+    if ingest_queue:
+        status, response_data = handlers.queue_quote(data, ingest_queue)
+        response = json_response(status, response_data)
+        if status == 202:
+            response.headers['Location'] = '/quotes/tickets/' + response_data['ticket']
+        return response
+    return respond(handlers.add_quote(data, quote_sampler, response_cache, name_resolvers,
+                                      quote_duplicates))
+
+#--------------------------------------------------------
+# Endpoint 9 (ticket status)                            |
+# Returns the outcome of a quote queued with 202, while |
+# INGEST_ENABLED is set                                 |
+#--------------------------------------------------------
+@app.route('/quotes/tickets/<string:ticket>', methods=['GET'])
+def get_ticket_status(ticket):
+    if not ingest_queue:
+        return json_response(404, {"error": "write-behind ingestion is disabled"})
+    return respond(handlers.ticket_status(ticket, ingest_queue))
+
+#--------------------------------------------------------
+# Endpoint 9 (batch)                                    |
+# Adds many quotes in one request. The body is an array |
+# of {quote, author, category} objects, the response    |
+# reports created / duplicate / invalid for each one.   |
+#--------------------------------------------------------
+@app.route('/quotes/batch', methods=['POST'])
+def add_quotes_batch(items=None):
+    if snapshots:
+        return read_only_error()
+    if items is None:
+        items = request.json
+    return respond(handlers.add_quotes(items, quote_sampler, response_cache, name_resolvers,
+                                       quote_duplicates, app.config['BATCH_MAX_SIZE']))
         
 #--------------------------------------------------------
 # Endpoint 10                                           |
@@ -578,43 +473,174 @@ def add_new_quote():
 #--------------------------------------------------------
 @app.route('/quotes/<int:quote_id_raw>', methods=['PATCH'])
 def update_quote(quote_id_raw: int):
-    conn = psycopg2.connect(app.config['CONNECTION_STRING'])
-    cursor = conn.cursor()
-    
+    if snapshots:
+        return read_only_error()
     # Fields required for updates
-    quote_id = escape(quote_id_raw)
     text = request.args.get('quote', default=None, type=str)
     author = request.args.get('author', default=None, type=str)
-    authorID = get_id_from_author_name(author)
     category = request.args.get('category', default=None, type=str)
-    categoryID = get_id_from_category_name(category)
+    return respond(handlers.update_quote(quote_id_raw, text, author, category, response_cache,
+                                         name_resolvers, quote_duplicates))
+
+#--------------------------------------------------------
+# Endpoint 11                                           |
+# Full-text search of the quotes, with optional author  |
+# and category filters                                  |
+#--------------------------------------------------------
+@app.route('/quotes/search', methods=['GET'])
+@data_versions.conditional('search', tags=lambda: ['quotes'])
+def search_quotes():
+    text = request.args.get('q', default=None, type=str)
+    author = request.args.get('author', default=None, type=str)
+    category = request.args.get('category', default=None, type=str)
+    fields = parse_fields(request.args.get('fields'), SEARCH_FIELDS)
+    if snapshots:
+        return json_response(*snapshots.current().search_quotes(text, author, category,
+                                                                page_args(), fields))
+    return respond(handlers.search_quotes(text, author, category, page_args(), fields))
+
+#--------------------------------------------------------
+# Endpoint 12                                           |
+# Streams every quote (optionally of one author and/or  |
+# category) as NDJSON or CSV, in ID order from after_id |
+#--------------------------------------------------------
+@app.route('/quotes/export', methods=['GET'])
+def export_quotes():
+    author = request.args.get('author', default=None, type=str)
+    category = request.args.get('category', default=None, type=str)
+    try:
+        fmt, content_type, after_id = export.parse_args(request.args.get('format'),
+                                                        request.args.get('after_id'))
+    except export.ExportError as e:
+        return json_response(400, {"error": str(e)})
+    fields = parse_fields(request.args.get('fields'))
+
+    batch_size = app.config['EXPORT_BATCH_SIZE']
+    if snapshots:
+        rows = snapshots.current().export_rows(author, category, after_id)
+        chunks = export.stream_rows(rows, fmt, batch_size, fields)
+    else:
+        chunks = export.stream(get_db(), fmt, author, category, after_id, batch_size, fields)
+    # No Content-Length, so the response is sent chunked as the rows are read
+    return Response(stream_with_context(chunks), 200, content_type=content_type)
+
+#--------------------------------------------------------
+# Endpoint 13                                           |
+# Returns the number of quotes, authors and categories  |
+# and the `limit` authors/categories with most quotes   |
+#--------------------------------------------------------
+@app.route('/stats', methods=['GET'])
+@data_versions.conditional('stats', tags=lambda: ['quotes'])
+@response_cache.cached('stats', tags=lambda: ['quotes'])
+def get_stats():
+    limit = request.args.get('limit', default=10, type=int)
+    if snapshots:
+        return json_response(*snapshots.current().quote_stats(limit))
+    return respond(handlers.quote_stats(limit))
+
+#--------------------------------------------------------
+# Returns an error response unless the request carries  |
+# the admin token as "Authorization: Bearer <token>"    |
+#--------------------------------------------------------
+def check_admin_token():
+    error = admin_token_error(request.headers.get('Authorization', ''))
+    if error:
+        return json_response(*error)
+    return None
+
+# (status, response data) when `authorization` isn't the admin token, shared with asgi.py
+def admin_token_error(authorization):
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        return 403, {"error": "admin endpoints are disabled"}
+    if not hmac.compare_digest(authorization.encode('utf-8'), ('Bearer ' + token).encode('utf-8')):
+        return 401, {"error": "invalid admin token"}
+    return None
+
+# The bulk import format: ?format= or else from the body's type
+def import_format(fmt, mimetype):
+    if fmt is None:
+        ndjson_types = ('application/x-ndjson', 'application/jsonl', 'application/json')
+        fmt = 'ndjson' if mimetype in ndjson_types else 'csv'
+    return fmt
+
+# Drops what the import made stale, `conn` is a psycopg2 connection
+def after_import(conn):
+    response_cache.clear()
+    quote_sampler.invalidate()
+    quote_duplicates.invalidate()
+    if name_catalog:
+        name_catalog.build(conn)
+
+#--------------------------------------------------------
+# Admin endpoint                                        |
+# Bulk imports quotes sent as CSV or NDJSON in the body |
+# (see bulk_load.py for the accepted columns)           |
+#--------------------------------------------------------
+@app.route('/admin/import', methods=['POST'])
+def bulk_import():
+    error = check_admin_token()
+    if error:
+        return error
+    if snapshots:
+        return read_only_error()
     
-    find_quote_query = "SELECT text FROM Quotes WHERE ID = %s"
-    cursor.execute(find_quote_query, (quote_id,))
-    existing_quote = cursor.fetchone()
-    if not existing_quote:
-        return Response(json.dumps({"error": "Quote was not found"}), 
-                        status=404, content_type='application/json')
+    fmt = import_format(request.args.get('format'), request.mimetype)
     
-    update_quote_query = "UPDATE Quotes SET"
-    if text:
-        update_quote_query += f" text = {text},"
-        
-    if author:
-        update_quote_query += f" authorID = {authorID},"
+    stream = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8', newline='')
+    try:
+        summary = bulk_load.load(get_db(), stream, fmt)
+    except bulk_load.BulkLoadError as e:
+        return Response(json.dumps({"error": str(e)}), 400, content_type='application/json')
     
-    if category:
-        update_quote_query += f" categoryID = {categoryID},"
-        
-    update_quote_query = update_quote_query.rstrip(',') + f" WHERE ID = {quote_id};"
+    after_import(get_db())
+    
+    return Response(json.dumps(summary), 200, content_type='application/json')
+
+#--------------------------------------------------------
+# Admin endpoint                                        |
+# Checks the quote counters against the tables, and     |
+# corrects them with ?repair=1 (see counts.py)          |
+#--------------------------------------------------------
+@app.route('/admin/counts/reconcile', methods=['POST'])
+def reconcile_counts():
+    error = check_admin_token()
+    if error:
+        return error
+    if snapshots:
+        return read_only_error()
+
+    summary = counts.reconcile(get_db(), request.args.get('repair') == '1')
+    if summary['repaired']:
+        response_cache.invalidate('quotes', 'authors', 'categories')
+
+    return json_response(200, summary)
+
+#--------------------------------------------------------
+# Returns the snapshot statistics, when serving one     |
+#--------------------------------------------------------
+@app.route('/snapshot/stats', methods=['GET'])
+def get_snapshot_stats():
+    if not snapshots:
+        return json_response(404, {"error": "not serving a snapshot"})
+    return json_response(200, snapshots.stats())
+
+#--------------------------------------------------------
+# Admin endpoint                                        |
+# Reloads the snapshot file now instead of waiting for  |
+# the next check                                        |
+#--------------------------------------------------------
+@app.route('/admin/snapshot/reload', methods=['POST'])
+def reload_snapshot():
+    error = check_admin_token()
+    if error:
+        return error
+    if not snapshots:
+        return json_response(404, {"error": "not serving a snapshot"})
+
     try:
-        cursor.execute(update_quote_query)
-        conn.commit()
-        conn.close()
-        response_data = {
-            "message": "Quote updated succesfully",
-            "quoteID": quote_id
-        }
-        return Response(json.dumps(response_data), status=200, content_type='application/json')
-    except Exception as e:
-        return Response(json.dumps({"error": str(e)}), status=500, content_type='application/json')
+        snapshots.reload()
+    except (OSError, SnapshotError, ValueError) as e:
+        return json_response(500, {"error": str(e)})
+
+    return json_response(200, snapshots.stats())
@@ -0,0 +1,777 @@
+import asyncio
+import io
+import json
+import re
+import time
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+
+from psycopg import AsyncConnection, OperationalError
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+
+import admission
+import bulk_load
+import counts
+import db
+import export
+import handlers
+import metrics
+import queries
+import replicas
+from queries import Query, Statement, Commit, Rollback, Wait
+from pagination import Page
+from fields import ArgumentError, QUOTE_FIELDS, SEARCH_FIELDS, parse_fields, parse_ids
+import serialize
+from app import (app as flask_app, quote_sampler, response_cache, snapshots,
+                 data_versions, cache_stats, compression, quote_fragments, name_resolvers,
+                 quote_duplicates, ingest_queue, name_catalog, admin_token_error,
+                 import_format, after_import)
+from snapshot import SnapshotError
+from versions import validator_headers, is_not_modified, not_modified_headers
+from cache import (quote_tag, author_tag, author_name_tag,
+                   category_tag, category_name_tag)
+
+#--------------------------------------------------------
+# ASGI serving mode.                                    |
+#                                                       |
+# Serves the same endpoints as app.py from the handlers |
+# in handlers.py, on psycopg 3's async driver and pool, |
+# so a worker waiting on the database doesn't hold a    |
+# thread. Configuration, the random quote sampler and   |
+# the response cache are the ones app.py sets up. Run   |
+# with any ASGI server:                                 |
+#                                                       |
+#     uvicorn asgi:app                                  |
+#--------------------------------------------------------
+config = flask_app.config
+
+# Times new connections for /metrics
+class InstrumentedConnection(AsyncConnection):
+    # The pool the connection was checked out of and the admission gate it
+    # holds, see getconn()
+    home_pool = None
+    gate = None
+
+    @classmethod
+    async def connect(cls, *args, **kwargs):
+        started = time.perf_counter()
+        conn = await super().connect(*args, **kwargs)
+        metrics.CONNECT_SECONDS.observe(time.perf_counter() - started)
+        return conn
+
+pool = AsyncConnectionPool(
+    config['CONNECTION_STRING'] or '',
+    min_size=config['DB_POOL_MIN_SIZE'],
+    max_size=config['DB_POOL_MAX_SIZE'],
+    timeout=config['DB_POOL_TIMEOUT'],
+    max_idle=config['DB_POOL_MAX_IDLE'],
+    max_lifetime=config['DB_POOL_MAX_LIFETIME'],
+    check=AsyncConnectionPool.check_connection if config['DB_POOL_HEALTH_CHECK'] else None,
+    connection_class=InstrumentedConnection,
+    open=False,
+)
+
+# Read replicas, routed like the Flask app does (see replicas.py and db.py)
+replica_dsns = [] if snapshots else replicas.parse_dsns(config['REPLICA_CONNECTION_STRINGS'])
+replica_router = None
+if replica_dsns:
+    replica_router = replicas.ReplicaRouter(
+        [replicas.Replica("replica%d" % (i + 1), AsyncConnectionPool(
+            dsn,
+            min_size=0,
+            max_size=config['DB_POOL_MAX_SIZE'],
+            timeout=config['REPLICA_CONNECT_TIMEOUT'],
+            max_idle=config['DB_POOL_MAX_IDLE'],
+            max_lifetime=config['DB_POOL_MAX_LIFETIME'],
+            check=AsyncConnectionPool.check_connection if config['DB_POOL_HEALTH_CHECK'] else None,
+            connection_class=InstrumentedConnection,
+            kwargs={'connect_timeout': max(int(config['REPLICA_CONNECT_TIMEOUT']), 1)},
+            open=False,
+        )) for i, dsn in enumerate(replica_dsns)],
+        max_lag=config['REPLICA_MAX_LAG'],
+        check_interval=config['REPLICA_CHECK_INTERVAL'],
+        write_window=config['READ_YOUR_WRITES_WINDOW'],
+    )
+    metrics.registry.collectors.append(replica_router.metrics)
+
+# Admission control, the same limits as the Flask app (see admission.py)
+admission_control = db.get_admission(flask_app)
+metrics.registry.collectors.append(admission_control.metrics)
+
+#--------------------------------------------------------
+# Async counterpart of queries.run(). Statements are    |
+# prepared by psycopg itself (prepare=True), once per   |
+# connection. The connection is checked out at the      |
+# first database operation, and its transaction is      |
+# always closed before it goes back to the pool.        |
+#--------------------------------------------------------
+async def run(handler, connect):
+    conn = cursor = None
+    try:
+        op = next(handler)
+        while True:
+            if cursor is None and not isinstance(op, Wait):
+                conn = await connect()
+                cursor = conn.cursor()
+            try:
+                if isinstance(op, Query):
+                    await execute(cursor, op.sql, op.params)
+                    if op.fetch == 'one':
+                        result = await cursor.fetchone()
+                    elif op.fetch == 'all':
+                        result = await cursor.fetchall()
+                    else:
+                        result = cursor.rowcount
+                elif isinstance(op, Statement):
+                    query, params = queries.portable_statement(op.name, op.params)
+                    await execute(cursor, query, params, op.name, prepare=True)
+                    result = await cursor.fetchone()
+                elif isinstance(op, Commit):
+                    await conn.commit()
+                    result = None
+                elif isinstance(op, Rollback):
+                    await conn.rollback()
+                    result = None
+                elif isinstance(op, Wait):
+                    # Shielded: a waiter timing out must not cancel the
+                    # future other requests share
+                    result = await asyncio.wait_for(
+                        asyncio.shield(asyncio.wrap_future(op.future)), op.timeout)
+                else:
+                    raise TypeError("unknown database operation %r" % (op,))
+            except Exception as error:
+                op = handler.throw(error)
+            else:
+                op = handler.send(result)
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        if conn is not None:
+            try:
+                await cursor.close()
+            finally:
+                await conn.rollback()
+
+#--------------------------------------------------------
+# cursor.execute() timed for /metrics, like the psycopg2|
+# cursors of db.py                                      |
+#--------------------------------------------------------
+async def execute(cursor, query, params, name=None, **kwargs):
+    started = time.perf_counter()
+    try:
+        await cursor.execute(query, params, **kwargs)
+    except Exception:
+        metrics.observe_query(query, time.perf_counter() - started, None, error=True, name=name)
+        raise
+    metrics.observe_query(query, time.perf_counter() - started, cursor.rowcount, name=name)
+
+#--------------------------------------------------------
+# Checks a connection out of the primary's pool or, for |
+# reads the router sends there, a replica's. Replica    |
+# checks run in a background task so no request waits   |
+# for them.                                             |
+#--------------------------------------------------------
+_checks = set()
+
+async def getconn():
+    started = time.perf_counter()
+    gate = admission_control.gate()
+    await gate.enter_async()
+    try:
+        conn = await _checkout()
+    except BaseException:
+        gate.leave()
+        raise
+    conn.gate = gate
+    metrics.ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+    return conn
+
+async def _checkout():
+    replica = None
+    if replica_router:
+        if replica_router.check_due():
+            task = asyncio.get_running_loop().create_task(check_replicas())
+            _checks.add(task)
+            task.add_done_callback(_checks.discard)
+        replica = replica_router.choose()
+    conn = None
+    if replica:
+        try:
+            conn = await replica.pool.getconn()
+        except (PoolTimeout, OperationalError) as error:
+            # Read from the primary this time. A replica whose pool is only busy
+            # stays in rotation, one that refused the connection is marked down.
+            if not isinstance(error, PoolTimeout):
+                replica_router.record(replica, error=error)
+        else:
+            conn.home_pool = replica.pool
+    if conn is None:
+        conn = await pool.getconn()
+        conn.home_pool = pool
+    return conn
+
+async def putconn(conn):
+    gate, conn.gate = conn.gate, None
+    try:
+        await conn.home_pool.putconn(conn)
+    finally:
+        if gate is not None:
+            gate.leave()
+
+async def check_replicas():
+    try:
+        for replica in replica_router.replicas:
+            try:
+                async with replica.pool.connection() as conn:
+                    cursor = await conn.execute(replicas.LAG_QUERY)
+                    lag = (await cursor.fetchone())[0]
+            except PoolTimeout:
+                # Busy, not down
+                continue
+            except Exception as error:
+                replica_router.record(replica, error=error)
+            else:
+                replica_router.record(replica, lag)
+    finally:
+        replica_router.checked()
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.client = (scope.get('client') or ('',))[0]
+        self.headers = scope.get('headers', [])
+        self.args = parse_qsl(scope.get('query_string', b'').decode('latin-1'),
+                              keep_blank_values=True)
+        self.body = body
+
+    def arg(self, name, default=None):
+        for key, value in self.args:
+            if key == name:
+                return value
+        return default
+
+    def header(self, name):
+        name = name.encode('latin-1')
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value.decode('latin-1')
+        return None
+
+    def cookie(self, name):
+        cookies = SimpleCookie()
+        try:
+            cookies.load(self.header('cookie') or '')
+        except Exception:
+            return None
+        return cookies[name].value if name in cookies else None
+
+    def int_arg(self, name, default):
+        return handlers.parse_int(self.arg(name), default)
+
+    def fields(self, allowed=QUOTE_FIELDS):
+        return parse_fields(self.arg('fields'), allowed)
+
+    def page(self):
+        return Page(self.path, self.args, self.int_arg('limit', 5))
+
+    def json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+def json_response(status, data):
+    return status, serialize.dumps_bytes(data), 'application/json'
+
+async def respond(handler):
+    conn = None
+    async def connect():
+        nonlocal conn
+        conn = await getconn()
+        return conn
+    try:
+        status, response_data = await run(handler, connect)
+    finally:
+        if conn is not None:
+            await putconn(conn)
+    return json_response(status, response_data)
+
+#--------------------------------------------------------
+# GET routes: conditional request handling and the      |
+# read-through cache, with the same keys, tags, TTLs    |
+# and ETags as the decorators in app.py. `snapshot`     |
+# answers instead of `handler` when serving a snapshot. |
+# Without `cache` only the ETags apply, like a route    |
+# with just @data_versions.conditional.                 |
+#--------------------------------------------------------
+async def cached(route, request, view_args, tags, handler, snapshot=None, cache=True):
+    key = response_cache.make_key(route, view_args, request.args)
+    etag, last_modified = data_versions.validators(key, tags)
+    headers = validator_headers(etag, last_modified, data_versions.policy(route))
+    if is_not_modified(etag, last_modified, request.header('if-none-match'),
+                       request.header('if-modified-since')):
+        data_versions.not_modified += 1
+        return 304, b'', None, not_modified_headers(headers, request.header('if-none-match'))
+
+    if snapshots and snapshot:
+        status, body, content_type = json_response(*snapshot(snapshots.current()))
+    elif not cache or response_cache.ttl(route) <= 0:
+        status, body, content_type = await respond(handler())
+    else:
+        value = response_cache.lookup(route, key)
+        stored = True
+        if value is None:
+            generation = response_cache.generation(tags)
+            with replicas.filling_cache():
+                status, body, content_type = await respond(handler())
+            if status != 200:
+                return status, body, content_type, []
+            value = (body, status, content_type)
+            stored = response_cache.store(route, key, value, tags, generation)
+        (body, status, content_type), encoding = response_cache.encoded(
+            route, key, value, tags, request.header('accept-encoding'), stored)
+        if encoding is not None:
+            headers = headers + [('Content-Encoding', encoding)]
+
+    return status, body, content_type, headers if status == 200 else []
+
+#--------------------------------------------------------
+# Endpoints, see app.py for the documentation           |
+#--------------------------------------------------------
+async def index(request):
+    body = flask_app.jinja_env.get_template('index.html').render()
+    return 200, body.encode('utf-8'), 'text/html; charset=utf-8'
+
+async def get_pool_stats(request):
+    stats = pool.get_stats()
+    if replica_router:
+        stats["replicas"] = replica_router.stats()
+    stats["admission"] = admission_control.stats()
+    if ingest_queue:
+        stats["ingest"] = ingest_queue.stats()
+    return json_response(200, stats)
+
+async def get_cache_stats(request):
+    return json_response(200, cache_stats())
+
+async def get_random_quote(request):
+    limit = request.int_arg('limit', 1)
+    fields = request.fields()
+    if snapshots:
+        response = json_response(*snapshots.current().random_quotes(limit, fields))
+    else:
+        response = await respond(handlers.random_quotes(quote_sampler, limit, quote_fragments,
+                                                        fields))
+    return response + ([('Cache-Control', 'no-store')],)
+
+async def get_quote_by_id(request, quote_id_raw):
+    fields = request.fields()
+    return await cached('quote', request, {'quote_id_raw': quote_id_raw},
+                        [quote_tag(quote_id_raw)],
+                        lambda: handlers.quote_by_id(quote_id_raw, quote_fragments, fields),
+                        lambda snapshot: snapshot.quote_by_id(quote_id_raw, fields))
+
+async def get_quotes_by_ids(request):
+    quote_ids = parse_ids(request.arg('ids'), config['MULTI_GET_MAX_IDS'])
+    fields = request.fields()
+    return await cached('quotes', request, {}, ['quotes'],
+                        lambda: handlers.quotes_by_ids(quote_ids, quote_fragments, fields),
+                        lambda snapshot: snapshot.quotes_by_ids(quote_ids, fields))
+
+async def get_all_authors(request):
+    page = request.page()
+    return await cached('authors', request, {}, ['authors'],
+                        lambda: handlers.authors(page),
+                        lambda snapshot: snapshot.authors_page(page))
+
+async def get_quotes_by_author(request, author_name_raw):
+    page = request.page()
+    return await cached('quotes_by_author', request, {'author_name_raw': author_name_raw},
+                        [author_name_tag(author_name_raw)],
+                        lambda: handlers.quotes_by_author_name(author_name_raw, page, name_catalog),
+                        lambda snapshot: snapshot.quotes_by_author_name(author_name_raw, page))
+
+async def get_quotes_by_authorID(request, author_id_raw):
+    page = request.page()
+    return await cached('quotes_by_author', request, {'author_id_raw': author_id_raw},
+                        [author_tag(author_id_raw)],
+                        lambda: handlers.quotes_by_author_id(author_id_raw, page),
+                        lambda snapshot: snapshot.quotes_by_author_id(author_id_raw, page))
+
+async def get_quotes_by_categoryName(request, category_name_raw):
+    page = request.page()
+    return await cached('quotes_by_category', request, {'category_name_raw': category_name_raw},
+                        [category_name_tag(category_name_raw)],
+                        lambda: handlers.quotes_by_category_name(category_name_raw, page,
+                                                                 name_catalog),
+                        lambda snapshot: snapshot.quotes_by_category_name(category_name_raw,
+                                                                          page))
+
+async def get_quotes_by_categoryID(request, category_id_raw):
+    page = request.page()
+    return await cached('quotes_by_category', request, {'category_id_raw': category_id_raw},
+                        [category_tag(category_id_raw)],
+                        lambda: handlers.quotes_by_category_id(category_id_raw, page),
+                        lambda snapshot: snapshot.quotes_by_category_id(category_id_raw, page))
+
+async def get_all_categories(request):
+    page = request.page()
+    return await cached('categories', request, {}, ['categories'],
+                        lambda: handlers.categories(page),
+                        lambda snapshot: snapshot.categories_page(page))
+
+async def add_new_quote(request):
+    if snapshots:
+        return read_only_error()
+    data = request.json()
+    if isinstance(data, list):
+        return await add_quotes_batch(request)
+    if ingest_queue:
+        # The journal write waits for the disk, keep it off the event loop
+        status, response_data = await asyncio.to_thread(handlers.queue_quote, data, ingest_queue)
+        location = [('Location', '/quotes/tickets/' + response_data['ticket'])] \
+            if status == 202 else []
+        return json_response(status, response_data) + (location,)
+    return await respond(handlers.add_quote(data, quote_sampler, response_cache,
+                                            name_resolvers, quote_duplicates))
+
+async def get_ticket_status(request, ticket):
+    if not ingest_queue:
+        return json_response(404, {"error": "write-behind ingestion is disabled"})
+    return await respond(handlers.ticket_status(ticket, ingest_queue))
+
+async def add_quotes_batch(request):
+    if snapshots:
+        return read_only_error()
+    return await respond(handlers.add_quotes(request.json(), quote_sampler, response_cache,
+                                             name_resolvers, quote_duplicates,
+                                             config['BATCH_MAX_SIZE']))
+
+async def update_quote(request, quote_id_raw):
+    if snapshots:
+        return read_only_error()
+    text = request.arg('quote')
+    author = request.arg('author')
+    category = request.arg('category')
+    return await respond(handlers.update_quote(quote_id_raw, text, author, category,
+                                               response_cache, name_resolvers, quote_duplicates))
+
+async def search_quotes(request):
+    args = (request.arg('q'), request.arg('author'), request.arg('category'), request.page(),
+            request.fields(SEARCH_FIELDS))
+    return await cached('search', request, {}, ['quotes'],
+                        lambda: handlers.search_quotes(*args),
+                        lambda snapshot: snapshot.search_quotes(*args), cache=False)
+
+async def get_stats(request):
+    limit = request.int_arg('limit', 10)
+    return await cached('stats', request, {}, ['quotes'],
+                        lambda: handlers.quote_stats(limit),
+                        lambda snapshot: snapshot.quote_stats(limit))
+
+async def export_quotes(request):
+    author, category = request.arg('author'), request.arg('category')
+    try:
+        fmt, content_type, after_id = export.parse_args(request.arg('format'),
+                                                        request.arg('after_id'))
+    except export.ExportError as e:
+        return json_response(400, {"error": str(e)})
+    fields = request.fields()
+
+    batch_size = config['EXPORT_BATCH_SIZE']
+    if snapshots:
+        rows = snapshots.current().export_rows(author, category, after_id)
+        return 200, iterate(export.stream_rows(rows, fmt, batch_size, fields)), content_type
+    # Checked out before the response starts, so a full pool is still a 503
+    conn = await getconn()
+    return 200, stream_export(conn, fmt, author, category, after_id, batch_size,
+                              fields), content_type
+
+#--------------------------------------------------------
+# Async counterpart of export.stream(), on a psycopg 3  |
+# server-side cursor. Gives the connection back to the  |
+# pool when done.                                       |
+#--------------------------------------------------------
+async def stream_export(conn, fmt, author, category, after_id, batch_size, fields):
+    sql, params = queries.export_quotes(author, category, after_id, fields)
+    try:
+        async with conn.cursor(name='quotes_export') as cursor:
+            cursor.itersize = batch_size
+            await execute(cursor, sql, params)
+            yield export.header(fmt, fields)
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield export.encode_rows(fmt, rows, fields)
+    finally:
+        await conn.rollback()
+        await putconn(conn)
+
+async def iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+async def get_metrics(request):
+    return 200, metrics.registry.render().encode('utf-8'), 'text/plain; version=0.0.4'
+
+async def get_snapshot_stats(request):
+    if not snapshots:
+        return json_response(404, {"error": "not serving a snapshot"})
+    return json_response(200, snapshots.stats())
+
+def read_only_error():
+    return json_response(405, {"error": "this instance serves a read-only snapshot"})
+
+#--------------------------------------------------------
+# Admin endpoints. The bulk import needs psycopg2's     |
+# COPY, so the database work runs in a thread on the    |
+# psycopg2 pool the ingest thread also uses.            |
+#--------------------------------------------------------
+def check_admin_token(request):
+    error = admin_token_error(request.header('authorization') or '')
+    return json_response(*error) if error else None
+
+async def run_sync(work):
+    def run():
+        sync_pool = db.get_pool(flask_app)
+        conn = sync_pool.getconn()
+        try:
+            return work(conn)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            sync_pool.putconn(conn)
+    return await asyncio.to_thread(run)
+
+async def bulk_import(request):
+    error = check_admin_token(request)
+    if error:
+        return error
+    if snapshots:
+        return read_only_error()
+
+    content_type = (request.header('content-type') or '').split(';')[0].strip().lower()
+    fmt = import_format(request.arg('format'), content_type)
+    stream = io.TextIOWrapper(io.BytesIO(request.body), encoding='utf-8', newline='')
+
+    def load(conn):
+        summary = bulk_load.load(conn, stream, fmt)
+        after_import(conn)
+        return summary
+    try:
+        summary = await run_sync(load)
+    except bulk_load.BulkLoadError as e:
+        return json_response(400, {"error": str(e)})
+    return json_response(200, summary)
+
+async def reconcile_counts(request):
+    error = check_admin_token(request)
+    if error:
+        return error
+    if snapshots:
+        return read_only_error()
+
+    repair = request.arg('repair') == '1'
+    summary = await run_sync(lambda conn: counts.reconcile(conn, repair))
+    if summary['repaired']:
+        response_cache.invalidate('quotes', 'authors', 'categories')
+    return json_response(200, summary)
+
+async def reload_snapshot(request):
+    error = check_admin_token(request)
+    if error:
+        return error
+    if not snapshots:
+        return json_response(404, {"error": "not serving a snapshot"})
+
+    try:
+        # Maps and checks the new file, keep it off the event loop
+        await asyncio.to_thread(snapshots.reload)
+    except (OSError, SnapshotError, ValueError) as e:
+        return json_response(500, {"error": str(e)})
+    return json_response(200, snapshots.stats())
+
+#--------------------------------------------------------
+# Routes in the order they are tried, so integer IDs    |
+# win over names like Flask's <int:...> converter does  |
+#--------------------------------------------------------
+INT = r'([0-9]+)'
+NAME = r'([^/]+)'
+
+ROUTES = [
+    ('GET', r'/', index),
+    ('GET', r'/pool/stats', get_pool_stats),
+    ('GET', r'/cache/stats', get_cache_stats),
+    ('GET', r'/metrics', get_metrics),
+    ('GET', r'/snapshot/stats', get_snapshot_stats),
+    ('GET', r'/quotes/random', get_random_quote),
+    ('GET', r'/quotes/search', search_quotes),
+    ('GET', r'/quotes/export', export_quotes),
+    ('GET', r'/quotes/' + INT, get_quote_by_id),
+    ('GET', r'/quotes/tickets/' + NAME, get_ticket_status),
+    ('GET', r'/authors', get_all_authors),
+    ('GET', r'/quotes/author/' + INT, get_quotes_by_authorID),
+    ('GET', r'/quotes/author/' + NAME, get_quotes_by_author),
+    ('GET', r'/quotes/category/' + INT, get_quotes_by_categoryID),
+    ('GET', r'/quotes/category/' + NAME, get_quotes_by_categoryName),
+    ('GET', r'/categories', get_all_categories),
+    ('GET', r'/stats', get_stats),
+    ('GET', r'/quotes', get_quotes_by_ids),
+    ('POST', r'/quotes', add_new_quote),
+    ('POST', r'/quotes/batch', add_quotes_batch),
+    ('PATCH', r'/quotes/' + INT, update_quote),
+    ('POST', r'/admin/import', bulk_import),
+    ('POST', r'/admin/counts/reconcile', reconcile_counts),
+    ('POST', r'/admin/snapshot/reload', reload_snapshot),
+]
+ROUTES = [(method, re.compile(pattern + '$'), view) for method, pattern, view in ROUTES]
+
+def match(method, path):
+    allowed = False
+    for route_method, pattern, view in ROUTES:
+        found = pattern.match(path)
+        if not found:
+            continue
+        if route_method != method:
+            allowed = True
+            continue
+        args = [int(arg) if arg.isascii() and arg.isdigit() else arg for arg in found.groups()]
+        return view, args
+    return None, allowed
+
+CORS_HEADERS = [
+    (b'access-control-allow-origin', b'*'),
+]
+
+CORS_PREFLIGHT_HEADERS = [
+    (b'access-control-allow-methods', b'GET, HEAD, POST, OPTIONS, PATCH'),
+    (b'access-control-allow-headers', b'*'),
+]
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # A snapshot instance never talks to the database
+            if not snapshots:
+                await pool.open()
+                for replica in replica_router.replicas if replica_router else []:
+                    await replica.pool.open()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if not snapshots:
+                await pool.close()
+                for replica in replica_router.replicas if replica_router else []:
+                    await replica.pool.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    started = time.perf_counter()
+    route = 'unmatched'
+    headers = list(CORS_HEADERS)
+    extra_headers = []
+    if method == 'OPTIONS':
+        status, body, content_type = 200, b'', 'text/plain'
+        headers += CORS_PREFLIGHT_HEADERS
+    else:
+        view, args = match('GET' if method == 'HEAD' else method, scope['path'])
+        if view is None:
+            status, body, content_type = json_response(405 if args else 404, {
+                "error": "method not allowed" if args else "not found"
+            })
+        else:
+            route = view.__name__
+            request = Request(scope, await read_body(receive))
+            replicas.allow_replica_reads(method, request.cookie(replicas.STICKY_COOKIE))
+            trace_header = config['TRACE_HEADER']
+            if trace_header:
+                metrics.set_trace_id(metrics.new_trace_id(request.header(trace_header)))
+            admission.classify(method)
+            if ingest_queue:
+                ingest_queue.start()
+            if name_catalog:
+                name_catalog.check()
+            try:
+                if request.path not in admission.EXEMPT_PATHS:
+                    client_header = config['RATE_LIMIT_CLIENT_HEADER']
+                    admission_control.check_rate(admission.client_key(
+                        request.header(client_header) if client_header else None,
+                        request.client))
+                status, body, content_type, *extra = await view(request, *args)
+            except PoolTimeout:
+                status, body, content_type = json_response(
+                    503, {"error": "no database connection available"})
+                extra_headers = [('Retry-After', str(db.UNAVAILABLE_RETRY_AFTER))]
+            except ArgumentError as e:
+                status, body, content_type = json_response(400, {"error": str(e)})
+            except admission.Overloaded as e:
+                status, body, content_type = json_response(e.status, e.response_data())
+                extra_headers = e.headers()
+            else:
+                extra_headers = extra[0] if extra else []
+            if replica_router and method not in replicas.READ_METHODS and status < 400:
+                replica_router.wrote()
+                value, max_age = replicas.sticky_cookie(replica_router.write_window)
+                extra_headers = extra_headers + [('Set-Cookie', (
+                    "%s=%s; Max-Age=%d; Path=/; HttpOnly; SameSite=Lax"
+                    % (replicas.STICKY_COOKIE, value, max_age)))]
+            if isinstance(body, bytes):
+                body, extra_headers = compression.finish(status, body, content_type,
+                                                         extra_headers,
+                                                         request.header('accept-encoding'))
+            if trace_header:
+                extra_headers = extra_headers + [(trace_header, metrics.current_trace_id())]
+
+    headers += [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in extra_headers]
+    if not isinstance(body, bytes):
+        await send_stream(send, status, headers, content_type, body, method == 'HEAD')
+    else:
+        if content_type is not None:
+            headers += [(b'content-type', content_type.encode('latin-1')),
+                        (b'content-length', str(len(body)).encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'' if method == 'HEAD' else body})
+        metrics.RESPONSE_BYTES.observe(len(body), route)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, route, method, str(status))
+
+#--------------------------------------------------------
+# Sends a body given as an async iterator of chunks. No |
+# Content-Length, so the server sends it chunked. The   |
+# first chunk is read before the status is sent, which  |
+# also starts the iterator so aclose() cleans it up.    |
+#--------------------------------------------------------
+async def send_stream(send, status, headers, content_type, chunks, head_only):
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        first = None
+    try:
+        headers = headers + [(b'content-type', content_type.encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if not head_only and first is not None:
+            await send({'type': 'http.response.body', 'body': first, 'more_body': True})
+            async for chunk in chunks:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        await chunks.aclose()
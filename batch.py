@@ -0,0 +1,225 @@
+from queries import Query, Commit
+from dedupe import fingerprint
+
+#--------------------------------------------------------
+# Set-based creation of many quotes at once, used by    |
+# POST /quotes when the body is an array.               |
+#                                                       |
+# Whatever the batch size, the work is four statements: |
+# find existing duplicates (skipped when the            |
+# fingerprint set rules them out), resolve authors,     |
+# resolve categories and one multi-row INSERT, all in a |
+# single transaction.                                   |
+#--------------------------------------------------------
+
+# Creates the missing names and returns (name as given, ID, created) for all of them.
+# A name another transaction commits while this runs isn't in the statement's
+# snapshot, so the names not found are upserted: DO UPDATE waits for that
+# transaction and returns its row (like UPSERT_AUTHOR), where DO NOTHING returns none.
+RESOLVE_NAMES = """
+WITH input AS (
+    SELECT DISTINCT ON (lower(n)) n AS name
+    FROM unnest(%s::text[]) AS n
+    ORDER BY lower(n)
+),
+existing AS (
+    SELECT ID, name FROM {table}
+    WHERE lower(name) IN (SELECT lower(name) FROM input)
+),
+upserted AS (
+    INSERT INTO {table} (name)
+    SELECT name FROM input
+    WHERE lower(name) NOT IN (SELECT lower(name) FROM existing)
+    ORDER BY lower(name)
+    ON CONFLICT ((lower(name))) DO UPDATE SET name = {table}.name
+    RETURNING ID, name, xmax = 0 AS created
+),
+resolved AS (
+    SELECT ID, name, created FROM upserted
+    UNION ALL
+    SELECT ID, name, FALSE FROM existing
+)
+SELECT given.name, resolved.ID, resolved.created
+FROM unnest(%s::text[]) AS given(name)
+JOIN resolved ON lower(resolved.name) = lower(given.name);
+"""
+
+# Returns (position in the array, existing quote ID) for fingerprints already stored
+EXISTING_QUOTES = """
+SELECT input.ord, Quotes.ID
+FROM unnest(%s::bytea[]) WITH ORDINALITY AS input(fingerprint, ord)
+JOIN Quotes ON Quotes.fingerprint = input.fingerprint;
+"""
+
+# Inserts the rows in array order and returns (new ID, fingerprint). Rows
+# another request inserted since the check are skipped.
+INSERT_QUOTES = """
+INSERT INTO Quotes (text, authorID, categoryID, fingerprint)
+SELECT input.text, input.author_id, input.category_id, input.fingerprint
+FROM unnest(%s::text[], %s::integer[], %s::integer[], %s::bytea[])
+     WITH ORDINALITY AS input(text, author_id, category_id, fingerprint, ord)
+ORDER BY input.ord
+ON CONFLICT (fingerprint) DO NOTHING
+RETURNING ID, fingerprint;
+"""
+
+#--------------------------------------------------------
+# Returns the list of missing fields of a quote         |
+#--------------------------------------------------------
+def missing_quote_fields(data):
+    missing_fields = []
+    if not data.get('quote'):
+        missing_fields.append("quote text")
+    if not data.get('author'):
+        missing_fields.append("author name")
+    if not data.get('category'):
+        missing_fields.append("category")
+    return missing_fields
+
+#--------------------------------------------------------
+# Returns the "invalid" result of an item that can't be |
+# added, None for a valid one                           |
+#--------------------------------------------------------
+def invalid_quote(item):
+    if not isinstance(item, dict):
+        return {"status": "invalid", "error": "quote must be an object"}
+    missing_fields = missing_quote_fields(item)
+    if missing_fields:
+        return {"status": "invalid", "missingFields": missing_fields}
+    if not all(isinstance(item[field], str) for field in ('quote', 'author', 'category')):
+        return {"status": "invalid", "error": "fields must be strings"}
+    return None
+
+#--------------------------------------------------------
+# Returns {name: ID} for the names as given and the set |
+# of names that were created                            |
+#--------------------------------------------------------
+def resolve_names(table, names):
+    if not names:
+        return {}, set()
+    names = list(names)
+    rows = yield Query(RESOLVE_NAMES.format(table=table), (names, names))
+    ids = {}
+    created = set()
+    for name, name_id, was_created in rows:
+        ids[name] = name_id
+        if was_created:
+            created.add(name)
+    return ids, created
+
+#--------------------------------------------------------
+# Creates the quotes in `items` (dicts with quote,      |
+# author and category) and commits. Like the handlers   |
+# in handlers.py this yields its queries. `duplicates`  |
+# is the dedupe.Deduper: only texts it may have seen    |
+# are looked up, near duplicates are reported with      |
+# their similarity.                                     |
+#                                                       |
+# Returns one result per item, in order, each with a    |
+# "status" of created, duplicate or invalid, plus the   |
+# rows that were created as (quote ID, author ID,       |
+# author, category ID, category) and the author and     |
+# category names that are new. `before_commit`, when   |
+# given, is a handler step run with the results just    |
+# before the commit, to write more in the same          |
+# transaction.                                          |
+#--------------------------------------------------------
+def create_quotes(items, duplicates, before_commit=None):
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        results[index] = invalid_quote(item)
+        if results[index] is None:
+            valid.append(index)
+
+    created_rows = []
+    new_authors, new_categories = set(), set()
+    if not valid:
+        if before_commit is not None:
+            yield from before_commit(results)
+            yield Commit()
+        return results, created_rows, new_authors, new_categories
+
+    yield from duplicates.load()
+    fingerprints = {i: fingerprint(items[i]['quote']) for i in valid}
+    existing = {}
+    probable = [i for i in valid if duplicates.might_contain(fingerprints[i])]
+    if probable:
+        rows = yield Query(EXISTING_QUOTES, ([fingerprints[i] for i in probable],))
+        existing = {probable[position - 1]: quote_id for position, quote_id in rows}
+
+    # Later copies of a text in the same batch are duplicates of the first one
+    to_insert = []
+    first_seen = {}
+    for index in valid:
+        if index in existing:
+            results[index] = {"status": "duplicate", "quoteID": existing[index]}
+            continue
+        key = fingerprints[index]
+        if key in first_seen:
+            results[index] = {"status": "duplicate", "duplicateOf": first_seen[key]}
+            continue
+        near = duplicates.find_near(items[index]['quote'])
+        if near:
+            results[index] = {"status": "duplicate", "quoteID": near[0], "similarity": near[1]}
+            continue
+        first_seen[key] = index
+        to_insert.append(index)
+
+    if to_insert:
+        author_ids, new_authors = yield from resolve_names(
+            'Authors', {items[i]['author'] for i in to_insert})
+        category_ids, new_categories = yield from resolve_names(
+            'Categories', {items[i]['category'] for i in to_insert})
+
+        # RESOLVE_NAMES returns every name, an item left out here would be a bug
+        for index in to_insert:
+            if (items[index]['author'] not in author_ids or
+                    items[index]['category'] not in category_ids):
+                results[index] = {"status": "invalid",
+                                  "error": "author or category could not be resolved"}
+        to_insert = [i for i in to_insert if results[i] is None]
+
+        rows = [(items[i]['quote'],
+                 author_ids[items[i]['author']],
+                 category_ids[items[i]['category']],
+                 fingerprints[i]) for i in to_insert]
+        quote_ids = {}
+        if rows:
+            columns = [list(column) for column in zip(*rows)]
+            inserted = yield Query(INSERT_QUOTES, tuple(columns))
+            quote_ids = {bytes(fp): quote_id for quote_id, fp in inserted}
+
+        conflicts = []
+        for index, row in zip(to_insert, rows):
+            item = items[index]
+            quote_id = quote_ids.get(row[3])
+            if quote_id is None:
+                conflicts.append(index)
+                continue
+            results[index] = {"status": "created", "quoteID": quote_id}
+            created_rows.append((quote_id, row[1], item['author'], row[2], item['category']))
+
+        if conflicts:
+            rows = yield Query(EXISTING_QUOTES, ([fingerprints[i] for i in conflicts],))
+            for position, quote_id in rows:
+                results[conflicts[position - 1]] = {"status": "duplicate", "quoteID": quote_id}
+
+        # Point in-batch duplicates at the ID their first copy got
+        for index in valid:
+            if results[index] and "duplicateOf" in results[index]:
+                first = results[index].pop("duplicateOf")
+                if "quoteID" in results[first]:
+                    results[index]["quoteID"] = results[first]["quoteID"]
+                else:
+                    results[index] = dict(results[first])
+
+    if before_commit is not None:
+        yield from before_commit(results)
+    yield Commit()
+
+    for index in to_insert:
+        if results[index]["status"] == "created":
+            duplicates.add(results[index]["quoteID"], items[index]['quote'], fingerprints[index])
+
+    return results, created_rows, new_authors, new_categories
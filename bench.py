@@ -0,0 +1,667 @@
+import argparse
+import atexit
+import csv
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urlencode, urlsplit
+
+import psycopg2
+
+import bulk_load
+import migrate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+#--------------------------------------------------------
+# Benchmarks.                                           |
+#                                                       |
+#   seed     fills a database with a synthetic corpus   |
+#            made from quotes.csv                       |
+#   run      drives every route of a running server     |
+#            with a closed-loop and an open-loop load   |
+#            and writes the results as JSON             |
+#   compare  checks results against a baseline and     |
+#            fails on regressions                       |
+#   all      does the above on a throwaway Postgres     |
+#            instance and server it starts itself       |
+#                                                       |
+# Everything random is drawn from --seed, so two runs   |
+# with the same arguments send the same requests.       |
+#--------------------------------------------------------
+
+#--------------------------------------------------------
+# Synthetic corpus.                                     |
+#                                                       |
+# Quote texts are the quotes.csv ones with a counter    |
+# appended (texts must be unique). Authors get quotes   |
+# on a skewed distribution like real data, a few with   |
+# many quotes and a long tail with a handful.           |
+#--------------------------------------------------------
+def base_quotes(path=os.path.join(HERE, 'quotes.csv')):
+    with open(path, encoding='utf-8', newline='') as f:
+        return [row['Text'] for row in csv.DictReader(f) if row.get('Text')]
+
+def corpus_rows(rows, seed=1, quotes_per_author=100, categories=50):
+    rng = random.Random(seed)
+    texts = base_quotes()
+    authors = max(1, rows // quotes_per_author)
+    for i in range(rows):
+        text = "%s (%d)" % (rng.choice(texts), i + 1)
+        author = int(rng.paretovariate(1.2) * 7919) % authors + 1
+        category = int(rng.paretovariate(1.5) * 104729) % categories + 1
+        yield text, "Author %d" % author, "Category %d" % category
+
+def corpus_csv(rows, seed=1):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(['text', 'author', 'category'])
+    yield out.getvalue()
+    for row in corpus_rows(rows, seed):
+        out.seek(0)
+        out.truncate()
+        writer.writerow(row)
+        yield out.getvalue()
+
+def reset_schema(conn):
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS Quotes, Authors, Categories, schema_migrations CASCADE;")
+    with open(os.path.join(HERE, 'schema.sql'), encoding='utf-8') as f:
+        cursor.execute(f.read())
+    conn.commit()
+    cursor.close()
+
+def seed(dsn, rows, seed_value=1, reset=True, out=sys.stdout):
+    conn = psycopg2.connect(dsn)
+    try:
+        if reset:
+            reset_schema(conn)
+        migrate.migrate_up(conn, out=out)
+
+        def progress(read, seconds):
+            print("%d rows generated, %.0f rows/s" % (read, read / seconds if seconds else 0),
+                  file=out)
+
+        summary = bulk_load.load(conn, corpus_csv(rows, seed_value), 'csv', progress)
+        cursor = conn.cursor()
+        conn.autocommit = True
+        cursor.execute("VACUUM ANALYZE;")
+        cursor.close()
+    finally:
+        conn.close()
+    print("seeded: %s" % json.dumps(summary), file=out)
+    return summary
+
+#--------------------------------------------------------
+# Throwaway Postgres instance in a temporary directory, |
+# when initdb and pg_ctl are on the PATH (or in         |
+# --pg-bin). pg_stat_statements is preloaded so DB      |
+# round trips can be counted.                           |
+#--------------------------------------------------------
+class DisposablePostgres:
+    def __init__(self, bin_dir=None):
+        self.bin_dir = bin_dir
+        self.directory = tempfile.mkdtemp(prefix='quotes-bench-pg-')
+        self.port = free_port()
+        self.dsn = "host=127.0.0.1 port=%d dbname=postgres user=bench" % self.port
+
+    def _tool(self, name):
+        path = os.path.join(self.bin_dir, name) if self.bin_dir else shutil.which(name)
+        if not path or not os.path.exists(path):
+            raise RuntimeError("%s not found, pass --pg-bin or --dsn" % name)
+        return path
+
+    def start(self):
+        data = os.path.join(self.directory, 'data')
+        subprocess.run([self._tool('initdb'), '-D', data, '-U', 'bench', '-A', 'trust',
+                        '--no-sync'], check=True, stdout=subprocess.DEVNULL)
+        options = ("-c port=%d -c listen_addresses=127.0.0.1 -c unix_socket_directories=%s "
+                   "-c shared_preload_libraries=pg_stat_statements -c fsync=off "
+                   "-c max_connections=200" % (self.port, self.directory))
+        subprocess.run([self._tool('pg_ctl'), '-D', data, '-o', options, '-w',
+                        '-l', os.path.join(self.directory, 'postgres.log'), 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        data = os.path.join(self.directory, 'data')
+        if os.path.exists(data):
+            subprocess.run([self._tool('pg_ctl'), '-D', data, '-m', 'immediate', 'stop'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+#--------------------------------------------------------
+# Starts the API in a subprocess, `server` is wsgi      |
+# (Flask's threaded server) or asgi (uvicorn)           |
+#--------------------------------------------------------
+def start_server(server, dsn, port, env=None):
+    env = dict(os.environ, CONNECTION_STRING=dsn, **(env or {}))
+    if server == 'asgi':
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', str(port),
+                   '--log-level', 'warning']
+    else:
+        command = [sys.executable, '-c',
+                   "import logging; logging.getLogger('werkzeug').setLevel(logging.WARNING); "
+                   "from app import app; app.run(port=%d, threaded=True)" % port]
+    process = subprocess.Popen(command, cwd=HERE, env=env)
+    atexit.register(process.terminate)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise RuntimeError("the %s server exited with %s" % (server, process.returncode))
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("the %s server did not start" % server)
+
+#--------------------------------------------------------
+# Values the routes are called with, taken from the     |
+# database so every request finds something            |
+#--------------------------------------------------------
+class Samples:
+    def __init__(self, quote_ids, authors, categories, words):
+        self.quote_ids = quote_ids
+        self.authors = authors          # [(ID, name)]
+        self.categories = categories    # [(ID, name)]
+        self.words = words
+
+    @classmethod
+    def from_db(cls, conn, size=1000, seed_value=1):
+        cursor = conn.cursor()
+        cursor.execute("SELECT setseed(%s);", (1 / (1 + abs(seed_value)),))
+        cursor.execute("SELECT ID, text FROM Quotes ORDER BY random() LIMIT %s;", (size,))
+        quotes = cursor.fetchall()
+        cursor.execute("SELECT ID, name FROM Authors ORDER BY random() LIMIT %s;", (size,))
+        authors = cursor.fetchall()
+        cursor.execute("SELECT ID, name FROM Categories ORDER BY random() LIMIT %s;", (size,))
+        categories = cursor.fetchall()
+        conn.rollback()
+        cursor.close()
+        words = sorted({word for _, text in quotes for word in re.findall(r'[a-z]{5,}', text.lower())})
+        return cls([quote_id for quote_id, _ in quotes], authors, categories, words or ['love'])
+
+#--------------------------------------------------------
+# Routes of app.py, each a function returning (method,  |
+# path, body) for one request. The writes change the    |
+# data and only run with --writes.                      |
+#--------------------------------------------------------
+def _path(path, **args):
+    return path + ('?' + urlencode(args) if args else '')
+
+def _json_body(value):
+    return json.dumps(value).encode('utf-8')
+
+ROUTES = {
+    'get_random_quote': lambda s, rng: ('GET', _path('/quotes/random', limit=5), None),
+    'get_quote_by_id': lambda s, rng: ('GET', '/quotes/%d' % rng.choice(s.quote_ids), None),
+    'get_quotes_by_ids': lambda s, rng: (
+        'GET', _path('/quotes', ids=",".join(
+            str(quote_id) for quote_id in rng.sample(s.quote_ids, min(20, len(s.quote_ids))))), None),
+    'get_all_authors': lambda s, rng: ('GET', _path('/authors', limit=20), None),
+    'get_quotes_by_author': lambda s, rng: (
+        'GET', _path('/quotes/author/' + quote(rng.choice(s.authors)[1]), limit=10), None),
+    'get_quotes_by_authorID': lambda s, rng: (
+        'GET', _path('/quotes/author/%d' % rng.choice(s.authors)[0], limit=10), None),
+    'get_quotes_by_categoryName': lambda s, rng: (
+        'GET', _path('/quotes/category/' + quote(rng.choice(s.categories)[1]), limit=10), None),
+    'get_quotes_by_categoryID': lambda s, rng: (
+        'GET', _path('/quotes/category/%d' % rng.choice(s.categories)[0], limit=10), None),
+    'get_all_categories': lambda s, rng: ('GET', _path('/categories', limit=20), None),
+    'get_stats': lambda s, rng: ('GET', _path('/stats', limit=10), None),
+    'search_quotes': lambda s, rng: ('GET', _path('/quotes/search', q=rng.choice(s.words),
+                                                  limit=10), None),
+    'export_quotes': lambda s, rng: ('GET', _path('/quotes/export', format='ndjson',
+                                                  author=rng.choice(s.authors)[1]), None),
+}
+
+WRITE_ROUTES = {
+    'add_new_quote': lambda s, rng: ('POST', '/quotes', _json_body({
+        'quote': "Benchmark quote %016x" % rng.getrandbits(64),
+        'author': rng.choice(s.authors)[1],
+        'category': rng.choice(s.categories)[1]})),
+    'update_quote': lambda s, rng: ('PATCH', _path('/quotes/%d' % rng.choice(s.quote_ids),
+                                                   category=rng.choice(s.categories)[1]), None),
+}
+
+#--------------------------------------------------------
+# HTTP client kept per load generator thread, reusing   |
+# its connection (keep-alive) like a real client would  |
+#--------------------------------------------------------
+class Client:
+    def __init__(self, url, timeout=30):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                headers = {'Content-Type': 'application/json'} if body is not None else {}
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                response.read()
+                return response.status
+            except (http.client.HTTPException, OSError):
+                self.conn.close()
+                self.conn = None
+                # A kept-alive connection the server closed, retry once on a new one
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, latency, status):
+        with self.lock:
+            self.latencies.append(latency)
+            if status is None:
+                self.errors += 1
+            else:
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+
+def _send(client, request, recorder, started):
+    try:
+        status = client.request(*request)
+    except (http.client.HTTPException, OSError):
+        status = None
+    recorder.add(time.perf_counter() - started, status)
+
+#--------------------------------------------------------
+# Closed loop: `concurrency` clients each send their    |
+# next request as soon as the last one is answered.     |
+# Measures the throughput the server can sustain.       |
+#--------------------------------------------------------
+def closed_loop(url, make_request, concurrency, duration, seed_value):
+    recorder = Recorder()
+    stop_at = time.perf_counter() + duration
+
+    def worker(n):
+        rng = random.Random("%s-%d" % (seed_value, n))
+        client = Client(url)
+        while time.perf_counter() < stop_at:
+            _send(client, make_request(rng), recorder, time.perf_counter())
+        client.close()
+
+    return _run_threads(worker, concurrency, recorder)
+
+#--------------------------------------------------------
+# Open loop: requests are due at a fixed `rate`, spaced |
+# by exponential gaps (a Poisson process), whether or   |
+# not earlier ones were answered. Latency counts from   |
+# when a request was due, so time spent queued behind a |
+# slow server is included (no coordinated omission).   |
+#--------------------------------------------------------
+def open_loop(url, make_request, rate, duration, max_in_flight, seed_value):
+    recorder = Recorder()
+    schedule_rng = random.Random("%s-schedule" % seed_value)
+    due = []
+    at = 0.0
+    while True:
+        at += schedule_rng.expovariate(rate)
+        if at >= duration:
+            break
+        due.append(at)
+    start = time.perf_counter() + 0.1
+    next_index = [0]
+    lock = threading.Lock()
+
+    def worker(n):
+        rng = random.Random("%s-%d" % (seed_value, n))
+        client = Client(url)
+        while True:
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= len(due):
+                break
+            due_at = start + due[i]
+            delay = due_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            _send(client, make_request(rng), recorder, due_at)
+        client.close()
+
+    return _run_threads(worker, max_in_flight, recorder)
+
+def _run_threads(worker, count, recorder):
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,), daemon=True) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder, time.perf_counter() - started
+
+#--------------------------------------------------------
+# Nearest-rank percentile of sorted values              |
+#--------------------------------------------------------
+def percentile(values, p):
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+def summarize(recorder, elapsed):
+    latencies = sorted(recorder.latencies)
+    requests = len(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    failed = recorder.errors + sum(count for status, count in recorder.statuses.items()
+                                   if status >= 500)
+    return {
+        'requests': requests,
+        'errors': failed,
+        'statuses': {str(status): count for status, count in sorted(recorder.statuses.items())},
+        'throughput': round(requests / elapsed, 2) if elapsed > 0 else 0,
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'mean': ms(sum(latencies) / requests) if requests else None,
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+#--------------------------------------------------------
+# Database work per request, from pg_stat_statements    |
+# (statements, when the extension is available) and    |
+# pg_stat_database (transactions). Both are sampled by  |
+# one statement of our own, which is subtracted.        |
+#--------------------------------------------------------
+class DBCounters:
+    QUERY = """
+    SELECT {statements},
+           (SELECT xact_commit + xact_rollback FROM pg_stat_database
+            WHERE datname = current_database());
+    """
+
+    def __init__(self, dsn):
+        self.conn = psycopg2.connect(dsn)
+        self.conn.autocommit = True
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements;")
+            cursor.execute("SELECT 1 FROM pg_stat_statements LIMIT 1;")
+            statements = ("(SELECT sum(calls) FROM pg_stat_statements "
+                          "WHERE dbid = (SELECT oid FROM pg_database "
+                          "WHERE datname = current_database()))")
+        except psycopg2.Error:
+            statements = "NULL"
+        cursor.close()
+        self.query = self.QUERY.format(statements=statements)
+
+    def read(self):
+        # Backends report transaction counts about once a second
+        time.sleep(1.1)
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT pg_stat_clear_snapshot();")
+        cursor.execute(self.query)
+        statements, transactions = cursor.fetchone()
+        cursor.close()
+        return statements, transactions
+
+    def per_request(self, before, after, requests):
+        if not requests:
+            return {'statements': None, 'transactions': None}
+        # Our own SELECTs in between: the clear_snapshot and the sampling query
+        statements = None
+        if before[0] is not None and after[0] is not None:
+            statements = round((after[0] - before[0] - 2) / requests, 3)
+        transactions = round((after[1] - before[1] - 2) / requests, 3)
+        return {'statements': statements, 'transactions': transactions}
+
+    def close(self):
+        self.conn.close()
+
+#--------------------------------------------------------
+# Runs every selected route in both load modes          |
+#--------------------------------------------------------
+def run(url, samples, routes, duration=10.0, concurrency=8, rate=100.0, max_in_flight=64,
+        warmup=2.0, seed_value=1, counters=None, out=sys.stdout):
+    results = {}
+    for name, route in routes.items():
+        make_request = lambda rng, route=route: route(samples, rng)
+        if warmup > 0:
+            closed_loop(url, make_request, concurrency, warmup, "%s-warmup" % seed_value)
+
+        results[name] = {}
+        for mode in ('closed', 'open'):
+            before = counters.read() if counters else None
+            if mode == 'closed':
+                recorder, elapsed = closed_loop(url, make_request, concurrency, duration,
+                                                seed_value)
+            else:
+                recorder, elapsed = open_loop(url, make_request, rate, duration, max_in_flight,
+                                              seed_value)
+            summary = summarize(recorder, elapsed)
+            if counters:
+                summary['db_per_request'] = counters.per_request(before, counters.read(),
+                                                                 summary['requests'])
+            results[name][mode] = summary
+            latency = summary['latency_ms']
+            print("%-28s %-6s %8.1f req/s  p50 %8s  p95 %8s  p99 %8s ms  errors %d" % (
+                name, mode, summary['throughput'], latency['p50'], latency['p95'],
+                latency['p99'], summary['errors']), file=out)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#--------------------------------------------------------
+# Regression check. For every route and mode in both    |
+# files, a latency percentile more than `threshold`     |
+# (a fraction) above the baseline, or a closed-loop     |
+# throughput more than `threshold` below it, fails.     |
+#--------------------------------------------------------
+METRICS = ('throughput', 'p50', 'p95', 'p99')
+
+def compare(baseline, current, threshold=0.1, metrics=('throughput', 'p95', 'p99')):
+    regressions = []
+    rows = []
+    for route, modes in sorted(current['results'].items()):
+        for mode, result in sorted(modes.items()):
+            base = baseline['results'].get(route, {}).get(mode)
+            if base is None:
+                continue
+            for metric in metrics:
+                # The open loop sends at a fixed rate, its throughput says nothing
+                if metric == 'throughput' and mode == 'open':
+                    continue
+                if metric == 'throughput':
+                    old, new = base['throughput'], result['throughput']
+                    worse = old and new < old * (1 - threshold)
+                else:
+                    old, new = base['latency_ms'][metric], result['latency_ms'][metric]
+                    worse = old is not None and new is not None and new > old * (1 + threshold)
+                change = (new - old) / old if old else None
+                rows.append((route, mode, metric, old, new, change, bool(worse)))
+                if worse:
+                    regressions.append((route, mode, metric, old, new))
+    return regressions, rows
+
+def print_comparison(rows, out=sys.stdout):
+    for route, mode, metric, old, new, change, worse in rows:
+        print("%-28s %-6s %-10s %10s -> %-10s %8s %s" % (
+            route, mode, metric, old, new,
+            "%+.1f%%" % (change * 100) if change is not None else "",
+            "REGRESSION" if worse else ""), file=out)
+
+def load_results(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def _run_command(args, url, dsn):
+    if not dsn:
+        raise SystemExit("--dsn (or CONNECTION_STRING) is needed to pick request values")
+    conn = psycopg2.connect(dsn)
+    try:
+        samples = Samples.from_db(conn, seed_value=args.seed)
+    finally:
+        conn.close()
+
+    routes = dict(ROUTES)
+    if args.writes:
+        routes.update(WRITE_ROUTES)
+    if args.routes:
+        unknown = set(args.routes) - set(routes)
+        if unknown:
+            raise SystemExit("unknown routes: %s" % ", ".join(sorted(unknown)))
+        routes = {name: routes[name] for name in args.routes}
+
+    counters = DBCounters(dsn) if not args.no_db_counters else None
+    try:
+        results = run(url, samples, routes, args.duration, args.concurrency, args.rate,
+                      args.max_in_flight, args.warmup, args.seed, counters)
+    finally:
+        if counters:
+            counters.close()
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'url': url,
+            'server': getattr(args, 'server', None),
+            'rows': getattr(args, 'rows', None),
+            'duration': args.duration,
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print("results written to %s" % args.out)
+
+    if args.baseline:
+        regressions, rows = compare(load_results(args.baseline), report, args.threshold,
+                                    args.metrics)
+        print_comparison(rows)
+        if regressions:
+            print("%d regression(s) over %.0f%%" % (len(regressions), args.threshold * 100))
+            return 1
+    return 0
+
+def _add_run_arguments(parser):
+    parser.add_argument('--duration', type=float, default=10, help="seconds per route and mode")
+    parser.add_argument('--warmup', type=float, default=2, help="seconds of warmup per route")
+    parser.add_argument('--concurrency', type=int, default=8, help="closed-loop clients")
+    parser.add_argument('--rate', type=float, default=100,
+                        help="open-loop requests per second")
+    parser.add_argument('--max-in-flight', type=int, default=64,
+                        help="open-loop clients, the most requests outstanding at once")
+    parser.add_argument('--routes', nargs='+', help="only these routes (view function names)")
+    parser.add_argument('--writes', action='store_true',
+                        help="also run POST /quotes and PATCH /quotes/<id> (changes the data)")
+    parser.add_argument('--seed', type=int, default=1, help="seed of everything random")
+    parser.add_argument('--no-db-counters', action='store_true',
+                        help="don't count statements and transactions per request")
+    parser.add_argument('--out', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="allowed regression as a fraction (default 0.1, 10%%)")
+    parser.add_argument('--metrics', nargs='+', choices=METRICS,
+                        default=['throughput', 'p95', 'p99'], help="metrics checked against the baseline")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quotes API benchmarks")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = commands.add_parser('seed', help="fill a database with a synthetic corpus")
+    seed_parser.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                             help="connection string (default: $CONNECTION_STRING)")
+    seed_parser.add_argument('--rows', type=int, default=10000, help="number of quotes")
+    seed_parser.add_argument('--seed', type=int, default=1, help="seed of the corpus")
+    seed_parser.add_argument('--keep', action='store_true',
+                             help="add to the existing tables instead of recreating them")
+
+    run_parser = commands.add_parser('run', help="benchmark a running server")
+    run_parser.add_argument('--url', default='http://127.0.0.1:5000', help="server to benchmark")
+    run_parser.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                            help="database of the server (default: $CONNECTION_STRING)")
+    _add_run_arguments(run_parser)
+
+    all_parser = commands.add_parser('all', help="seed a throwaway Postgres, start the server "
+                                                 "and benchmark it")
+    all_parser.add_argument('--rows', type=int, default=10000, help="number of quotes")
+    all_parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    all_parser.add_argument('--dsn', help="use this database instead of a throwaway one")
+    all_parser.add_argument('--pg-bin', help="directory of initdb and pg_ctl")
+    _add_run_arguments(all_parser)
+
+    compare_parser = commands.add_parser('compare', help="compare results with a baseline")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    compare_parser.add_argument('--metrics', nargs='+', choices=METRICS,
+                                default=['throughput', 'p95', 'p99'])
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'seed':
+        if not args.dsn:
+            parser.error("no connection string, set CONNECTION_STRING or pass --dsn")
+        seed(args.dsn, args.rows, args.seed, reset=not args.keep)
+        return 0
+
+    if args.command == 'run':
+        return _run_command(args, args.url, args.dsn)
+
+    if args.command == 'all':
+        dsn = args.dsn
+        if not dsn:
+            dsn = DisposablePostgres(args.pg_bin).start().dsn
+        seed(dsn, args.rows, args.seed)
+        port = free_port()
+        start_server(args.server, dsn, port)
+        return _run_command(args, "http://127.0.0.1:%d" % port, dsn)
+
+    regressions, rows = compare(load_results(args.baseline), load_results(args.current),
+                                args.threshold, args.metrics)
+    print_comparison(rows)
+    if regressions:
+        print("%d regression(s) over %.0f%%" % (len(regressions), args.threshold * 100))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+
+import psycopg2
+
+from dedupe import fingerprint
+
+#--------------------------------------------------------
+# Bulk import of quotes through COPY.                   |
+#                                                       |
+# Rows are streamed from CSV or NDJSON into a temporary |
+# staging table, then authors and categories are        |
+# resolved, duplicates dropped and the quotes merged    |
+# into Quotes with a handful of set-based statements,   |
+# all in one transaction.                               |
+#                                                       |
+# A row needs the quote text plus either author and     |
+# category names (author, category) or IDs (authorID,   |
+# categoryID), so both an export like quotes.csv and a  |
+# list of new quotes can be loaded. Column names are    |
+# case-insensitive, "quote" is accepted for "text" and  |
+# other columns (like ID) are ignored.                  |
+#--------------------------------------------------------
+STAGING_TABLE = """
+CREATE TEMP TABLE quotes_staging (
+  line BIGINT NOT NULL,
+  text TEXT,
+  author TEXT,
+  category TEXT,
+  author_id INTEGER,
+  category_id INTEGER,
+  fingerprint BYTEA
+) ON COMMIT DROP;
+"""
+
+COPY_STAGING = """
+COPY quotes_staging (line, text, author, category, author_id, category_id, fingerprint)
+FROM STDIN WITH (FORMAT csv);
+"""
+
+MERGE_STATEMENTS = [
+    ('new_authors', """
+    INSERT INTO Authors (name)
+    SELECT DISTINCT ON (lower(author)) author
+    FROM quotes_staging
+    WHERE author_id IS NULL AND author IS NOT NULL
+    ORDER BY lower(author), line
+    ON CONFLICT ((lower(name))) DO NOTHING;
+    """),
+    (None, """
+    UPDATE quotes_staging SET author_id = Authors.id
+    FROM Authors
+    WHERE quotes_staging.author_id IS NULL AND lower(Authors.name) = lower(quotes_staging.author);
+    """),
+    ('new_categories', """
+    INSERT INTO Categories (name)
+    SELECT DISTINCT ON (lower(category)) category
+    FROM quotes_staging
+    WHERE category_id IS NULL AND category IS NOT NULL
+    ORDER BY lower(category), line
+    ON CONFLICT ((lower(name))) DO NOTHING;
+    """),
+    (None, """
+    UPDATE quotes_staging SET category_id = Categories.id
+    FROM Categories
+    WHERE quotes_staging.category_id IS NULL AND lower(Categories.name) = lower(quotes_staging.category);
+    """),
+    # Rows pointing at authors/categories that don't exist
+    ('invalid', """
+    DELETE FROM quotes_staging
+    WHERE NOT EXISTS (SELECT 1 FROM Authors WHERE Authors.id = quotes_staging.author_id)
+       OR NOT EXISTS (SELECT 1 FROM Categories WHERE Categories.id = quotes_staging.category_id);
+    """),
+    # Duplicates by fingerprint (see dedupe.py), within the file or of stored quotes
+    ('inserted', """
+    INSERT INTO Quotes (text, authorID, categoryID, fingerprint)
+    SELECT DISTINCT ON (fingerprint) text, author_id, category_id, fingerprint
+    FROM quotes_staging
+    ORDER BY fingerprint, line
+    ON CONFLICT (fingerprint) DO NOTHING;
+    """),
+]
+
+class BulkLoadError(Exception):
+    pass
+
+#--------------------------------------------------------
+# Row readers, both yield dicts with lowercased keys    |
+#--------------------------------------------------------
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield {(key or '').strip().lower(): value for key, value in row.items()}
+
+def read_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("expected a JSON object, got %s" % type(row).__name__)
+            yield {key.lower(): value for key, value in row.items()}
+
+READERS = {'csv': read_csv, 'ndjson': read_ndjson}
+
+def _clean(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+# authorID and categoryID are INTEGER columns
+MAX_ID = 2 ** 31 - 1
+
+def _to_id(value):
+    value = _clean(value)
+    if value is None:
+        return None
+    value = int(value)
+    if not 0 < value <= MAX_ID:
+        raise ValueError("ID %d out of range" % value)
+    return value
+
+#--------------------------------------------------------
+# Turns a row into the staging columns, or None if the  |
+# row can't possibly be loaded                          |
+#--------------------------------------------------------
+def staging_row(line, row):
+    text = _clean(row.get('text', row.get('quote')))
+    author = _clean(row.get('author'))
+    category = _clean(row.get('category'))
+    try:
+        author_id = _to_id(row.get('authorid'))
+        category_id = _to_id(row.get('categoryid'))
+    except ValueError:
+        return None
+
+    if not text or (author is None and author_id is None) or \
+            (category is None and category_id is None):
+        return None
+    return (line, text, author, category, author_id, category_id,
+            '\\x' + fingerprint(text).hex())
+
+#--------------------------------------------------------
+# File-like object fed to copy_expert. It encodes rows  |
+# as CSV on demand so the input is never fully held in  |
+# memory, and counts rows for progress reporting.       |
+#--------------------------------------------------------
+class CopyStream:
+    def __init__(self, rows, progress=None, progress_every=100000):
+        self._rows = rows
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._pending = b''
+        self._done = False
+        self.progress = progress
+        self.progress_every = progress_every
+        self.read_rows = 0
+        self.staged = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+
+    def _fill(self, size):
+        for line, row in self._rows:
+            self.read_rows += 1
+            values = staging_row(line, row)
+            if values is None:
+                self.skipped += 1
+            else:
+                self._writer.writerow(values)
+                self.staged += 1
+            if self.progress and self.read_rows % self.progress_every == 0:
+                self.progress(self.read_rows, time.monotonic() - self.started)
+            if self._buffer.tell() >= size:
+                break
+        else:
+            self._done = True
+
+        data = self._buffer.getvalue().encode('utf-8')
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        return data
+
+    def read(self, size=65536):
+        while len(self._pending) < size and not self._done:
+            self._pending += self._fill(size)
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+#--------------------------------------------------------
+# Loads `stream` (text) into the database on `conn` and |
+# returns a summary. Commits on success, rolls back and |
+# re-raises on error, input the database rejects as a   |
+# BulkLoadError.                                        |
+#--------------------------------------------------------
+def load(conn, stream, fmt='csv', progress=None, progress_every=100000):
+    if fmt not in READERS:
+        raise BulkLoadError("unsupported format %r, use one of %s" % (fmt, ", ".join(READERS)))
+
+    started = time.monotonic()
+    rows = enumerate(READERS[fmt](stream), start=1)
+    copy_stream = CopyStream(rows, progress, progress_every)
+    summary = {}
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(STAGING_TABLE)
+        cursor.copy_expert(COPY_STAGING, copy_stream)
+        copied = time.monotonic()
+
+        for name, statement in MERGE_STATEMENTS:
+            cursor.execute(statement)
+            if name:
+                summary[name] = cursor.rowcount
+        conn.commit()
+    except (ValueError, csv.Error) as error:
+        conn.rollback()
+        raise BulkLoadError("line %d: %s" % (copy_stream.read_rows + 1, error))
+    except psycopg2.DataError as error:
+        # Values COPY won't take, like NUL characters in the text
+        conn.rollback()
+        raise BulkLoadError("invalid data: %s" % str(error).strip().splitlines()[0])
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    elapsed = time.monotonic() - started
+    summary['rows'] = copy_stream.read_rows
+    summary['duplicates'] = copy_stream.staged - summary['invalid'] - summary['inserted']
+    summary['invalid'] += copy_stream.skipped
+    summary['copy_seconds'] = round(copied - started, 3)
+    summary['seconds'] = round(elapsed, 3)
+    summary['rows_per_second'] = round(copy_stream.read_rows / elapsed) if elapsed > 0 else None
+    return summary
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk load quotes from CSV or NDJSON")
+    parser.add_argument('path', help="input file, - for stdin")
+    parser.add_argument('--format', choices=sorted(READERS),
+                        help="input format (default: from the file extension, else csv)")
+    parser.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                        help="connection string (default: $CONNECTION_STRING)")
+    parser.add_argument('--progress-every', type=int, default=100000,
+                        help="report progress every N rows")
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error("no connection string, set CONNECTION_STRING or pass --dsn")
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'ndjson' if args.path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+    def progress(rows, seconds):
+        rate = rows / seconds if seconds > 0 else 0
+        print("%d rows read, %.0f rows/s" % (rows, rate), file=sys.stderr)
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        if args.path == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+            summary = load(conn, stream, fmt, progress, args.progress_every)
+        else:
+            with open(args.path, encoding='utf-8', newline='') as stream:
+                summary = load(conn, stream, fmt, progress, args.progress_every)
+    except BulkLoadError as error:
+        print("import failed: %s" % error, file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+    print(json.dumps(summary, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+import functools
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+import replicas
+import serialize
+
+# Version of everything, bumped by clear() (bulk imports), see versions.py
+GLOBAL_TAG = '*'
+
+#--------------------------------------------------------
+# Interface every cache backend implements. Values are  |
+# plain (body, status, content_type) tuples, tags are   |
+# strings used to drop groups of entries on writes.     |
+#--------------------------------------------------------
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl, tags=()):
+        raise NotImplementedError
+
+    def invalidate_tags(self, tags):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+#--------------------------------------------------------
+# In-process backend: a bounded LRU with per-entry      |
+# expiry and an index from tag to keys                  |
+#--------------------------------------------------------
+class LocalCache(CacheBackend):
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _remove(self, key):
+        value, expires, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_tags(self, tags):
+        removed = 0
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+                    removed += 1
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+#--------------------------------------------------------
+# Backend for any Redis-compatible server, so workers   |
+# share entries and invalidations. The redis package is |
+# only needed when this backend is used.                |
+#--------------------------------------------------------
+class RedisCache(CacheBackend):
+    def __init__(self, url, prefix='quotes-api:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        body, status, content_type = json.loads(value)
+        return body.encode('latin-1'), status, content_type
+
+    def set(self, key, value, ttl, tags=()):
+        body, status, content_type = value
+        # latin-1 maps every byte to one character, compressed bodies included
+        if isinstance(body, bytes):
+            body = body.decode('latin-1')
+        ttl = max(int(ttl), 1)
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, json.dumps([body, status, content_type]), ex=ttl)
+        for tag in tags:
+            pipe.sadd(self.prefix + 'tag:' + tag, key)
+            pipe.expire(self.prefix + 'tag:' + tag, ttl)
+        pipe.execute()
+
+    def invalidate_tags(self, tags):
+        removed = 0
+        for tag in tags:
+            tag_key = self.prefix + 'tag:' + tag
+            keys = self.client.smembers(tag_key)
+            if keys:
+                removed += self.client.delete(*[self.prefix + k.decode('utf-8') for k in keys])
+            self.client.delete(tag_key)
+        return removed
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(self.prefix + '*'))
+
+#--------------------------------------------------------
+# Read-through cache for GET routes.                    |
+#                                                       |
+# Entries are keyed by route name, the URL arguments    |
+# (lowercased, since names are matched case-            |
+# insensitively) and the sorted query string. Only 200  |
+# responses are stored. tags(**view_args) returns the   |
+# tags an entry belongs to, writes call invalidate()    |
+# with the tags they touched. Both also bump the data   |
+# versions (see versions.py) and drop the pre-encoded   |
+# quotes (see serialize.py) when those are set.         |
+# Compressed variants of an entry are stored next to it |
+# with the same tags.                                   |
+#                                                       |
+# A response read while a write commits may predate it, |
+# so a fill is only stored if the versions of its tags  |
+# didn't move while the route ran.                      |
+#--------------------------------------------------------
+class ResponseCache:
+    def __init__(self, backend, default_ttl=60.0, ttls=None, enabled=True, versions=None,
+                 fragments=None, compression=None):
+        self.backend = backend
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.enabled = enabled
+        self.versions = versions
+        self.fragments = fragments
+        self.compression = compression
+        self.hits = {}
+        self.misses = {}
+        self.stale_fills = 0
+
+    @staticmethod
+    def make_key(route, view_args, args):
+        parts = [route]
+        for name in sorted(view_args):
+            value = view_args[name]
+            if isinstance(value, str):
+                value = value.lower()
+            parts.append("%s=%s" % (name, value))
+        parts.append("?" + "&".join("%s=%s" % item for item in sorted(args)))
+        return "|".join(parts)
+
+    def ttl(self, route):
+        if not self.enabled:
+            return 0
+        return self.ttls.get(route, self.default_ttl)
+
+    #--------------------------------------------------------
+    # Framework independent lookup/store, used by the Flask |
+    # decorator below and by asgi.py                        |
+    #--------------------------------------------------------
+    def lookup(self, route, key):
+        value = self.backend.get(key)
+        if value is not None:
+            self.hits[route] = self.hits.get(route, 0) + 1
+        else:
+            self.misses[route] = self.misses.get(route, 0) + 1
+        return value
+
+    # Read before the route runs and passed to store()
+    def generation(self, tags):
+        return self.versions.generation(tags) if self.versions is not None else None
+
+    #--------------------------------------------------------
+    # Stores `value`, unless `tags` were invalidated since  |
+    # `generation` was read. Returns whether it was stored. |
+    #--------------------------------------------------------
+    def store(self, route, key, value, tags=(), generation=None):
+        if generation is not None and self.generation(tags) != generation:
+            self.stale_fills += 1
+            return False
+        self.backend.set(key, value, self.ttl(route), tags)
+        return True
+
+    #--------------------------------------------------------
+    # Returns the entry `value` to send for a request with  |
+    # `accept_encoding` and its Content-Encoding (None when |
+    # sent as it is). A compressed variant is made once and |
+    # stored under the entry's key plus the encoding,       |
+    # unless the entry itself wasn't stored.                |
+    #--------------------------------------------------------
+    def encoded(self, route, key, value, tags, accept_encoding, stored=True):
+        body, status, content_type = value
+        encoding = None
+        if self.compression is not None:
+            encoding = self.compression.choose(accept_encoding, body, content_type)
+        if encoding is None:
+            return value, None
+
+        if not stored:
+            return (serialize.compress(body, encoding), status, content_type), encoding
+
+        variant_key = key + '|' + encoding
+        variant = self.backend.get(variant_key)
+        if variant is None:
+            variant = (serialize.compress(body, encoding), status, content_type)
+            self.backend.set(variant_key, variant, self.ttl(route), tags)
+        return variant, encoding
+
+    def cached(self, route, tags=None):
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**view_args):
+                if self.ttl(route) <= 0:
+                    return view(**view_args)
+
+                key = self.make_key(route, view_args, request.args.items(multi=True))
+                entry_tags = tags(**view_args) if tags else ()
+                value = self.lookup(route, key)
+                stored = True
+                if value is not None:
+                    response = Response(value[0], value[1], content_type=value[2])
+                else:
+                    generation = self.generation(entry_tags)
+                    with replicas.filling_cache():
+                        response = view(**view_args)
+                    if not isinstance(response, Response) or response.status_code != 200:
+                        return response
+                    value = (response.get_data(), 200, response.content_type)
+                    stored = self.store(route, key, value, entry_tags, generation)
+
+                (body, _, _), encoding = self.encoded(route, key, value, entry_tags,
+                                                      request.headers.get('Accept-Encoding'),
+                                                      stored)
+                if encoding is not None:
+                    response.set_data(body)
+                    response.headers['Content-Encoding'] = encoding
+                return response
+            return wrapper
+        return decorator
+
+    def invalidate(self, *tags):
+        tags = [tag for tag in tags if tag]
+        if self.versions is not None:
+            self.versions.bump(*tags)
+        if self.fragments is not None:
+            self.fragments.invalidate(tags)
+        return self.backend.invalidate_tags(tags)
+
+    def clear(self):
+        if self.versions is not None:
+            self.versions.bump(GLOBAL_TAG)
+        if self.fragments is not None:
+            self.fragments.clear()
+        self.backend.clear()
+
+    def stats(self):
+        routes = sorted(set(self.hits) | set(self.misses))
+        stats = {
+            "entries": len(self.backend),
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "stale fills": self.stale_fills,
+            "routes": {
+                route: {"hits": self.hits.get(route, 0), "misses": self.misses.get(route, 0)}
+                for route in routes
+            },
+        }
+        if isinstance(self.backend, LocalCache):
+            stats["evictions"] = self.backend.evictions
+        if self.fragments is not None:
+            stats["fragments"] = self.fragments.stats()
+        return stats
+
+#--------------------------------------------------------
+# Builds the cache configured for the app               |
+#--------------------------------------------------------
+def create_cache(app):
+    if app.config['CACHE_BACKEND'] == 'redis':
+        backend = RedisCache(app.config['CACHE_REDIS_URL'])
+    else:
+        backend = LocalCache(app.config['CACHE_MAX_ENTRIES'])
+    return ResponseCache(backend,
+                         default_ttl=app.config['CACHE_DEFAULT_TTL'],
+                         ttls=app.config['CACHE_TTLS'],
+                         enabled=app.config['CACHE_ENABLED'])
+
+#--------------------------------------------------------
+# Tag helpers shared by the routes and the writes that  |
+# invalidate them                                       |
+#--------------------------------------------------------
+def quote_tag(quote_id):
+    return "quote:%s" % quote_id
+
+def author_tag(author_id):
+    return "author:%s" % author_id if author_id is not None else None
+
+def author_name_tag(author_name):
+    return "author-name:%s" % author_name.lower() if author_name else None
+
+def category_tag(category_id):
+    return "category:%s" % category_id if category_id is not None else None
+
+def category_name_tag(category_name):
+    return "category-name:%s" % category_name.lower() if category_name else None
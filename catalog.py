@@ -0,0 +1,333 @@
+import argparse
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import sys
+import threading
+import time
+from array import array
+
+from snapshot import SnapshotError, Strings, map_columns, string_column, write_columns
+
+MAGIC = b'QCAT0001'
+FORMAT_VERSION = 1
+TABLES = ('authors', 'categories')
+
+#--------------------------------------------------------
+# Author/category catalog shared by the workers of a    |
+# pre-fork server.                                      |
+#                                                       |
+# The names and IDs of both tables are written to one   |
+# file in the snapshot layout (see snapshot.py), kept   |
+# in shared memory (CATALOG_PATH, /dev/shm by default)  |
+# and mapped read-only: every worker reads the same     |
+# pages, nothing is copied into the workers. Names are  |
+# looked up by bisection over a lower(name) column, IDs |
+# over the sorted ID column.                            |
+#                                                       |
+# The file is never changed in place. New names are     |
+# merged into a new file that replaces it, then a       |
+# counter in <path>.version, mapped by every worker, is |
+# bumped. A worker compares it with the version it has  |
+# open once per request (one memory read) and maps the  |
+# new file when it moved. Writers take an flock on      |
+# <path>.lock, so names published at the same time by   |
+# different workers are all kept.                       |
+#                                                       |
+# Rewriting costs the size of the catalog, so requests  |
+# only queue the names they added. A thread in each     |
+# worker writes what was queued at most once every      |
+# publish_interval seconds, in one new file. Until      |
+# then the worker that added a name resolves it from    |
+# its own map (see names.py).                           |
+#                                                       |
+# Authors and categories are only ever added, so an     |
+# entry is never wrong, at worst missing: a missed name |
+# is looked up in the database as before.               |
+#--------------------------------------------------------
+SELECT_NAMES = "SELECT ID, name FROM %s ORDER BY ID;"
+
+#--------------------------------------------------------
+# Writes a catalog of {table: [(ID, name)]} to `path`.  |
+#--------------------------------------------------------
+def write_catalog(path, tables, version):
+    sections = []
+    counts = {}
+    for table in TABLES:
+        rows = sorted(tables.get(table, ()))
+        ids = array('i', (name_id for name_id, _ in rows))
+        name_offsets, names = string_column(name for _, name in rows)
+        # Lowercased names in sort order, the first ID wins like the lower(name) index
+        keyed = {}
+        for position, (_, name) in enumerate(rows):
+            keyed.setdefault(name.lower(), position)
+        keys = sorted(keyed)
+        key_offsets, key_blob = string_column(keys)
+        key_positions = array('i', (keyed[key] for key in keys))
+        sections += [
+            (table + '_ids', ids),
+            (table + '_name_offsets', name_offsets),
+            (table + '_names', names),
+            (table + '_key_offsets', key_offsets),
+            (table + '_keys', key_blob),
+            (table + '_key_positions', key_positions),
+        ]
+        counts[table] = len(rows)
+
+    write_columns(path, MAGIC, dict(version=FORMAT_VERSION, catalog=version,
+                                    created=time.time(), **counts), sections)
+    return counts
+
+class CatalogTable:
+    def __init__(self, columns, table):
+        self.ids = columns[table + '_ids']
+        self.names = Strings(columns[table + '_name_offsets'], columns[table + '_names'])
+        self._keys = Strings(columns[table + '_key_offsets'], columns[table + '_keys'])
+        self._key_positions = columns[table + '_key_positions']
+
+    def __len__(self):
+        return len(self.ids)
+
+    def id_for_name(self, name):
+        key = name.lower()
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return self.ids[self._key_positions[i]]
+        return None
+
+    def name_for_id(self, name_id):
+        i = bisect.bisect_left(self.ids, name_id)
+        if i < len(self.ids) and self.ids[i] == name_id:
+            return self.names[i]
+        return None
+
+    def rows(self):
+        return list(zip(self.ids, self.names))
+
+#--------------------------------------------------------
+# A catalog file opened read-only                       |
+#--------------------------------------------------------
+class Catalog:
+    def __init__(self, path):
+        self.path = path
+        self._map, self.header, columns = map_columns(path, MAGIC, FORMAT_VERSION, 'name catalog')
+        self.version = self.header['catalog']
+        self.tables = {table: CatalogTable(columns, table) for table in TABLES}
+
+    def rows(self):
+        return {table: self.tables[table].rows() for table in TABLES}
+
+class CatalogStore:
+    def __init__(self, path, publish_interval=1.0):
+        self.path = path
+        self.publish_interval = publish_interval
+        self.reloads = 0
+        self.published = 0
+        self.build_seconds = None
+        self.last_error = None
+        self._catalog = None
+        self._loaded_version = None
+        self._lock = threading.Lock()
+        self._pending = {table: {} for table in TABLES}
+        self._cond = threading.Condition()
+        self._pid = None
+
+        fd = os.open(path + '.version', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < 8:
+                os.ftruncate(fd, 8)
+            self._version = mmap.mmap(fd, 8)
+        finally:
+            os.close(fd)
+        self.check()
+
+    def current(self):
+        return self._catalog
+
+    def version(self):
+        return int.from_bytes(self._version[:8], 'little')
+
+    #--------------------------------------------------------
+    # Maps the newest file when another process published   |
+    # one, run before every request                         |
+    #--------------------------------------------------------
+    def check(self):
+        if self.version() != self._loaded_version:
+            self._open()
+
+    #--------------------------------------------------------
+    # A file that can't be read is not retried before the   |
+    # next version, the last one read stays in use          |
+    #--------------------------------------------------------
+    def _open(self):
+        with self._lock:
+            version = self.version()
+            if version == self._loaded_version:
+                return
+            self._loaded_version = version
+            try:
+                self._catalog = Catalog(self.path)
+            except (OSError, SnapshotError, ValueError, KeyError) as error:
+                self.last_error = str(error)
+                return
+            self.reloads += 1
+            self.last_error = None
+
+    def id_for_name(self, table, name):
+        catalog = self._catalog
+        return catalog.tables[table].id_for_name(name) if catalog else None
+
+    def name_for_id(self, table, name_id):
+        catalog = self._catalog
+        return catalog.tables[table].name_for_id(name_id) if catalog else None
+
+    #--------------------------------------------------------
+    # Replaces the catalog with {table: [(ID, name)]}, or   |
+    # with those rows merged into it when merge is set, and |
+    # bumps the version. Returns the number of rows.        |
+    #--------------------------------------------------------
+    def _write(self, tables, merge):
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = self.version() + 1
+            if merge:
+                try:
+                    merged = Catalog(self.path).rows()
+                except (OSError, SnapshotError, ValueError, KeyError):
+                    merged = {table: [] for table in TABLES}
+                for table, rows in tables.items():
+                    known = {name_id for name_id, _ in merged[table]}
+                    merged[table] += [row for row in rows if row[0] not in known]
+                tables = merged
+            counts = write_catalog(self.path, tables, version)
+            self._version[:8] = version.to_bytes(8, 'little')
+        self.check()
+        return counts
+
+    #--------------------------------------------------------
+    # Loads both tables from a psycopg2 connection. Run     |
+    # once in the master before it forks, and again after   |
+    # a bulk import.                                        |
+    #--------------------------------------------------------
+    def build(self, conn):
+        started = time.perf_counter()
+        tables = {}
+        cursor = conn.cursor()
+        try:
+            for table in TABLES:
+                cursor.execute(SELECT_NAMES % table.title())
+                tables[table] = cursor.fetchall()
+            conn.rollback()
+        finally:
+            cursor.close()
+        counts = self._write(tables, merge=False)
+        self.build_seconds = time.perf_counter() - started
+        return counts
+
+    #--------------------------------------------------------
+    # Queues committed names, {table: [(ID, name)]}, that   |
+    # the catalog lacks, for the publisher thread           |
+    #--------------------------------------------------------
+    def publish(self, tables):
+        catalog = self._catalog
+        missing = [(table, name_id, name) for table, rows in tables.items()
+                   for name_id, name in rows
+                   if catalog is None or catalog.tables[table].name_for_id(name_id) is None]
+        if not missing:
+            return
+        with self._cond:
+            for table, name_id, name in missing:
+                self._pending[table][name_id] = name
+            self._cond.notify()
+        self._start()
+
+    # Threads don't survive a fork, each worker starts its own on its first publish
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='catalog', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not any(self._pending.values()):
+                    self._cond.wait()
+            # Names added in the meantime go into the same file
+            time.sleep(self.publish_interval)
+            self.flush()
+
+    #--------------------------------------------------------
+    # Writes the queued names now. Names that can't be      |
+    # written stay queued for the next try.                 |
+    #--------------------------------------------------------
+    def flush(self):
+        with self._cond:
+            tables = {table: list(rows.items()) for table, rows in self._pending.items()}
+            for rows in self._pending.values():
+                rows.clear()
+        if not any(tables.values()):
+            return
+        try:
+            self._write(tables, merge=True)
+        except OSError as error:
+            self.last_error = str(error)
+            with self._cond:
+                for table, rows in tables.items():
+                    for name_id, name in rows:
+                        self._pending[table].setdefault(name_id, name)
+            return
+        self.published += 1
+
+    def stats(self):
+        catalog = self._catalog
+        stats = {"version": self.version(), "reloads": self.reloads,
+                 "published": self.published, "build_seconds": self.build_seconds,
+                 "pending": sum(len(rows) for rows in self._pending.values()),
+                 "last_error": self.last_error}
+        if catalog:
+            stats.update({table: len(catalog.tables[table]) for table in TABLES})
+            stats["bytes"] = len(catalog._map)
+            stats["loaded_version"] = self._loaded_version
+        return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and inspect the name catalog")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    build = commands.add_parser('build', help="catalog the database's authors and categories")
+    build.add_argument('path', nargs='?', default=os.environ.get('CATALOG_PATH', '/dev/shm/quotes-catalog'))
+    build.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                       help="connection string (default: $CONNECTION_STRING)")
+
+    info = commands.add_parser('info', help="print a catalog's header")
+    info.add_argument('path', nargs='?', default=os.environ.get('CATALOG_PATH', '/dev/shm/quotes-catalog'))
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'build':
+            if not args.dsn:
+                parser.error("no connection string, set CONNECTION_STRING or pass --dsn")
+            import psycopg2
+
+            conn = psycopg2.connect(args.dsn)
+            try:
+                store = CatalogStore(args.path)
+                store.build(conn)
+            finally:
+                conn.close()
+            print(json.dumps(store.stats(), indent=2))
+        else:
+            print(json.dumps(Catalog(args.path).header, indent=2))
+    except (OSError, SnapshotError, ValueError) as error:
+        print("error: %s" % error, file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
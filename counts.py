@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import sys
+
+import psycopg2
+
+#--------------------------------------------------------
+# Checks quote_counts (see migrations/0007) against the |
+# tables and repairs it.                                |
+#                                                       |
+# The triggers keep the counters in step with every     |
+# committed write, so drift only comes from changes     |
+# made around them (triggers disabled for a restore,    |
+# rows edited by hand). Both the counters and the       |
+# COUNT(*)s are read from one snapshot, and since later |
+# writes move both the same way, the difference found   |
+# is still right when it is added: repairing needs no   |
+# lock on Quotes and writers are never blocked. The     |
+# totals are spread over several rows (migration 0009), |
+# they are compared summed and repaired in row 0.       |
+#--------------------------------------------------------
+COUNT_DRIFT = """
+WITH stored AS (
+  SELECT scope, CASE WHEN scope IN ('quotes', 'authors', 'categories') THEN 0 ELSE id END AS id,
+         SUM(count)::bigint AS count
+  FROM quote_counts
+  GROUP BY 1, 2
+),
+actual AS (
+  SELECT 'author' AS scope, authorID AS id, COUNT(*) AS count FROM Quotes GROUP BY authorID
+  UNION ALL SELECT 'category', categoryID, COUNT(*) FROM Quotes GROUP BY categoryID
+  UNION ALL SELECT 'quotes', 0, COUNT(*) FROM Quotes
+  UNION ALL SELECT 'authors', 0, COUNT(*) FROM Authors
+  UNION ALL SELECT 'categories', 0, COUNT(*) FROM Categories
+)
+SELECT COALESCE(actual.scope, stored.scope), COALESCE(actual.id, stored.id),
+       COALESCE(stored.count, 0), COALESCE(actual.count, 0)
+FROM actual
+FULL JOIN stored ON stored.scope = actual.scope AND stored.id = actual.id
+WHERE COALESCE(actual.count, 0) <> COALESCE(stored.count, 0)
+ORDER BY 1, 2;
+"""
+
+# Adds the differences in (scope, id) order, the order the triggers lock rows in
+REPAIR_COUNTS = """
+INSERT INTO quote_counts (scope, id, count)
+SELECT scope, id, delta
+FROM unnest(%s::text[], %s::integer[], %s::bigint[]) AS drift(scope, id, delta)
+ORDER BY scope, id
+ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+"""
+
+#--------------------------------------------------------
+# Returns {"drift": [{"scope", "id", "stored",          |
+# "actual"}], "repaired"}. With repair=True the         |
+# counters found off are corrected and committed.       |
+#--------------------------------------------------------
+def reconcile(conn, repair=False):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(COUNT_DRIFT)
+        drift = cursor.fetchall()
+        if repair and drift:
+            cursor.execute(REPAIR_COUNTS, ([scope for scope, _, _, _ in drift],
+                                           [owner_id for _, owner_id, _, _ in drift],
+                                           [actual - stored for _, _, stored, actual in drift]))
+            conn.commit()
+        else:
+            conn.rollback()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    return {
+        "drift": [{"scope": scope, "id": owner_id, "stored": stored, "actual": actual}
+                  for scope, owner_id, stored, actual in drift],
+        "repaired": bool(repair and drift),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check and repair the quote counters")
+    parser.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                        help="connection string (default: $CONNECTION_STRING)")
+    parser.add_argument('--repair', action='store_true', help="correct the counters found off")
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error("no connection string, set CONNECTION_STRING or pass --dsn")
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        summary = reconcile(conn, args.repair)
+    finally:
+        conn.close()
+
+    print(json.dumps(summary, indent=2))
+    # Drift left in place fails the run, so a scheduled check gets noticed
+    return 1 if summary["drift"] and not summary["repaired"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,445 @@
+import threading
+import time
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+from flask import current_app, g, jsonify, request
+
+import admission
+import metrics
+import replicas
+
+#--------------------------------------------------------
+# Raised when no connection could be checked out of the |
+# pool before the checkout timeout expired              |
+#--------------------------------------------------------
+class PoolTimeout(Exception):
+    pass
+
+# Retry-After, in seconds, of the 503 sent when no connection can be had
+UNAVAILABLE_RETRY_AFTER = 1
+
+#--------------------------------------------------------
+# Connection class used by the pool, it remembers when  |
+# it was opened and last handed back so the pool can    |
+# recycle old or idle connections, and which prepared   |
+# statements exist on it (see queries.py)               |
+#--------------------------------------------------------
+class PooledConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.prepared_statements = set()
+
+#--------------------------------------------------------
+# Thread-safe pool of psycopg2 connections.             |
+#                                                       |
+# min_size connections are kept open, at most max_size  |
+# are ever open at once. getconn() waits up to timeout  |
+# seconds for a free connection, checks it with a cheap |
+# query before handing it out and throws away any       |
+# connection that sat idle longer than max_idle or is   |
+# older than max_lifetime.                              |
+#--------------------------------------------------------
+class ConnectionPool:
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=5.0,
+                 max_idle=300.0, max_lifetime=3600.0, health_check=True, connect_timeout=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("invalid pool size: min=%s max=%s" % (min_size, max_size))
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.health_check = health_check
+        self.connect_timeout = connect_timeout
+
+        self._idle = deque()
+        self._in_use = set()
+        self._opening = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._stats = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "health_check_failures": 0,
+            "recycled": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+        }
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+            self._stats["connections_opened"] += 1
+
+    def _connect(self):
+        started = time.perf_counter()
+        kwargs = {'connect_timeout': self.connect_timeout} if self.connect_timeout else {}
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection,
+                                cursor_factory=metrics.InstrumentedCursor, **kwargs)
+        metrics.CONNECT_SECONDS.observe(time.perf_counter() - started)
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self._stats["connections_closed"] += 1
+
+    def _expired(self, conn, now):
+        if conn.closed:
+            return True
+        if self.max_idle and now - conn.last_used > self.max_idle:
+            return True
+        if self.max_lifetime and now - conn.created_at > self.max_lifetime:
+            return True
+        return False
+
+    def _healthy(self, conn):
+        if not self.health_check:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            conn.rollback()
+            return True
+        except Exception:
+            self._stats["health_check_failures"] += 1
+            return False
+
+    #--------------------------------------------------------
+    # Borrows a connection, opening a new one if the pool   |
+    # is below max_size. Raises PoolTimeout if none became  |
+    # available within the timeout.                         |
+    #--------------------------------------------------------
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited = False
+        wait_started = time.monotonic()
+
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout("connection pool is closed")
+                    if self._idle:
+                        conn = self._idle.pop()
+                        self._in_use.add(conn)
+                        break
+                    if len(self._in_use) + self._opening < self.max_size:
+                        self._opening += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["checkout_timeouts"] += 1
+                        raise PoolTimeout(
+                            "no connection available within %.2f seconds" % timeout)
+                    waited = True
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                # Open the new connection outside the lock
+                try:
+                    conn = self._connect()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._in_use.add(conn)
+                            self._stats["connections_opened"] += 1
+                        self._cond.notify()
+            elif self._expired(conn, time.monotonic()) or not self._healthy(conn):
+                with self._cond:
+                    self._in_use.discard(conn)
+                    self._stats["recycled"] += 1
+                    self._discard(conn)
+                    self._cond.notify()
+                continue
+
+            with self._cond:
+                self._stats["checkouts"] += 1
+                if waited:
+                    self._stats["waits"] += 1
+                    self._stats["wait_time_total"] += time.monotonic() - wait_started
+            return conn
+
+    #--------------------------------------------------------
+    # Hands a connection back. Anything left open in the    |
+    # transaction is rolled back first.                     |
+    #--------------------------------------------------------
+    def putconn(self, conn, close=False):
+        if not conn.closed and not close:
+            try:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+            except Exception:
+                close = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if close or conn.closed or self._closed:
+                self._discard(conn)
+            else:
+                conn.last_used = time.monotonic()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    #--------------------------------------------------------
+    # Closes idle connections past max_idle/max_lifetime,   |
+    # never going below min_size                            |
+    #--------------------------------------------------------
+    def recycle_idle(self):
+        now = time.monotonic()
+        with self._cond:
+            keep = deque()
+            total = len(self._idle) + len(self._in_use)
+            # Oldest idle connections sit at the left of the deque
+            while self._idle:
+                conn = self._idle.popleft()
+                if self._expired(conn, now) and total > self.min_size:
+                    self._discard(conn)
+                    self._stats["recycled"] += 1
+                    total -= 1
+                else:
+                    keep.append(conn)
+            self._idle = keep
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "size": len(self._idle) + len(self._in_use),
+            })
+        return stats
+
+#--------------------------------------------------------
+# Flask integration. The pool is created on first use   |
+# from the app config, and each request checks out at   |
+# most one connection which every route and helper of   |
+# that request shares. With REPLICA_CONNECTION_STRINGS  |
+# set, reads may take it from a replica's pool instead  |
+# (see replicas.py). Checkouts pass the admission gate  |
+# of the request's class first (see admission.py).      |
+#--------------------------------------------------------
+_pool = None
+_pool_lock = threading.Lock()
+_router = None
+_admission = None
+
+def init_app(app):
+    app.teardown_appcontext(release_db)
+    metrics.registry.collectors.append(collect_metrics)
+
+    @app.before_request
+    def route_reads():
+        replicas.allow_replica_reads(request.method, request.cookies.get(replicas.STICKY_COOKIE))
+
+    @app.before_request
+    def admit():
+        admission.classify(request.method)
+        if request.path in admission.EXEMPT_PATHS:
+            return
+        header = app.config['RATE_LIMIT_CLIENT_HEADER']
+        get_admission(current_app).check_rate(
+            admission.client_key(request.headers.get(header) if header else None,
+                                 request.remote_addr))
+
+    @app.errorhandler(admission.Overloaded)
+    def overloaded(error):
+        return jsonify(error.response_data()), error.status, error.headers()
+
+    # The pool had no connection in time, or the database can't be reached
+    @app.errorhandler(PoolTimeout)
+    @app.errorhandler(psycopg2.OperationalError)
+    def unavailable(error):
+        return (jsonify({"error": "no database connection available"}), 503,
+                [('Retry-After', str(UNAVAILABLE_RETRY_AFTER))])
+
+    @app.after_request
+    def stick_to_primary(response):
+        router = get_router(current_app)
+        if router and request.method not in replicas.READ_METHODS + ('OPTIONS',) \
+                and response.status_code < 400:
+            router.wrote()
+            value, max_age = replicas.sticky_cookie(router.write_window)
+            response.set_cookie(replicas.STICKY_COOKIE, value, max_age=max_age,
+                                httponly=True, samesite='Lax')
+        return response
+
+def get_pool(app):
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    app.config['CONNECTION_STRING'],
+                    min_size=int(app.config['DB_POOL_MIN_SIZE']),
+                    max_size=int(app.config['DB_POOL_MAX_SIZE']),
+                    timeout=float(app.config['DB_POOL_TIMEOUT']),
+                    max_idle=float(app.config['DB_POOL_MAX_IDLE']),
+                    max_lifetime=float(app.config['DB_POOL_MAX_LIFETIME']),
+                    health_check=app.config['DB_POOL_HEALTH_CHECK'],
+                )
+    return _pool
+
+#--------------------------------------------------------
+# The replica router, None when no replica is set up    |
+#--------------------------------------------------------
+def get_router(app):
+    global _router
+    if _router is None and app.config['REPLICA_CONNECTION_STRINGS']:
+        with _pool_lock:
+            dsns = replicas.parse_dsns(app.config['REPLICA_CONNECTION_STRINGS'])
+            if _router is None and dsns:
+                _router = replicas.ReplicaRouter(
+                    [replicas.Replica("replica%d" % (i + 1), ConnectionPool(
+                        dsn,
+                        min_size=0,
+                        max_size=int(app.config['DB_POOL_MAX_SIZE']),
+                        timeout=float(app.config['REPLICA_CONNECT_TIMEOUT']),
+                        max_idle=float(app.config['DB_POOL_MAX_IDLE']),
+                        max_lifetime=float(app.config['DB_POOL_MAX_LIFETIME']),
+                        health_check=app.config['DB_POOL_HEALTH_CHECK'],
+                        connect_timeout=int(app.config['REPLICA_CONNECT_TIMEOUT']) or None,
+                    )) for i, dsn in enumerate(dsns)],
+                    max_lag=float(app.config['REPLICA_MAX_LAG']),
+                    check_interval=float(app.config['REPLICA_CHECK_INTERVAL']),
+                    write_window=float(app.config['READ_YOUR_WRITES_WINDOW']),
+                )
+    return _router
+
+#--------------------------------------------------------
+# Measures the lag of every replica. A replica that     |
+# can't be reached is marked down until a later check   |
+# succeeds. One whose pool is busy keeps its state.     |
+#--------------------------------------------------------
+def check_replicas(router):
+    try:
+        for replica in router.replicas:
+            conn = None
+            try:
+                conn = replica.pool.getconn()
+                cursor = conn.cursor()
+                cursor.execute(replicas.LAG_QUERY)
+                lag = cursor.fetchone()[0]
+                cursor.close()
+                replica.pool.putconn(conn)
+            except PoolTimeout:
+                continue
+            except Exception as error:
+                if conn is not None:
+                    replica.pool.putconn(conn, close=True)
+                router.record(replica, error=error)
+            else:
+                router.record(replica, lag)
+    finally:
+        router.checked()
+
+#--------------------------------------------------------
+# The pool this request reads from: a replica's if the  |
+# router picks one, else the primary's                  |
+#--------------------------------------------------------
+def _pool_for_request(app):
+    router = get_router(app)
+    if router is None:
+        return get_pool(app), None
+    if router.check_due():
+        check_replicas(router)
+    replica = router.choose()
+    if replica is None:
+        return get_pool(app), None
+    return replica.pool, replica
+
+#--------------------------------------------------------
+# Admission control, created on first use from the app  |
+# config                                                |
+#--------------------------------------------------------
+def get_admission(app):
+    global _admission
+    if _admission is None:
+        with _pool_lock:
+            if _admission is None:
+                _admission = admission.AdmissionControl(
+                    read_limit=int(app.config['ADMISSION_READ_LIMIT']),
+                    write_limit=int(app.config['ADMISSION_WRITE_LIMIT']),
+                    max_queue=int(app.config['ADMISSION_QUEUE_SIZE']),
+                    queue_timeout=float(app.config['ADMISSION_QUEUE_TIMEOUT']),
+                    read_rate=float(app.config['RATE_LIMIT_READS']),
+                    write_rate=float(app.config['RATE_LIMIT_WRITES']),
+                    burst=int(app.config['RATE_LIMIT_BURST']),
+                )
+    return _admission
+
+def get_db():
+    if 'db_conn' not in g:
+        started = time.perf_counter()
+        gate = get_admission(current_app).gate()
+        gate.enter()
+        try:
+            pool, replica = _pool_for_request(current_app)
+            try:
+                conn = pool.getconn()
+            except (PoolTimeout, psycopg2.OperationalError) as error:
+                if replica is None:
+                    raise
+                # Read from the primary this time. A replica whose pool is only busy
+                # stays in rotation, one that refused the connection is marked down.
+                if not isinstance(error, PoolTimeout):
+                    _router.record(replica, error=error)
+                pool = get_pool(current_app)
+                conn = pool.getconn()
+        except BaseException:
+            gate.leave()
+            raise
+        g.db_conn, g.db_pool, g.db_gate = conn, pool, gate
+        metrics.ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+    return g.db_conn
+
+def release_db(exception=None):
+    conn = g.pop('db_conn', None)
+    pool = g.pop('db_pool', _pool)
+    gate = g.pop('db_gate', None)
+    if conn is not None:
+        pool.putconn(conn)
+        pool.recycle_idle()
+    if gate is not None:
+        gate.leave()
+
+#--------------------------------------------------------
+# Pool statistics for /metrics, once the pool exists    |
+#--------------------------------------------------------
+def collect_metrics():
+    if _pool is None:
+        return []
+    stats = _pool.stats()
+    return (_router.metrics() if _router else []) + \
+        (_admission.metrics() if _admission else []) + [
+        ('quotes_api_db_pool_connections', 'gauge', "Connections of the pool by state",
+         [({'state': 'idle'}, stats['idle']), ({'state': 'in_use'}, stats['in_use'])]),
+        ('quotes_api_db_connections_opened_total', 'counter', "Connections opened by the pool",
+         [({}, stats['connections_opened'])]),
+        ('quotes_api_db_checkout_timeouts_total', 'counter', "Checkouts that timed out",
+         [({}, stats['checkout_timeouts'])]),
+    ]
@@ -0,0 +1,250 @@
+import hashlib
+import heapq
+import random
+import re
+import threading
+import unicodedata
+from array import array
+
+import queries
+from queries import Query
+
+#--------------------------------------------------------
+# Duplicate detection for new quotes.                   |
+#                                                       |
+# A quote's fingerprint is a hash of its normalized     |
+# text: Unicode NFKC, curly quotes and dashes made      |
+# straight, case folded, whitespace collapsed and the   |
+# surrounding quote marks and trailing punctuation      |
+# dropped. It is stored in Quotes.fingerprint under a   |
+# unique index (migrations/0006_quote_fingerprints.py), |
+# so inserts are race-free with ON CONFLICT.            |
+#                                                       |
+# Each process also keeps the first 8 bytes of every    |
+# fingerprint in a set. A text whose prefix is not in   |
+# the set is new without asking the database; only      |
+# probable duplicates are looked up. Optionally, a      |
+# MinHash/LSH index finds near duplicates: quotes whose |
+# character shingles overlap by at least the threshold. |
+#--------------------------------------------------------
+_QUOTES = str.maketrans({
+    '‘': "'", '’': "'", '‚': "'", '‛': "'", '′': "'", '`': "'",
+    '´': "'", '“': '"', '”': '"', '„': '"', '‟': '"', '″': '"',
+    '«': '"', '»': '"', '‐': '-', '‑': '-', '‒': '-', '–': '-',
+    '—': '-', '―': '-', '−': '-',
+})
+_SPACES = re.compile(r'\s+')
+_SPACE_BEFORE_PUNCTUATION = re.compile(r' (?=[.,;:!?])')
+_EDGES = re.compile(r'^[\s"\'-]+|[\s"\'.,;:!?-]+$')
+_WORDS = re.compile(r'\w+')
+
+def normalize(text):
+    text = unicodedata.normalize('NFKC', text).translate(_QUOTES).casefold()
+    text = _SPACE_BEFORE_PUNCTUATION.sub('', _SPACES.sub(' ', text))
+    return _EDGES.sub('', text)
+
+def fingerprint(text):
+    return hashlib.blake2b(normalize(text).encode('utf-8'), digest_size=16).digest()
+
+def _prefix(fp):
+    return int.from_bytes(fp[:8], 'big')
+
+#--------------------------------------------------------
+# Near-duplicate index. Each quote gets a MinHash       |
+# signature over the 5-character shingles of its        |
+# normalized words; the signature is cut into bands and |
+# quotes sharing any band are candidates, kept if their |
+# estimated similarity reaches the threshold. Bands and |
+# rows are picked so 95% of the pairs at the threshold  |
+# become candidates.                                    |
+#--------------------------------------------------------
+_MERSENNE = (1 << 61) - 1
+SHINGLE_SIZE = 5
+
+def shingles(text):
+    text = " ".join(_WORDS.findall(normalize(text)))
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def _bands(permutations, threshold):
+    # Most rows per band (fewest candidates) that still catch 95% of the pairs at the threshold
+    best = (permutations, 1)
+    for rows in range(1, permutations + 1):
+        if permutations % rows == 0:
+            bands = permutations // rows
+            if 1 - (1 - threshold ** rows) ** bands >= 0.95:
+                best = (bands, rows)
+    return best
+
+class MinHashIndex:
+    def __init__(self, threshold, permutations=64, seed=1):
+        self.threshold = threshold
+        self.permutations = permutations
+        generator = random.Random(seed)
+        self._coefficients = [(generator.randrange(1, _MERSENNE), generator.randrange(_MERSENNE))
+                              for _ in range(permutations)]
+        self.bands, self.rows = _bands(permutations, threshold)
+        self._buckets = [{} for _ in range(self.bands)]
+        self._signatures = {}
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def signature(self, text):
+        hashes = [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(),
+                                 'big') for shingle in shingles(text)]
+        return array('I', [min((a * h + b) % _MERSENNE for h in hashes) & 0xFFFFFFFF
+                           for a, b in self._coefficients])
+
+    def _keys(self, signature):
+        rows = self.rows
+        return [hash(tuple(signature[band * rows:(band + 1) * rows])) for band in range(self.bands)]
+
+    def add(self, quote_id, text):
+        self.remove(quote_id)
+        signature = self.signature(text)
+        self._signatures[quote_id] = signature
+        for bucket, key in zip(self._buckets, self._keys(signature)):
+            bucket.setdefault(key, []).append(quote_id)
+
+    def remove(self, quote_id):
+        signature = self._signatures.pop(quote_id, None)
+        if signature is None:
+            return
+        for bucket, key in zip(self._buckets, self._keys(signature)):
+            ids = bucket.get(key)
+            if ids and quote_id in ids:
+                ids.remove(quote_id)
+                if not ids:
+                    del bucket[key]
+
+    #--------------------------------------------------------
+    # Returns [(similarity, quote ID)] of the quotes at or  |
+    # above the threshold, most similar first               |
+    #--------------------------------------------------------
+    def query(self, text, limit=5):
+        signature = self.signature(text)
+        candidates = set()
+        for bucket, key in zip(self._buckets, self._keys(signature)):
+            candidates.update(bucket.get(key, ()))
+        matches = []
+        for quote_id in candidates:
+            other = self._signatures.get(quote_id)
+            if other is None:
+                continue
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / self.permutations
+            if similarity >= self.threshold:
+                matches.append((round(similarity, 3), quote_id))
+        return heapq.nlargest(limit, matches)
+
+#--------------------------------------------------------
+# The fingerprint set plus the optional near-duplicate  |
+# index of one process. Like the random quote sampler   |
+# it is loaded on first use and then written through by |
+# the inserts; other workers' inserts are caught by the |
+# unique index and added when seen.                     |
+#--------------------------------------------------------
+class Deduper:
+    PAGE_SIZE = 100000
+
+    def __init__(self, near_threshold=0.0, permutations=64):
+        self.near = MinHashIndex(near_threshold, permutations) if near_threshold > 0 else None
+        self._prefixes = set()
+        self._loaded = False
+        self._loading = False
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.near_duplicates = 0
+
+    #--------------------------------------------------------
+    # Loads the fingerprints (and the texts, for the near-  |
+    # duplicate index) in pages along the primary key. A    |
+    # handler step (see queries.py), run with `yield from`. |
+    # Until it is done every check asks the database.       |
+    #--------------------------------------------------------
+    def load(self):
+        with self._lock:
+            if self._loaded or self._loading:
+                return
+            self._loading = True
+
+        try:
+            if self.near is not None:
+                sql = queries.QUOTE_TEXTS_PAGE
+            else:
+                sql = queries.QUOTE_FINGERPRINTS_PAGE
+            last = 0
+            while True:
+                rows = yield Query(sql, (last, self.PAGE_SIZE))
+                with self._lock:
+                    for row in rows:
+                        if row[1] is not None:
+                            self._prefixes.add(_prefix(bytes(row[1])))
+                        if self.near is not None:
+                            self.near.add(row[0], row[2])
+                if len(rows) < self.PAGE_SIZE:
+                    break
+                last = rows[-1][0]
+            with self._lock:
+                self._loaded = True
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def might_contain(self, fp):
+        with self._lock:
+            return not self._loaded or _prefix(fp) in self._prefixes
+
+    #--------------------------------------------------------
+    # Returns (quote ID, similarity) of an existing quote   |
+    # that `text` duplicates, or None. Similarity is 1.0    |
+    # for an exact duplicate. A handler step.               |
+    #--------------------------------------------------------
+    def find(self, text, exclude=None):
+        yield from self.load()
+        fp = fingerprint(text)
+        if self.might_contain(fp):
+            self.lookups += 1
+            row = yield Query(queries.QUOTE_ID_BY_FINGERPRINT, (fp,), fetch='one')
+            if row and row[0] != exclude:
+                self.duplicates += 1
+                return row[0], 1.0
+        else:
+            self.skipped += 1
+        return self.find_near(text, exclude)
+
+    def find_near(self, text, exclude=None):
+        if self.near is None:
+            return None
+        with self._lock:
+            matches = [match for match in self.near.query(text) if match[1] != exclude]
+        if not matches:
+            return None
+        self.near_duplicates += 1
+        similarity, quote_id = matches[0]
+        return quote_id, similarity
+
+    #--------------------------------------------------------
+    # Records a committed quote                             |
+    #--------------------------------------------------------
+    def add(self, quote_id, text, fp=None):
+        with self._lock:
+            self._prefixes.add(_prefix(fp or fingerprint(text)))
+            if self.near is not None:
+                self.near.add(quote_id, text)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+            self._prefixes = set()
+            if self.near is not None:
+                self.near = MinHashIndex(self.near.threshold, self.near.permutations)
+
+    def stats(self):
+        return {"fingerprints": len(self._prefixes), "loaded": self._loaded,
+                "near duplicate index": len(self.near) if self.near is not None else None,
+                "lookups": self.lookups, "skipped": self.skipped,
+                "duplicates": self.duplicates, "near duplicates": self.near_duplicates}
@@ -0,0 +1,108 @@
+import csv
+import io
+
+import queries
+import serialize
+from fields import QUOTE_FIELDS
+
+#--------------------------------------------------------
+# Streaming export of the quotes (GET /quotes/export).  |
+#                                                       |
+# Rows are read through a server-side cursor in fetches |
+# of `batch_size` and each fetch is encoded into one    |
+# chunk of the response, so memory use doesn't depend   |
+# on the number of quotes. Rows come in ID order: after |
+# an interrupted download, ask again with after_id set  |
+# to the last quoteID received. The CSV columns are     |
+# ones bulk_load.py accepts, so an export can be loaded |
+# into another database as it is, unless fields= left  |
+# some of them out (see fields.py).                     |
+#--------------------------------------------------------
+class ExportError(ValueError):
+    pass
+
+COLUMNS = ['quoteID', 'quote', 'author', 'category']
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+#--------------------------------------------------------
+# Checks the query string arguments and returns         |
+# (format, content type, after_id)                      |
+#--------------------------------------------------------
+def parse_args(fmt, after_id):
+    fmt = (fmt or 'ndjson').lower()
+    if fmt not in FORMATS:
+        raise ExportError("format must be one of: %s" % ", ".join(sorted(FORMATS)))
+    try:
+        after_id = int(after_id) if after_id not in (None, '') else 0
+    except ValueError:
+        raise ExportError("after_id must be an integer")
+    if after_id < 0:
+        raise ExportError("after_id cannot be negative")
+    return fmt, FORMATS[fmt], after_id
+
+def header(fmt, fields=QUOTE_FIELDS):
+    if fmt == 'csv':
+        return _encode(fmt, [_columns(fields)], None)
+    return b''
+
+# quoteID and the fields, in the order of COLUMNS
+def _columns(fields):
+    return [COLUMNS[0]] + [column for column in COLUMNS[1:] if column in fields]
+
+#--------------------------------------------------------
+# Encodes (ID, text, author, category) rows as one      |
+# chunk of the response, with the columns of `fields`   |
+#--------------------------------------------------------
+def encode_rows(fmt, rows, fields=QUOTE_FIELDS):
+    columns = _columns(fields)
+    if len(columns) < len(COLUMNS):
+        positions = [COLUMNS.index(column) for column in columns]
+        rows = [[row[i] for i in positions] for row in rows]
+    return _encode(fmt, rows, columns)
+
+def _encode(fmt, rows, columns):
+    if fmt == 'csv':
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerows(rows)
+        return out.getvalue().encode('utf-8')
+    return "".join(serialize.dumps(dict(zip(columns, row))) + "\n" for row in rows).encode('utf-8')
+
+#--------------------------------------------------------
+# Streams an export from a psycopg2 connection. The     |
+# transaction is rolled back at the end, it only read.  |
+#--------------------------------------------------------
+def stream(conn, fmt, author=None, category=None, after_id=0, batch_size=1000,
+           fields=QUOTE_FIELDS):
+    sql, params = queries.export_quotes(author, category, after_id, fields)
+    cursor = conn.cursor(name='quotes_export')
+    try:
+        cursor.itersize = batch_size
+        cursor.execute(sql, params)
+        yield header(fmt, fields)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield encode_rows(fmt, rows, fields)
+    finally:
+        cursor.close()
+        conn.rollback()
+
+#--------------------------------------------------------
+# Same as stream() from an iterable of rows, used when  |
+# serving a snapshot                                    |
+#--------------------------------------------------------
+def stream_rows(rows, fmt, batch_size=1000, fields=QUOTE_FIELDS):
+    yield header(fmt, fields)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield encode_rows(fmt, batch, fields)
+            batch = []
+    if batch:
+        yield encode_rows(fmt, batch, fields)
@@ -0,0 +1,52 @@
+from pagination import MAX_ID
+
+#--------------------------------------------------------
+# Arguments of the routes returning quote objects.      |
+#                                                       |
+# fields=quote,author is a sparse fieldset: the quote   |
+# objects of the response only carry those keys, and    |
+# the author/category joins are left out of the query   |
+# when their field is (see queries.py). quoteID, on the |
+# routes that return it, is always sent. ids=1,2,3 is   |
+# the list of GET /quotes.                              |
+#--------------------------------------------------------
+class ArgumentError(ValueError):
+    pass
+
+QUOTE_FIELDS = ('quote', 'author', 'category')
+
+SEARCH_FIELDS = ('quote', 'snippet', 'author', 'category', 'rank')
+
+#--------------------------------------------------------
+# Returns the fields asked for in the order of          |
+# `allowed`, all of them when the argument is missing   |
+#--------------------------------------------------------
+def parse_fields(value, allowed=QUOTE_FIELDS):
+    names = {name.strip() for name in (value or '').split(',') if name.strip()}
+    if not names:
+        return allowed
+    unknown = sorted(names - set(allowed))
+    if unknown:
+        raise ArgumentError("unknown field %s, fields are: %s"
+                            % (", ".join(unknown), ", ".join(allowed)))
+    return tuple(field for field in allowed if field in names)
+
+def select_fields(quote, fields):
+    return {field: quote[field] for field in fields}
+
+#--------------------------------------------------------
+# Returns the IDs of a comma separated list in their    |
+# order, duplicates included                            |
+#--------------------------------------------------------
+def parse_ids(value, max_ids):
+    if not value or not value.strip():
+        raise ArgumentError("missing ids")
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise ArgumentError("ids must be comma separated integers")
+    if any(not 0 <= quote_id <= MAX_ID for quote_id in ids):
+        raise ArgumentError("ids must be comma separated integers")
+    if len(ids) > max_ids:
+        raise ArgumentError("at most %d ids can be asked for at once" % max_ids)
+    return ids
@@ -0,0 +1,39 @@
+import logging
+import os
+import time
+
+#--------------------------------------------------------
+# Pre-fork serving: `gunicorn -c gunicorn.conf.py`.     |
+#                                                       |
+# The app is loaded once in the master, which also      |
+# builds the name catalog (CATALOG_PATH, see            |
+# catalog.py), and the workers are forked from it, so   |
+# they share its memory until they write to it. Each    |
+# worker logs its start time and memory, also on        |
+# /metrics (see metrics.py).                            |
+#--------------------------------------------------------
+wsgi_app = 'app:app'
+preload_app = True
+bind = os.environ.get('BIND', '127.0.0.1:5000')
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+threads = int(os.environ.get('THREADS', 4))
+
+log = logging.getLogger('gunicorn.error')
+_started = time.perf_counter()
+
+def when_ready(server):
+    import app
+    catalog = app.name_catalog.stats() if app.name_catalog else None
+    log.info("app loaded in %.0f ms, name catalog: %s",
+             (time.perf_counter() - _started) * 1000, catalog)
+
+def post_fork(server, worker):
+    worker.forked = time.perf_counter()
+
+def post_worker_init(worker):
+    import metrics
+    metrics.worker_boot_seconds = time.perf_counter() - worker.forked
+    memory = metrics.process_memory()
+    log.info("worker %s ready in %.1f ms, memory %s KiB", worker.pid,
+             metrics.worker_boot_seconds * 1000,
+             ", ".join("%s %d" % (kind, size // 1024) for kind, size in memory.items()))
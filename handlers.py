@@ -0,0 +1,671 @@
+from markupsafe import escape
+
+import batch
+import ingest
+import queries
+import serialize
+from queries import Query, Statement, Commit, Rollback
+from pagination import CursorError, FIRST_NAME_KEY, FIRST_ID_KEY
+from serialize import Fragment
+from fields import QUOTE_FIELDS, SEARCH_FIELDS, select_fields
+from dedupe import fingerprint
+from cache import (quote_tag, author_tag, author_name_tag,
+                   category_tag, category_name_tag)
+
+#--------------------------------------------------------
+# Route logic shared by the Flask app (app.py) and the  |
+# ASGI app (asgi.py).                                   |
+#                                                       |
+# Handlers are generators: they yield the database work |
+# they need (queries.Query, Statement, Commit,          |
+# Rollback), get the result sent back and finally       |
+# return (status, response data). queries.run() drives  |
+# them on a psycopg2 connection and asgi.py drives the  |
+# same handlers with an async driver, so both modes     |
+# answer identically.                                   |
+#--------------------------------------------------------
+
+#--------------------------------------------------------
+# Parses an integer query parameter the way Flask's     |
+# request.args.get(type=int) does                       |
+#--------------------------------------------------------
+def parse_int(value, default):
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def limit_error():
+    return 404, {"error": "limit cannot be negative"}
+
+#--------------------------------------------------------
+# Endpoint 1                                            |
+# Returns randomly selected quotes                      |
+#--------------------------------------------------------
+def random_quotes(sampler, limit, fragments=None, fields=QUOTE_FIELDS):
+    if limit < 0:
+        return limit_error()
+
+    yield from sampler.refresh()
+    quote_ids = sampler.sample(limit)
+
+    found = yield from _quotes(quote_ids, fragments, fields)
+    # A sampled ID may belong to a quote deleted since the last reload
+    if len(found) < len(set(quote_ids)):
+        sampler.invalidate()
+
+    quotes = [found[quote_id] for quote_id in quote_ids if quote_id in found]
+
+    return 200, {'randomQuotes': quotes}
+
+#--------------------------------------------------------
+# Endpoint 2                                            |
+# Returns the quote data provided the ID of that quote  |
+#--------------------------------------------------------
+def quote_by_id(quote_id, fragments=None, fields=QUOTE_FIELDS):
+    if fields != QUOTE_FIELDS:
+        found = yield from _quotes([quote_id], None, fields)
+        if quote_id not in found:
+            return 404, {"error": "Quote not found"}
+        return 200, found[quote_id]
+
+    if fragments is not None:
+        found = fragments.get_many([quote_tag(quote_id)])
+        if found:
+            return 200, found[quote_tag(quote_id)]
+
+    quote_data = yield Query(queries.QUOTE_BY_ID, (quote_id,), fetch='one')
+
+    if not quote_data:
+        return 404, {"error": "Quote not found"}
+
+    quote_text, author_name, category_name = quote_data
+
+    return 200, _quote_fragment(quote_id, quote_text, author_name, category_name, fragments)
+
+#--------------------------------------------------------
+# Endpoint 2 (multi-get)                                |
+# Returns the quotes with the given IDs in the order    |
+# they were asked for, read with one query. An ID with  |
+# no quote gets {"quoteID", "error"} in its place.      |
+#--------------------------------------------------------
+def quotes_by_ids(quote_ids, fragments=None, fields=QUOTE_FIELDS):
+    found = yield from _quotes(quote_ids, fragments, fields)
+
+    quotes = []
+    for quote_id in quote_ids:
+        quote = found.get(quote_id)
+        if quote is None:
+            quotes.append({"quoteID": quote_id, "error": "Quote not found"})
+        elif isinstance(quote, Fragment):
+            quotes.append(serialize.extend({"quoteID": quote_id}, quote))
+        else:
+            quotes.append(dict({"quoteID": quote_id}, **quote))
+
+    return 200, {
+        "amount of quotes returned": sum(1 for quote_id in quote_ids if quote_id in found),
+        "quotes": quotes
+    }
+
+#--------------------------------------------------------
+# Reads the quotes with the given IDs, returns them by  |
+# ID. With every field, quotes encoded by earlier       |
+# requests are reused as they are and the others are    |
+# kept in `fragments`.                                  |
+#--------------------------------------------------------
+def _quotes(quote_ids, fragments, fields):
+    if fields != QUOTE_FIELDS:
+        fragments = None
+
+    found = {}
+    if fragments is not None:
+        cached = fragments.get_many([quote_tag(quote_id) for quote_id in quote_ids])
+        found = {quote_id: cached[quote_tag(quote_id)]
+                 for quote_id in quote_ids if quote_tag(quote_id) in cached}
+    missing = list(dict.fromkeys(quote_id for quote_id in quote_ids if quote_id not in found))
+
+    if missing:
+        rows = yield Query(queries.quotes_by_ids(fields), (missing,))
+        for quote_id, quote_text, author_name, category_name in rows:
+            if fields != QUOTE_FIELDS:
+                found[quote_id] = select_fields({
+                    "quote": quote_text,
+                    "author": author_name,
+                    "category": category_name
+                }, fields)
+            else:
+                found[quote_id] = _quote_fragment(quote_id, quote_text, author_name,
+                                                  category_name, fragments)
+    return found
+
+#--------------------------------------------------------
+# A quote as {"quote", "author", "category"}, encoded   |
+# once and kept in `fragments` (see serialize.py) when  |
+# given. Without it the plain dict is returned.         |
+#--------------------------------------------------------
+def _quote_fragment(quote_id, quote_text, author_name, category_name, fragments):
+    quote = {
+        "quote": quote_text,
+        "author": author_name,
+        "category": category_name
+    }
+    if fragments is None:
+        return quote
+    fragment = Fragment(serialize.dumps(quote))
+    fragments.set(quote_tag(quote_id), fragment)
+    return fragment
+
+#--------------------------------------------------------
+# Reads one page of a list statement (see queries.py    |
+# and pagination.py). Returns the total (None when the  |
+# request asked for count=false), the resolved name,    |
+# the values in order and the next/prev links.          |
+#--------------------------------------------------------
+def _page(statement, page, first_key, params=()):
+    backwards, key = page.position(first_key)
+    if backwards:
+        statement += '_before'
+
+    total, name, values, ids = yield Statement(
+        statement, tuple(params) + tuple(key) + (page.limit + 1, page.with_count))
+
+    more = len(values) > page.limit
+    values, ids = values[:page.limit], ids[:page.limit]
+    if backwards:
+        values.reverse()
+        ids.reverse()
+
+    if len(first_key) == 2:
+        keys = list(zip(values, ids))
+    else:
+        keys = [(quote_id,) for quote_id in ids]
+    next_link, prev_link = page.links(keys, backwards, more)
+    return total, name, values, next_link, prev_link
+
+def cursor_error(error):
+    return 400, {"error": str(error)}
+
+#--------------------------------------------------------
+# Endpoint 3                                            |
+# Returns a list of Authors                             |
+#--------------------------------------------------------
+def authors(page):
+    if page.limit < 0:
+        return limit_error()
+
+    try:
+        authors_count, _, authors, next_link, prev_link = yield from _page(
+            'authors_page', page, FIRST_NAME_KEY)
+    except CursorError as error:
+        return cursor_error(error)
+
+    if authors_count is not None and authors_count < 1:
+        return 200, {"authors": []}
+
+    response_data = {}
+    if authors_count is not None:
+        response_data["total number of authors"] = authors_count
+    response_data.update({
+        "number of authors returned": len(authors),
+        "authors": authors,
+        "next": next_link,
+        "prev": prev_link
+    })
+    return 200, response_data
+
+#--------------------------------------------------------
+# Endpoints 4 and 6                                     |
+# Returns quotes by author or category name. A name the |
+# catalog (see catalog.py) knows is read by its ID,     |
+# which returns the same page without the name join.    |
+#--------------------------------------------------------
+def quotes_by_author_name(author_name_raw, page, catalog=None):
+    return _quotes_by_name('quotes_by_author', 'author', 'authors', author_name_raw, page,
+                           catalog)
+
+def quotes_by_category_name(category_name_raw, page, catalog=None):
+    return _quotes_by_name('quotes_by_category', 'category', 'categories', category_name_raw,
+                           page, catalog)
+
+def _quotes_by_name(statement, key, table, name_raw, page, catalog=None):
+    name = escape(name_raw)
+
+    if page.limit < 0:
+        return limit_error()
+
+    name_id = catalog.id_for_name(table, name) if catalog else None
+    if name_id is not None:
+        statement, params = statement + '_id', (name_id,)
+    else:
+        statement, params = statement + '_name', (name,)
+
+    try:
+        quote_count, found_name, quotes, next_link, prev_link = yield from _page(
+            statement, page, FIRST_ID_KEY, params)
+    except CursorError as error:
+        return cursor_error(error)
+
+    if _not_found(quote_count, found_name, quotes, page):
+        return 404, {"error": "quotes not found!"}
+
+    response_data = {}
+    if quote_count is not None:
+        response_data["total quotes available"] = quote_count
+    response_data.update({
+        "amount of quotes returned": len(quotes),
+        key: name.title(),
+        "quotes": quotes,
+        "next": next_link,
+        "prev": prev_link
+    })
+    return 200, response_data
+
+#--------------------------------------------------------
+# Endpoints 5 and 7                                     |
+# Returns quotes by author or category ID               |
+#--------------------------------------------------------
+def quotes_by_author_id(author_id, page):
+    return _quotes_by_id('quotes_by_author_id', 'author', author_id, page)
+
+def quotes_by_category_id(category_id, page):
+    return _quotes_by_id('quotes_by_category_id', 'category', category_id, page)
+
+def _quotes_by_id(statement, key, name_id, page):
+    if page.limit < 0:
+        return limit_error()
+
+    try:
+        quote_count, name, quotes, next_link, prev_link = yield from _page(
+            statement, page, FIRST_ID_KEY, (name_id,))
+    except CursorError as error:
+        return cursor_error(error)
+
+    if _not_found(quote_count, name, quotes, page):
+        return 404, {"error": "quotes not found!"}
+
+    response_data = {}
+    if quote_count is not None:
+        response_data["total quotes available"] = quote_count
+    response_data.update({
+        "amount of quotes returned": len(quotes),
+        key + "ID": int(name_id),
+        key + "Name": name,
+        "quotes": quotes,
+        "next": next_link,
+        "prev": prev_link
+    })
+    return 200, response_data
+
+# Without the count, an author/category with no quotes shows as an empty first page
+def _not_found(count, name, quotes, page):
+    if count is not None:
+        return count < 1
+    return name is None or (not quotes and page.cursor is None)
+
+#--------------------------------------------------------
+# Endpoint 8                                            |
+# Returns a list of all categories for quotes           |
+#--------------------------------------------------------
+def categories(page):
+    if page.limit < 0:
+        return limit_error()
+
+    try:
+        total_categories, _, categories, next_link, prev_link = yield from _page(
+            'categories_page', page, FIRST_NAME_KEY)
+    except CursorError as error:
+        return cursor_error(error)
+
+    if total_categories is not None and total_categories < 1:
+        return 200, {"categories": []}
+
+    response_data = {}
+    if total_categories is not None:
+        response_data["total number of categories"] = total_categories
+    response_data.update({
+        "amount of categories returned": len(categories),
+        "categories": categories,
+        "next": next_link,
+        "prev": prev_link
+    })
+    return 200, response_data
+
+#--------------------------------------------------------
+# Endpoint 11                                           |
+# Full-text search of the quotes, best match first,     |
+# optionally within one author and/or category          |
+#--------------------------------------------------------
+def search_quotes(text, author, category, page, fields=SEARCH_FIELDS):
+    if not text or not text.strip():
+        return 400, {"error": "missing search query"}
+
+    if page.limit < 0:
+        return limit_error()
+
+    try:
+        backwards, key = page.position(SEARCH_FIRST_KEY)
+    except CursorError as error:
+        return cursor_error(error)
+
+    sql, params = queries.search_quotes(text, page.limit + 1, author, category,
+                                        key if page.cursor else None, backwards, fields)
+    rows = yield Query(sql, params)
+
+    more = len(rows) > page.limit
+    rows = rows[:page.limit]
+    if backwards:
+        rows.reverse()
+
+    quotes = [dict({"quoteID": quote_id}, **select_fields({
+        "quote": quote_text,
+        "snippet": _highlight(snippet) if snippet is not None else None,
+        "author": author_name,
+        "category": category_name,
+        "rank": rank
+    }, fields)) for quote_id, rank, quote_text, snippet, author_name, category_name in rows]
+
+    next_link, prev_link = page.links([(row[1], row[0]) for row in rows], backwards, more)
+    return 200, {
+        "amount of quotes returned": len(quotes),
+        "quotes": quotes,
+        "next": next_link,
+        "prev": prev_link
+    }
+
+# Search cursors hold (rank, quote ID)
+SEARCH_FIRST_KEY = (0.0, 0)
+
+def _highlight(snippet):
+    snippet = str(escape(snippet))
+    return snippet.replace(queries.SEARCH_START, "<b>").replace(queries.SEARCH_STOP, "</b>")
+
+#--------------------------------------------------------
+# Endpoint 13                                           |
+# Returns the number of quotes, authors and categories  |
+# and the authors/categories with the most quotes, read |
+# from the counters of migrations/0007 (no scans)       |
+#--------------------------------------------------------
+def quote_stats(limit):
+    if limit < 0:
+        return limit_error()
+
+    totals = dict((yield Query(queries.QUOTE_TOTALS)))
+    top_authors = yield Query(queries.TOP_AUTHORS, (limit,))
+    top_categories = yield Query(queries.TOP_CATEGORIES, (limit,))
+
+    return 200, {
+        "total quotes": totals.get('quotes', 0),
+        "total authors": totals.get('authors', 0),
+        "total categories": totals.get('categories', 0),
+        "top authors": [{"authorID": author_id, "author": name, "quotes": count}
+                        for author_id, name, count in top_authors],
+        "top categories": [{"categoryID": category_id, "category": name, "quotes": count}
+                           for category_id, name, count in top_categories],
+    }
+
+#--------------------------------------------------------
+# Return the ID of the author/category with the given   |
+# name, adding it if it doesn't exist (see names.py)    |
+#--------------------------------------------------------
+def author_id_from_name(author_name, names, cache):
+    return _id_from_name(names.authors, author_name, cache)
+
+def category_id_from_name(category_name, names, cache):
+    return _id_from_name(names.categories, category_name, cache)
+
+def _id_from_name(resolver, name, cache):
+    if not name:
+        return None
+
+    name_id, created = yield from resolver.resolve(name)
+    if created:
+        cache.invalidate(resolver.list_tag)
+
+    return name_id
+
+#--------------------------------------------------------
+# Endpoint 9                                            |
+# Adds a new quote to the database provided the         |
+# quote, author name, and the category.                 |
+#--------------------------------------------------------
+def add_quote(data, sampler, cache, names, duplicates):
+    if not isinstance(data, dict):
+        return 400, {"error": "expected a quote object or an array of quotes"}
+
+    text = data.get('quote')
+    author_name = data.get('author')
+    category_name = data.get('category')
+
+    # check for any missing parameters
+    missing_fields = batch.missing_quote_fields(data)
+    if missing_fields:
+        return 400, {"error": "couldn't add the quote", "missingFields": missing_fields}
+    if batch.invalid_quote(data):
+        return 400, {"error": "fields must be strings"}
+
+    try:
+        #check if quote already exists
+        duplicate = yield from duplicates.find(text)
+        if duplicate:
+            return duplicate_error(text, *duplicate)
+
+        author_id = yield from author_id_from_name(author_name, names, cache)
+        category_id = yield from category_id_from_name(category_name, names, cache)
+
+        fp = fingerprint(text)
+        row = yield Query(queries.INSERT_QUOTE, (text, author_id, category_id, fp), fetch='one')
+        if not row:
+            # Added by another request since the check
+            existing = yield Query(queries.QUOTE_ID_BY_FINGERPRINT, (fp,), fetch='one')
+            duplicates.add(existing[0], text, fp)
+            return duplicate_error(text, existing[0], 1.0)
+        yield Commit()
+    except Exception as error:
+        return 500, {"error": str(error)}
+
+    quote_id = row[0]
+    sampler.add(quote_id)
+    duplicates.add(quote_id, text, fp)
+    cache.invalidate('quotes', author_tag(author_id), author_name_tag(author_name),
+                     category_tag(category_id), category_name_tag(category_name))
+
+    return 201, {
+        "message": "successfully created a new quote",
+        "quoteID": quote_id,
+        "author": author_name,
+        "quote": text,
+        "category": category_name
+    }
+
+def duplicate_error(text, quote_id, similarity):
+    if similarity < 1.0:
+        return 404, {"error": "a similar quote already exists", "quoteID": quote_id,
+                     "quote": text, "similarity": similarity}
+    return 404, {"error": "quote already exists", "quoteID": quote_id, "quote": text}
+
+#--------------------------------------------------------
+# Endpoint 9 (write-behind)                             |
+# Queues a new quote for the next group commit (see     |
+# ingest.py) and returns its ticket. Not a generator,   |
+# the database isn't touched.                           |
+#--------------------------------------------------------
+def queue_quote(data, ingest_queue):
+    if not isinstance(data, dict):
+        return 400, {"error": "expected a quote object or an array of quotes"}
+
+    missing_fields = batch.missing_quote_fields(data)
+    if missing_fields:
+        return 400, {"error": "couldn't add the quote", "missingFields": missing_fields}
+    if batch.invalid_quote(data):
+        return 400, {"error": "fields must be strings"}
+
+    ticket = ingest_queue.submit(data)
+    return 202, {
+        "message": "quote queued",
+        "ticket": ticket,
+        "status": "queued",
+        "author": data['author'],
+        "quote": data['quote'],
+        "category": data['category']
+    }
+
+#--------------------------------------------------------
+# Endpoint 9 (batch)                                    |
+# Adds many quotes in one request, reporting created /  |
+# duplicate / invalid for each one                      |
+#--------------------------------------------------------
+def add_quotes(items, sampler, cache, names, duplicates, max_size):
+    if not isinstance(items, list):
+        return 400, {"error": "expected an array of quotes"}
+
+    if len(items) > max_size:
+        return 413, {"error": "too many quotes, at most %d per request" % max_size}
+
+    try:
+        results, created_rows, new_authors, new_categories = yield from batch.create_quotes(
+            items, duplicates)
+    except Exception as error:
+        return 500, {"error": str(error)}
+
+    quotes_created(created_rows, new_authors, new_categories, sampler, cache, names)
+
+    statuses = [result["status"] for result in results]
+    return 200, {
+        "created": statuses.count("created"),
+        "duplicates": statuses.count("duplicate"),
+        "invalid": statuses.count("invalid"),
+        "results": results
+    }
+
+#--------------------------------------------------------
+# Updates the sampler, name maps and cache after        |
+# batch.create_quotes() committed                       |
+#--------------------------------------------------------
+def quotes_created(created_rows, new_authors, new_categories, sampler, cache, names):
+    tags = {'quotes'} if created_rows else set()
+    if new_authors:
+        tags.add('authors')
+    if new_categories:
+        tags.add('categories')
+    names.remember([row[1:] for row in created_rows])
+    for quote_id, author_id, author_name, category_id, category_name in created_rows:
+        sampler.add(quote_id)
+        tags.update((author_tag(author_id), author_name_tag(author_name),
+                     category_tag(category_id), category_name_tag(category_name)))
+    cache.invalidate(*tags)
+
+#--------------------------------------------------------
+# Endpoint 9 (write-behind)                             |
+# Commits a group of quotes taken off the ingest queue  |
+# (see ingest.py) together with their ticket outcomes.  |
+# Replayed tickets whose outcome is already stored are  |
+# skipped. Returns {ticket: result}, None for those.    |
+#--------------------------------------------------------
+def ingest_quotes(entries, sampler, cache, names, duplicates):
+    done = set()
+    replayed = [entry['ticket'] for entry in entries if entry.get('replayed')]
+    if replayed:
+        rows = yield Query(ingest.TICKETS_DONE, (replayed,))
+        done = {ticket for ticket, in rows}
+    entries = [entry for entry in entries if entry['ticket'] not in done]
+
+    def store_outcomes(results):
+        yield Query(ingest.INSERT_TICKETS, ingest.ticket_rows(entries, results), fetch=None)
+
+    results, created_rows, new_authors, new_categories = yield from batch.create_quotes(
+        entries, duplicates, store_outcomes)
+    quotes_created(created_rows, new_authors, new_categories, sampler, cache, names)
+
+    outcomes = dict.fromkeys(done)
+    outcomes.update((entry['ticket'], result) for entry, result in zip(entries, results))
+    return outcomes
+
+#--------------------------------------------------------
+# Endpoint 9 (ticket status)                            |
+# Returns the outcome of a quote accepted with 202, or  |
+# "queued" while it waits for its group commit          |
+#--------------------------------------------------------
+def ticket_status(ticket, ingest_queue):
+    result = ingest_queue.result(ticket)
+    if result is None:
+        row = yield Query(ingest.TICKET_STATUS, (ticket,), fetch='one')
+        if row:
+            result = row[0]
+        elif ingest_queue.queued_anywhere(ticket):
+            result = {"status": "queued"}
+    if result is None:
+        return 404, {"error": "ticket not found"}
+    return 200, dict({"ticket": ticket}, **result)
+
+#--------------------------------------------------------
+# Endpoint 10                                           |
+# Update the quote, or the author, or the category      |
+#--------------------------------------------------------
+FIND_QUOTE = """
+SELECT Quotes.text, Quotes.authorID, Authors.name, Quotes.categoryID, Categories.name
+FROM Quotes
+JOIN Authors ON Quotes.authorID = Authors.ID
+JOIN Categories ON Quotes.categoryID = Categories.ID
+WHERE Quotes.ID = %s;
+"""
+
+def update_quote(quote_id, text, author, category, cache, names, duplicates):
+    try:
+        existing_quote = yield Query(FIND_QUOTE, (quote_id,), fetch='one')
+        if not existing_quote:
+            return 404, {"error": "Quote was not found"}
+
+        if text:
+            duplicate = yield from duplicates.find(text, exclude=quote_id)
+            if duplicate:
+                return duplicate_error(text, *duplicate)
+
+        author_id = yield from author_id_from_name(author, names, cache)
+        category_id = yield from category_id_from_name(category, names, cache)
+
+        columns = []
+        params = []
+        if text:
+            columns.append("text = %s, fingerprint = %s")
+            params.extend((text, fingerprint(text)))
+        if author:
+            columns.append("authorID = %s")
+            params.append(author_id)
+        if category:
+            columns.append("categoryID = %s")
+            params.append(category_id)
+
+        if columns:
+            update_query = "UPDATE Quotes SET %s WHERE ID = %%s;" % ", ".join(columns)
+            try:
+                yield Query(update_query, tuple(params) + (quote_id,), fetch=None)
+            except Exception as error:
+                if not queries.unique_violation(error, queries.FINGERPRINT_KEY):
+                    raise
+                # Added by another request (or worker) since the check
+                yield Rollback()
+                fp = fingerprint(text)
+                existing = yield Query(queries.QUOTE_ID_BY_FINGERPRINT, (fp,), fetch='one')
+                if not existing:
+                    raise error
+                duplicates.add(existing[0], text, fp)
+                return duplicate_error(text, existing[0], 1.0)
+        yield Commit()
+    except Exception as error:
+        return 500, {"error": str(error)}
+
+    if text:
+        duplicates.add(quote_id, text)
+    _, old_author_id, old_author_name, old_category_id, old_category_name = existing_quote
+    cache.invalidate('quotes', quote_tag(quote_id),
+                     author_tag(old_author_id), author_name_tag(old_author_name),
+                     category_tag(old_category_id), category_name_tag(old_category_name),
+                     author_tag(author_id), author_name_tag(author),
+                     category_tag(category_id), category_name_tag(category))
+
+    return 200, {
+        "message": "Quote updated succesfully",
+        "quoteID": str(quote_id)
+    }
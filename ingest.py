@@ -0,0 +1,395 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import psycopg2
+
+import queries
+from admission import Overloaded
+from db import PoolTimeout
+from queries import Query, Commit
+
+#--------------------------------------------------------
+# Write-behind ingestion for POST /quotes.              |
+#                                                       |
+# With INGEST_ENABLED a new quote is validated, written |
+# to a local journal and answered with 202 and a        |
+# ticket. A background thread commits the queued quotes |
+# to Postgres in groups (batch.create_quotes, four      |
+# statements and one commit per group) once             |
+# `batch_size` are waiting or the oldest has waited     |
+# `max_delay` seconds. Each ticket's outcome is stored  |
+# in ingest_tickets (migration 0008) in the same        |
+# transaction.                                          |
+#                                                       |
+# Every worker process appends to its own journal       |
+# segment, an NDJSON file in `directory` it holds an    |
+# flock on. A segment whose lock is free belongs to a   |
+# process that died: the next worker to look adopts     |
+# its quotes and the tickets not found in               |
+# ingest_tickets are committed again. The segment is    |
+# emptied whenever everything in it is committed.       |
+#--------------------------------------------------------
+log = logging.getLogger('quotes_api.ingest')
+
+TICKETS_DONE = "SELECT ticket FROM ingest_tickets WHERE ticket = ANY(%s);"
+
+INSERT_TICKETS = """
+INSERT INTO ingest_tickets (ticket, status, result, queued_at)
+SELECT ticket, status, result::jsonb, to_timestamp(queued_at)
+FROM unnest(%s::text[], %s::text[], %s::text[], %s::float8[])
+     AS input(ticket, status, result, queued_at)
+ON CONFLICT (ticket) DO NOTHING;
+"""
+
+TICKET_STATUS = "SELECT result FROM ingest_tickets WHERE ticket = %s;"
+
+PURGE_TICKETS = "DELETE FROM ingest_tickets WHERE committed_at < now() - %s * interval '1 second';"
+
+# Errors worth retrying the same group for later, anything else is the data's fault
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout)
+
+# Seconds between looks for segments of dead workers, and between purges of old tickets
+ADOPT_INTERVAL = 30.0
+PURGE_INTERVAL = 600.0
+
+def ticket_rows(entries, results):
+    return ([entry['ticket'] for entry in entries],
+            [result['status'] for result in results],
+            [json.dumps(result) for result in results],
+            [entry['queued'] for entry in entries])
+
+# Stores the outcome of a quote that failed on its own
+def store_failure(entry, result):
+    yield Query(INSERT_TICKETS, ticket_rows([entry], [result]), fetch=None)
+    yield Commit()
+
+def purge_tickets(ttl):
+    yield Query(PURGE_TICKETS, (ttl,), fetch=None)
+    yield Commit()
+
+#--------------------------------------------------------
+# Append-only journal segments                          |
+#--------------------------------------------------------
+class Journal:
+    def __init__(self, directory, fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+        self.path = None
+        self._file = None
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, 'journal-%d-%s.ndjson'
+                            % (os.getpid(), uuid.uuid4().hex[:8]))
+        f = open(path, 'ab')
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.path, self._file = path, f
+
+    def append(self, records):
+        self._file.write(b''.join(json.dumps(record).encode('utf-8') + b'\n'
+                                  for record in records))
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def size(self):
+        return self._file.tell()
+
+    def truncate(self):
+        self._file.truncate(0)
+        self._file.seek(0)
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    # Starts a new segment holding `records` and drops the old one
+    def rotate(self, records):
+        old_path, old_file = self.path, self._file
+        self.open()
+        self.append(records)
+        os.unlink(old_path)
+        old_file.close()
+
+    def _segments(self):
+        return [path for path in sorted(glob.glob(os.path.join(self.directory, 'journal-*.ndjson')))
+                if path != self.path]
+
+    #--------------------------------------------------------
+    # Returns the records of the segments no live process   |
+    # holds, locked, as [(path, file, records)]. Pass each  |
+    # to release() once its records are safe elsewhere.     |
+    #--------------------------------------------------------
+    def orphans(self):
+        found = []
+        for path in self._segments():
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            # Adopted and removed by another worker while this one waited for the lock
+            if os.fstat(f.fileno()).st_nlink == 0:
+                f.close()
+                continue
+            found.append((path, f, _records(f)))
+        return found
+
+    def release(self, path, f):
+        os.unlink(path)
+        f.close()
+
+    # True if another process's segment holds the ticket
+    def contains(self, ticket):
+        for path in self._segments():
+            try:
+                with open(path, 'rb') as f:
+                    if any(record.get('ticket') == ticket for record in _records(f)):
+                        return True
+            except FileNotFoundError:
+                continue
+        return False
+
+def _records(f):
+    records = []
+    for line in f:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            # A torn write at the end of a segment, its quote was never acknowledged
+            continue
+    return records
+
+#--------------------------------------------------------
+# The queue and its group commit thread. `write` runs a |
+# group, a list of journal records, and returns         |
+# {ticket: result} (handlers.ingest_quotes on a         |
+# connection). The thread starts on first use in each   |
+# process, so pre-forked workers each get their own.    |
+#--------------------------------------------------------
+class IngestQueue:
+    def __init__(self, directory, write, record_failure, purge, batch_size=500,
+                 max_delay=0.05, max_pending=10000, fsync=True, retry_delay=1.0,
+                 ticket_ttl=604800.0, max_journal_bytes=64 * 1024 * 1024, max_results=10000):
+        self.journal = Journal(directory, fsync)
+        self._write = write
+        self._record_failure = record_failure
+        self._purge = purge
+        self.batch_size = max(batch_size, 1)
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.ticket_ttl = ticket_ttl
+        self.max_journal_bytes = max_journal_bytes
+        self.max_results = max_results
+
+        self._queue = deque()
+        self._pending = {}
+        self._results = OrderedDict()
+        self._cond = threading.Condition()
+        self._append_lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        self._next_adopt = 0.0
+        self._next_purge = 0.0
+
+        self.stats_counts = {"accepted": 0, "replayed": 0, "batches": 0, "committed": 0,
+                             "retries": 0}
+        self.outcomes = {}
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits no thread and must not share the parent's segment
+            self._queue.clear()
+            self._pending.clear()
+            self.journal.open()
+            self._thread = threading.Thread(target=self._run, name='ingest', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    #--------------------------------------------------------
+    # Journals a valid quote and returns its ticket. Raises |
+    # Overloaded when the queue is full.                    |
+    #--------------------------------------------------------
+    def submit(self, data):
+        self.start()
+        entry = {"ticket": uuid.uuid4().hex, "quote": data['quote'], "author": data['author'],
+                 "category": data['category'], "queued": time.time()}
+        with self._cond:
+            if len(self._pending) >= self.max_pending:
+                raise Overloaded(503, "ingest queue is full, retry later", self.retry_delay)
+        with self._append_lock:
+            self.journal.append([entry])
+            with self._cond:
+                self._queue.append(entry)
+                self._pending[entry['ticket']] = entry
+                self.stats_counts["accepted"] += 1
+                self._cond.notify()
+        return entry['ticket']
+
+    # The outcome known to this process: queued, committed recently, or None
+    def result(self, ticket):
+        with self._cond:
+            if ticket in self._pending:
+                return {"status": "queued"}
+            return self._results.get(ticket)
+
+    def queued_anywhere(self, ticket):
+        return self.result(ticket) is not None or self.journal.contains(ticket)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            if now >= self._next_adopt:
+                self._next_adopt = now + ADOPT_INTERVAL
+                self._guard(self._adopt)
+            if self.ticket_ttl and now >= self._next_purge:
+                self._next_purge = now + PURGE_INTERVAL
+                self._guard(lambda: self._purge(self.ticket_ttl))
+            entries = self._next_group()
+            if entries:
+                try:
+                    self._commit(entries)
+                except Exception:
+                    # Quotes still pending weren't committed, the others were
+                    log.exception("ingest group of %d quotes failed", len(entries))
+                    with self._cond:
+                        entries = [entry for entry in entries if entry['ticket'] in self._pending]
+                    if entries:
+                        self._retry(entries)
+
+    def _guard(self, step):
+        try:
+            step()
+        except Exception:
+            log.exception("ingest maintenance failed")
+
+    #--------------------------------------------------------
+    # Waits for a full group or for the oldest quote to     |
+    # have waited max_delay                                 |
+    #--------------------------------------------------------
+    def _next_group(self):
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(ADOPT_INTERVAL)
+            while self._queue and len(self._queue) < self.batch_size:
+                remaining = self._queue[0]['queued'] + self.max_delay - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+
+    def _commit(self, entries):
+        try:
+            outcomes = self._write(entries)
+        except TRANSIENT_ERRORS:
+            self._retry(entries)
+            return
+        except Exception as error:
+            if len(entries) > 1:
+                # One bad quote fails the whole group, find it by committing them one by one
+                for entry in entries:
+                    self._commit([entry])
+                return
+            result = {"status": "failed", "error": str(error)}
+            try:
+                self._record_failure(entries[0], result)
+            except TRANSIENT_ERRORS:
+                self._retry(entries)
+                return
+            except Exception:
+                # The outcome is only kept in memory, the ticket reads failed here
+                log.exception("ingest ticket %s failed and its outcome wasn't stored",
+                              entries[0]['ticket'])
+            outcomes = {entries[0]['ticket']: result}
+        self._done(entries, outcomes)
+
+    def _retry(self, entries):
+        with self._cond:
+            self._queue.extendleft(reversed(entries))
+            self.stats_counts["retries"] += 1
+        time.sleep(self.retry_delay)
+
+    def _done(self, entries, outcomes):
+        with self._append_lock:
+            with self._cond:
+                for entry in entries:
+                    self._pending.pop(entry['ticket'], None)
+                    result = outcomes.get(entry['ticket'])
+                    if result is not None:
+                        self._results[entry['ticket']] = result
+                        self.outcomes[result['status']] = self.outcomes.get(result['status'], 0) + 1
+                while len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+                self.stats_counts["batches"] += 1
+                self.stats_counts["committed"] += len(entries)
+                pending = list(self._pending.values()) if self._pending else None
+            # Everything journaled is committed: start the segment over
+            if pending is None:
+                self.journal.truncate()
+            elif self.journal.size() > self.max_journal_bytes:
+                self.journal.rotate(sorted(pending, key=lambda entry: entry['queued']))
+
+    #--------------------------------------------------------
+    # Takes over the segments of dead processes: their      |
+    # quotes are journaled here first, then queued          |
+    #--------------------------------------------------------
+    def _adopt(self):
+        for path, f, records in self.journal.orphans():
+            with self._append_lock:
+                with self._cond:
+                    records = [dict(record, replayed=True) for record in records
+                               if record.get('ticket') and record['ticket'] not in self._pending]
+                if records:
+                    self.journal.append(records)
+                with self._cond:
+                    for record in records:
+                        self._queue.append(record)
+                        self._pending[record['ticket']] = record
+                    self.stats_counts["replayed"] += len(records)
+                    self._cond.notify()
+            self.journal.release(path, f)
+
+    def stats(self):
+        with self._cond:
+            return dict(self.stats_counts, queued=len(self._pending), outcomes=dict(self.outcomes),
+                        journal=self.journal.path)
+
+    def metrics(self):
+        stats = self.stats()
+        return [
+            ('quotes_api_ingest_queue_depth', 'gauge',
+             "Quotes accepted with 202 and not committed yet", [({}, stats['queued'])]),
+            ('quotes_api_ingest_batches_total', 'counter',
+             "Group commits of the ingest queue", [({}, stats['batches'])]),
+            ('quotes_api_ingest_quotes_total', 'counter',
+             "Quotes taken off the ingest queue, by outcome",
+             [({'status': status}, count) for status, count in sorted(stats['outcomes'].items())]),
+        ]
+
+#--------------------------------------------------------
+# Runs a handler step on a connection of `pool`, rolled |
+# back if it fails                                      |
+#--------------------------------------------------------
+def run_on_pool(pool, handler):
+    conn = pool.getconn()
+    try:
+        return queries.run(handler, lambda: conn)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
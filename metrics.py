@@ -0,0 +1,347 @@
+import bisect
+import contextvars
+import logging
+import re
+import sys
+import threading
+import time
+import uuid
+
+import psycopg2.extensions
+
+#--------------------------------------------------------
+# Instrumentation and the Prometheus /metrics output.   |
+#                                                       |
+# Routes, database statements, pool checkouts and new   |
+# connections are timed into histograms kept in this    |
+# process (each worker exposes its own). Statements     |
+# slower than the slow-query threshold are logged to    |
+# the "quotes_api.slow_query" logger with the trace ID  |
+# of the request that ran them.                         |
+#--------------------------------------------------------
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+BYTES_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+ROWS_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 10000)
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            series = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._series.items())
+        for label_values, (counts, total, count) in series:
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket{%s} %d' % (
+                    self.name, _join(labels, 'le="%s"' % _number(bound)), cumulative))
+            lines.append('%s_bucket{%s} %d' % (self.name, _join(labels, 'le="+Inf"'), count))
+            lines.append('%s_sum%s %s' % (self.name, _braces(labels), _number(total)))
+            lines.append('%s_count%s %d' % (self.name, _braces(labels), count))
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            lines.append('%s%s %s' % (self.name, _braces(_labels(self.labels, label_values)),
+                                      _number(value)))
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values):
+    return ",".join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+def _join(*parts):
+    return ",".join(part for part in parts if part)
+
+def _braces(labels):
+    return "{%s}" % labels if labels else ""
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+#--------------------------------------------------------
+# All metrics of the process plus collectors, functions |
+# returning (name, type, help, [(labels, value)]) for   |
+# values read at scrape time (pool and cache stats)     |
+#--------------------------------------------------------
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def histogram(self, name, help_text, labels=(), buckets=SECONDS_BUCKETS):
+        metric = Histogram(name, help_text, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(name, help_text, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, kind, help_text, samples in collector():
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in samples:
+                    lines.append("%s%s %s" % (name, _braces(_labels(labels.keys(), labels.values())),
+                                              _number(value)))
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'quotes_api_request_duration_seconds', "Time to answer a request, by route",
+    ('route', 'method', 'status'))
+RESPONSE_BYTES = registry.histogram(
+    'quotes_api_response_size_bytes', "Size of the response body, by route",
+    ('route',), BYTES_BUCKETS)
+QUERY_SECONDS = registry.histogram(
+    'quotes_api_query_duration_seconds', "Time spent executing a database statement, by query",
+    ('query',))
+QUERY_ROWS = registry.histogram(
+    'quotes_api_query_rows', "Rows returned or changed by a database statement, by query",
+    ('query',), ROWS_BUCKETS)
+QUERY_ERRORS = registry.counter(
+    'quotes_api_query_errors_total', "Database statements that raised an error, by query",
+    ('query',))
+ACQUIRE_SECONDS = registry.histogram(
+    'quotes_api_db_acquire_duration_seconds', "Time to check a connection out of the pool")
+CONNECT_SECONDS = registry.histogram(
+    'quotes_api_db_connect_duration_seconds', "Time to open a new database connection")
+SLOW_QUERIES = registry.counter(
+    'quotes_api_slow_queries_total', "Statements slower than the slow-query threshold",
+    ('query',))
+
+slow_query_log = logging.getLogger('quotes_api.slow_query')
+
+#--------------------------------------------------------
+# Memory of this process. Under a pre-fork server the   |
+# pages a worker still shares with the master and the   |
+# other workers (the loaded app, the name catalog) are  |
+# "shared", and "private" is what the worker adds.      |
+# Without /proc/self/smaps_rollup only the peak RSS is  |
+# known.                                                |
+#--------------------------------------------------------
+def process_memory():
+    try:
+        fields = {}
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) * 1024
+        return {
+            'rss': fields['Rss'],
+            'pss': fields['Pss'],
+            'shared': fields['Shared_Clean'] + fields['Shared_Dirty'],
+            'private': fields['Private_Clean'] + fields['Private_Dirty'],
+        }
+    except (OSError, KeyError, ValueError):
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return {'max_rss': max_rss * (1 if sys.platform == 'darwin' else 1024)}
+
+# Seconds from fork to serving of this worker, set by gunicorn.conf.py
+worker_boot_seconds = None
+
+def process_metrics():
+    collected = [
+        ('quotes_api_process_memory_bytes', 'gauge',
+         "Memory of this process by kind (rss, pss, shared with other processes, private)",
+         [({'kind': kind}, value) for kind, value in process_memory().items()]),
+    ]
+    if worker_boot_seconds is not None:
+        collected.append(('quotes_api_worker_boot_seconds', 'gauge',
+                          "Seconds this worker took from fork to serving",
+                          [({}, worker_boot_seconds)]))
+    return collected
+
+registry.collectors.append(process_metrics)
+
+# Seconds after which a statement is logged, 0 disables the log (set by init_app())
+slow_query_seconds = 0.5
+
+#--------------------------------------------------------
+# Query names: the name of a constant in queries.py and |
+# the other modules holding SQL (register_queries()),   |
+# the statement name for EXECUTE/PREPARE, else the verb |
+# and first table, so the label set stays small         |
+#--------------------------------------------------------
+_query_names = {}
+# Constants with {placeholders} are formatted before use, they match as patterns with
+# anything in place of the placeholders. Templates only vary in structure, so the
+# formatted queries are few and remembered once matched.
+_query_templates = []
+
+def register_queries(*modules):
+    for module in modules:
+        for name, value in vars(module).items():
+            if name.isupper() and isinstance(value, str) and not name.startswith('_'):
+                if '{' in value:
+                    pattern = '.*?'.join(re.escape(part) for part in re.split(r'\{\w*\}', value))
+                    _query_templates.append((re.compile(pattern, re.DOTALL), name.lower()))
+                else:
+                    _query_names.setdefault(value, name.lower())
+
+_PREPARED = re.compile(r'\s*(EXECUTE|PREPARE)\s+(\w+)', re.IGNORECASE)
+_VERB = re.compile(r'\s*(?:WITH\b.*?\)\s*)?(SELECT|INSERT|UPDATE|DELETE|COPY|CREATE|DROP|'
+                   r'DECLARE|BEGIN|COMMIT|ROLLBACK|SET|VACUUM|DEALLOCATE)\b', re.IGNORECASE | re.DOTALL)
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)', re.IGNORECASE)
+
+def query_name(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    name = _query_names.get(sql)
+    if name:
+        return name
+    for pattern, name in _query_templates:
+        if pattern.fullmatch(sql):
+            _query_names[sql] = name
+            return name
+    prepared = _PREPARED.match(sql)
+    if prepared:
+        return prepared.group(2).lower() if prepared.group(1).upper() == 'EXECUTE' else 'prepare'
+    verb = _VERB.match(sql)
+    table = _TABLE.search(sql)
+    if not verb:
+        return 'other'
+    return "_".join([verb.group(1).lower()] + ([table.group(1).lower()] if table else []))
+
+#--------------------------------------------------------
+# Records one executed statement                        |
+#--------------------------------------------------------
+def observe_query(sql, seconds, rows, error=False, name=None):
+    name = name or query_name(sql)
+    QUERY_SECONDS.observe(seconds, name)
+    if error:
+        QUERY_ERRORS.inc(name)
+    elif rows is not None and rows >= 0:
+        QUERY_ROWS.observe(rows, name)
+    if slow_query_seconds and seconds >= slow_query_seconds:
+        SLOW_QUERIES.inc(name)
+        text = sql.decode('utf-8', 'replace') if isinstance(sql, bytes) else sql
+        slow_query_log.warning("slow query %s took %.1f ms (trace %s): %s", name, seconds * 1000,
+                               current_trace_id() or '-', " ".join(text.split())[:500])
+
+#--------------------------------------------------------
+# psycopg2 cursor timing every execute(), used by the   |
+# connections of the pool in db.py                      |
+#--------------------------------------------------------
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception:
+            observe_query(query, time.perf_counter() - started, None, error=True)
+            raise
+        observe_query(query, time.perf_counter() - started, self.rowcount)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            result = super().copy_expert(sql, file, size)
+        except Exception:
+            observe_query(sql, time.perf_counter() - started, None, error=True)
+            raise
+        observe_query(sql, time.perf_counter() - started, self.rowcount)
+        return result
+
+#--------------------------------------------------------
+# Trace IDs. When enabled, each request takes its ID    |
+# from the trace header (if it looks sane) or gets a    |
+# new one, and the response sends it back. The ID is   |
+# a context variable, so it follows asyncio tasks too.  |
+#--------------------------------------------------------
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+_TRACE_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+def new_trace_id(incoming=None):
+    if incoming and _TRACE_ID.match(incoming):
+        return incoming
+    return uuid.uuid4().hex
+
+def set_trace_id(trace_id):
+    _trace_id.set(trace_id)
+
+def current_trace_id():
+    return _trace_id.get()
+
+#--------------------------------------------------------
+# Flask integration: times every request by endpoint    |
+# (the view function name) and serves GET /metrics      |
+#--------------------------------------------------------
+def init_app(app):
+    from flask import Response, g, request
+
+    global slow_query_seconds
+    slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000.0
+    trace_header = app.config['TRACE_HEADER']
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        set_trace_id(new_trace_id(request.headers.get(trace_header)) if trace_header else None)
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('metrics_started', None)
+        route = request.endpoint or 'unmatched'
+        if started is not None:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method,
+                                    str(response.status_code))
+        # Streamed responses (the export) have no size yet
+        if response.content_length is not None:
+            RESPONSE_BYTES.observe(response.content_length, route)
+        if trace_header and current_trace_id():
+            response.headers[trace_header] = current_trace_id()
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(registry.render(), 200, content_type='text/plain; version=0.0.4')
@@ -0,0 +1,314 @@
+import argparse
+import importlib.util
+import json
+import os
+import re
+import sys
+
+import psycopg2
+
+import dedupe
+import ingest
+import queries
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+# Arbitrary key for pg_advisory_xact_lock so two deploys can't migrate at once
+LOCK_KEY = 7263011
+
+#--------------------------------------------------------
+# A migration is a file named <version>_<name>.sql with |
+# a "-- migrate:up" and a "-- migrate:down" section.    |
+# Every statement should be safe to run twice (IF NOT   |
+# EXISTS / IF EXISTS), each migration runs in its own   |
+# transaction together with its schema_migrations row.  |
+#                                                       |
+# Data migrations that need Python are <version>_<name> |
+# .py files defining up(cursor) and down(cursor), run   |
+# the same way.                                         |
+#--------------------------------------------------------
+class Migration:
+    def __init__(self, version, name, path):
+        self.version = version
+        self.name = name
+        self.path = path
+
+    def _sections(self):
+        with open(self.path, encoding='utf-8') as f:
+            text = f.read()
+        match = re.search(r'^--\s*migrate:up\s*$(.*?)^--\s*migrate:down\s*$(.*)',
+                          text, re.MULTILINE | re.DOTALL)
+        if not match:
+            raise ValueError("%s has no migrate:up/migrate:down sections" % self.path)
+        return match.group(1), match.group(2)
+
+    def up(self, cursor):
+        cursor.execute(self._sections()[0])
+
+    def down(self, cursor):
+        cursor.execute(self._sections()[1])
+
+class PythonMigration(Migration):
+    def _module(self):
+        spec = importlib.util.spec_from_file_location(
+            "migration_%04d" % self.version, self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if not (callable(getattr(module, 'up', None)) and callable(getattr(module, 'down', None))):
+            raise ValueError("%s has no up(cursor)/down(cursor) functions" % self.path)
+        return module
+
+    def up(self, cursor):
+        self._module().up(cursor)
+
+    def down(self, cursor):
+        self._module().down(cursor)
+
+MIGRATION_TYPES = {'sql': Migration, 'py': PythonMigration}
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    migrations = []
+    for filename in sorted(os.listdir(directory)):
+        match = re.match(r'^(\d+)_(\w+)\.(sql|py)$', filename)
+        if match:
+            migration_type = MIGRATION_TYPES[match.group(3)]
+            migrations.append(migration_type(int(match.group(1)), match.group(2),
+                                             os.path.join(directory, filename)))
+    versions = [m.version for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError("duplicate migration versions in %s" % directory)
+    return migrations
+
+def ensure_version_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+      version INTEGER NOT NULL,
+      name VARCHAR(150) NOT NULL,
+      applied_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+      PRIMARY KEY (version)
+    );
+    """)
+    conn.commit()
+    cursor.close()
+
+def applied_versions(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT version FROM schema_migrations ORDER BY version;")
+    versions = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return versions
+
+#--------------------------------------------------------
+# Applies every pending migration up to `target`        |
+#--------------------------------------------------------
+def migrate_up(conn, target=None, out=sys.stdout):
+    ensure_version_table(conn)
+    done = set(applied_versions(conn))
+    for migration in load_migrations():
+        if migration.version in done:
+            continue
+        if target is not None and migration.version > target:
+            break
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+            # Another process may have applied it while we waited for the lock
+            cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s;",
+                           (migration.version,))
+            if cursor.fetchone():
+                conn.rollback()
+                continue
+            migration.up(cursor)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s);",
+                           (migration.version, migration.name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        print("applied %04d_%s" % (migration.version, migration.name), file=out)
+
+#--------------------------------------------------------
+# Reverts applied migrations, newest first, until only  |
+# versions <= target remain (or `steps` were reverted)  |
+#--------------------------------------------------------
+def migrate_down(conn, target=None, steps=1, out=sys.stdout):
+    ensure_version_table(conn)
+    done = set(applied_versions(conn))
+    applied = [m for m in reversed(load_migrations()) if m.version in done]
+    if target is not None:
+        applied = [m for m in applied if m.version > target]
+    else:
+        applied = applied[:steps]
+
+    for migration in applied:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (LOCK_KEY,))
+            migration.down(cursor)
+            cursor.execute("DELETE FROM schema_migrations WHERE version = %s;",
+                           (migration.version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+        print("reverted %04d_%s" % (migration.version, migration.name), file=out)
+
+def status(conn, out=sys.stdout):
+    ensure_version_table(conn)
+    done = set(applied_versions(conn))
+    for migration in load_migrations():
+        state = "applied" if migration.version in done else "pending"
+        print("%04d_%-40s %s" % (migration.version, migration.name, state), file=out)
+
+#--------------------------------------------------------
+# EXPLAIN report.                                       |
+#                                                       |
+# Runs EXPLAIN on the query behind each endpoint with a |
+# sample author/category/quote taken from the database  |
+# and lists the scans used. Sequential scans on Quotes, |
+# Authors or Categories are flagged, --strict makes the |
+# command fail on them so CI can catch plan regressions.|
+#--------------------------------------------------------
+WATCHED_TABLES = {'quotes', 'authors', 'categories'}
+
+def _sample_params(cursor):
+    cursor.execute("""
+    SELECT Quotes.ID, Quotes.text, Authors.ID, Authors.name, Categories.ID, Categories.name
+    FROM Quotes
+    JOIN Authors ON Quotes.authorID = Authors.ID
+    JOIN Categories ON Quotes.categoryID = Categories.ID
+    LIMIT 1;
+    """)
+    row = cursor.fetchone()
+    if not row:
+        return {'quote_id': 1, 'text': '', 'author_id': 1, 'author': '',
+                'category_id': 1, 'category': ''}
+    keys = ['quote_id', 'text', 'author_id', 'author', 'category_id', 'category']
+    return dict(zip(keys, row))
+
+def endpoint_queries(sample):
+    limit = 5
+    # First pages, with the total count, as the list routes run them by default
+    first_name = ('', 0, limit + 1, True)
+    first_id = (0, limit + 1, True)
+    # The longest word of the sample quote as a search term
+    search = max(re.findall(r'\w+', sample['text']) or ['quote'], key=len)
+    return [
+        ('GET /quotes/random', queries.QUOTES_BY_IDS, ([sample['quote_id']],)),
+        ('GET /quotes/<id>', queries.QUOTE_BY_ID, (sample['quote_id'],)),
+        ('GET /authors', 'authors_page', first_name),
+        ('GET /quotes/author/<name>', 'quotes_by_author_name', (sample['author'],) + first_id),
+        ('GET /quotes/author/<id>', 'quotes_by_author_id', (sample['author_id'],) + first_id),
+        ('GET /quotes/category/<name>', 'quotes_by_category_name', (sample['category'],) + first_id),
+        ('GET /quotes/category/<id>', 'quotes_by_category_id', (sample['category_id'],) + first_id),
+        ('GET /categories', 'categories_page', first_name),
+        ('GET /quotes/search',) + queries.search_quotes(search, limit + 1),
+        ('GET /quotes/export',) + queries.export_quotes(sample['author']),
+        ('GET /stats (totals)', queries.QUOTE_TOTALS, ()),
+        ('GET /stats (top authors)', queries.TOP_AUTHORS, (10,)),
+        ('GET /stats (top categories)', queries.TOP_CATEGORIES, (10,)),
+        ('GET /quotes/tickets/<ticket>', ingest.TICKET_STATUS, ('',)),
+        ('POST /quotes (duplicate check)', queries.QUOTE_ID_BY_FINGERPRINT,
+         (dedupe.fingerprint(sample['text']),)),
+        ('POST /quotes (author lookup)', queries.AUTHOR_ID_BY_NAME, (sample['author'],)),
+        ('POST /quotes (category lookup)', queries.CATEGORY_ID_BY_NAME, (sample['category'],)),
+    ]
+
+def _scans(plan, found):
+    node = plan.get('Node Type', '')
+    if 'Scan' in node:
+        found.append({
+            'node': node,
+            'relation': plan.get('Relation Name'),
+            'index': plan.get('Index Name'),
+        })
+    for child in plan.get('Plans', []):
+        _scans(child, found)
+    return found
+
+def explain_report(conn):
+    cursor = conn.cursor()
+    sample = _sample_params(cursor)
+    report = []
+    for endpoint, query, params in endpoint_queries(sample):
+        if query in queries.STATEMENTS:
+            types, statement = queries.STATEMENTS[query]
+            cursor.execute("DEALLOCATE ALL;")
+            cursor.execute("PREPARE %s %s AS %s;" % (query, types, statement))
+            query = "EXECUTE %s (%s);" % (query, ", ".join(["%s"] * len(params)))
+        cursor.execute("EXPLAIN (FORMAT JSON) " + query, params)
+        plan = cursor.fetchone()[0][0]['Plan']
+        scans = _scans(plan, [])
+        seq_scans = [s['relation'] for s in scans
+                     if s['node'] == 'Seq Scan' and (s['relation'] or '').lower() in WATCHED_TABLES]
+        report.append({
+            'endpoint': endpoint,
+            'total_cost': plan.get('Total Cost'),
+            'scans': scans,
+            'seq_scans': seq_scans,
+        })
+    cursor.execute("DEALLOCATE ALL;")
+    conn.rollback()
+    cursor.close()
+    return report
+
+def print_report(report, out=sys.stdout):
+    for entry in report:
+        flag = "SEQ SCAN on %s" % ", ".join(entry['seq_scans']) if entry['seq_scans'] else "ok"
+        print("%-34s cost=%-10s %s" % (entry['endpoint'], entry['total_cost'], flag), file=out)
+        for scan in entry['scans']:
+            target = scan['index'] or scan['relation'] or ''
+            print("    %s %s" % (scan['node'], target), file=out)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Quotes API schema migrations")
+    parser.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                        help="connection string (default: $CONNECTION_STRING)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    up = commands.add_parser('up', help="apply pending migrations")
+    up.add_argument('--to', type=int, help="stop after this version")
+
+    down = commands.add_parser('down', help="revert migrations")
+    down.add_argument('--to', type=int, help="revert everything above this version")
+    down.add_argument('--steps', type=int, default=1, help="number of migrations to revert")
+
+    commands.add_parser('status', help="list migrations and whether they are applied")
+
+    explain = commands.add_parser('explain', help="EXPLAIN the query behind each endpoint")
+    explain.add_argument('--json', action='store_true', help="print the report as JSON")
+    explain.add_argument('--strict', action='store_true',
+                         help="exit with status 1 if any query scans a whole table")
+
+    args = parser.parse_args(argv)
+    if not args.dsn:
+        parser.error("no connection string, set CONNECTION_STRING or pass --dsn")
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        if args.command == 'up':
+            migrate_up(conn, args.to)
+        elif args.command == 'down':
+            migrate_down(conn, args.to, args.steps)
+        elif args.command == 'status':
+            status(conn)
+        elif args.command == 'explain':
+            report = explain_report(conn)
+            if args.json:
+                print(json.dumps(report, indent=2))
+            else:
+                print_report(report)
+            if args.strict and any(entry['seq_scans'] for entry in report):
+                return 1
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,9 @@
+-- Indexes on the foreign keys used by the per author and
+-- per category quote listings
+-- migrate:up
+CREATE INDEX IF NOT EXISTS quotes_authorid_idx ON Quotes (authorID);
+CREATE INDEX IF NOT EXISTS quotes_categoryid_idx ON Quotes (categoryID);
+
+-- migrate:down
+DROP INDEX IF EXISTS quotes_categoryid_idx;
+DROP INDEX IF EXISTS quotes_authorid_idx;
@@ -0,0 +1,36 @@
+-- Case-insensitive unique author and category names.
+-- Existing duplicates (same name, different case) are merged
+-- into the row with the lowest ID before the indexes are built.
+-- migrate:up
+UPDATE Quotes SET authorID = keep.id
+FROM Authors dup
+JOIN (SELECT lower(name) AS lname, MIN(id) AS id FROM Authors GROUP BY lower(name)) keep
+  ON lower(dup.name) = keep.lname
+WHERE Quotes.authorID = dup.id AND dup.id <> keep.id;
+
+DELETE FROM Authors dup
+USING Authors keep
+WHERE lower(dup.name) = lower(keep.name) AND dup.id > keep.id;
+
+UPDATE Quotes SET categoryID = keep.id
+FROM Categories dup
+JOIN (SELECT lower(name) AS lname, MIN(id) AS id FROM Categories GROUP BY lower(name)) keep
+  ON lower(dup.name) = keep.lname
+WHERE Quotes.categoryID = dup.id AND dup.id <> keep.id;
+
+DELETE FROM Categories dup
+USING Categories keep
+WHERE lower(dup.name) = lower(keep.name) AND dup.id > keep.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS authors_lower_name_key ON Authors (lower(name));
+CREATE UNIQUE INDEX IF NOT EXISTS categories_lower_name_key ON Categories (lower(name));
+
+-- Ordered listings for /authors and /categories
+CREATE INDEX IF NOT EXISTS authors_name_idx ON Authors (name);
+CREATE INDEX IF NOT EXISTS categories_name_idx ON Categories (name);
+
+-- migrate:down
+DROP INDEX IF EXISTS categories_name_idx;
+DROP INDEX IF EXISTS authors_name_idx;
+DROP INDEX IF EXISTS categories_lower_name_key;
+DROP INDEX IF EXISTS authors_lower_name_key;
@@ -0,0 +1,7 @@
+-- Hash index for the duplicate check done before inserting a quote.
+-- The text itself can exceed the btree row size limit, its md5 can not.
+-- migrate:up
+CREATE INDEX IF NOT EXISTS quotes_text_md5_idx ON Quotes (md5(lower(text)));
+
+-- migrate:down
+DROP INDEX IF EXISTS quotes_text_md5_idx;
@@ -0,0 +1,24 @@
+-- Composite indexes for keyset pagination: /authors and /categories
+-- page over (name, id), the per author and per category quote
+-- listings over id. They replace the single column indexes.
+-- migrate:up
+CREATE INDEX IF NOT EXISTS authors_name_id_idx ON Authors (name, id);
+CREATE INDEX IF NOT EXISTS categories_name_id_idx ON Categories (name, id);
+CREATE INDEX IF NOT EXISTS quotes_authorid_id_idx ON Quotes (authorID, id);
+CREATE INDEX IF NOT EXISTS quotes_categoryid_id_idx ON Quotes (categoryID, id);
+
+DROP INDEX IF EXISTS authors_name_idx;
+DROP INDEX IF EXISTS categories_name_idx;
+DROP INDEX IF EXISTS quotes_authorid_idx;
+DROP INDEX IF EXISTS quotes_categoryid_idx;
+
+-- migrate:down
+CREATE INDEX IF NOT EXISTS quotes_authorid_idx ON Quotes (authorID);
+CREATE INDEX IF NOT EXISTS quotes_categoryid_idx ON Quotes (categoryID);
+CREATE INDEX IF NOT EXISTS authors_name_idx ON Authors (name);
+CREATE INDEX IF NOT EXISTS categories_name_idx ON Categories (name);
+
+DROP INDEX IF EXISTS quotes_categoryid_id_idx;
+DROP INDEX IF EXISTS quotes_authorid_id_idx;
+DROP INDEX IF EXISTS categories_name_id_idx;
+DROP INDEX IF EXISTS authors_name_id_idx;
@@ -0,0 +1,11 @@
+-- Full-text search over the quote text for /quotes/search.
+-- The tsvector is a generated column, so every insert and update
+-- (single, batch, bulk import) keeps it and the GIN index current.
+-- migrate:up
+ALTER TABLE Quotes ADD COLUMN IF NOT EXISTS search tsvector
+  GENERATED ALWAYS AS (to_tsvector('english', text)) STORED;
+CREATE INDEX IF NOT EXISTS quotes_search_idx ON Quotes USING GIN (search);
+
+-- migrate:down
+DROP INDEX IF EXISTS quotes_search_idx;
+ALTER TABLE Quotes DROP COLUMN IF EXISTS search;
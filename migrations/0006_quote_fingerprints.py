@@ -0,0 +1,48 @@
+# Normalized text fingerprints for the duplicate checks (see dedupe.py).
+# The fingerprint is computed in Python, so existing quotes are backfilled
+# here page by page. When stored quotes already normalize to the same text,
+# only the oldest gets the fingerprint and the others keep NULL, which the
+# unique index allows. The md5(lower(text)) index of 0003 is no longer used.
+import dedupe
+
+PAGE_SIZE = 10000
+
+def up(cursor):
+    cursor.execute("ALTER TABLE Quotes ADD COLUMN IF NOT EXISTS fingerprint BYTEA;")
+    cursor.execute("""
+    CREATE TEMP TABLE IF NOT EXISTS quote_fingerprints (
+      id INTEGER NOT NULL,
+      fingerprint BYTEA NOT NULL
+    ) ON COMMIT DROP;
+    """)
+
+    last = 0
+    while True:
+        cursor.execute("SELECT ID, text FROM Quotes WHERE ID > %s ORDER BY ID LIMIT %s;",
+                       (last, PAGE_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.execute("""
+        INSERT INTO quote_fingerprints (id, fingerprint)
+        SELECT * FROM unnest(%s::integer[], %s::bytea[]);
+        """, ([row[0] for row in rows], [dedupe.fingerprint(row[1]) for row in rows]))
+        last = rows[-1][0]
+
+    cursor.execute("""
+    UPDATE Quotes SET fingerprint = first.fingerprint
+    FROM (
+        SELECT DISTINCT ON (fingerprint) id, fingerprint
+        FROM quote_fingerprints
+        WHERE NOT EXISTS (SELECT 1 FROM Quotes WHERE Quotes.fingerprint = quote_fingerprints.fingerprint)
+        ORDER BY fingerprint, id
+    ) AS first
+    WHERE Quotes.ID = first.id AND Quotes.fingerprint IS NULL;
+    """)
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS quotes_fingerprint_key ON Quotes (fingerprint);")
+    cursor.execute("DROP INDEX IF EXISTS quotes_text_md5_idx;")
+
+def down(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS quotes_text_md5_idx ON Quotes (md5(lower(text)));")
+    cursor.execute("DROP INDEX IF EXISTS quotes_fingerprint_key;")
+    cursor.execute("ALTER TABLE Quotes DROP COLUMN IF EXISTS fingerprint;")
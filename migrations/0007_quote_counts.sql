@@ -0,0 +1,118 @@
+-- Quote counts per author and category and the totals of quotes,
+-- authors and categories, read by the list endpoints instead of a
+-- COUNT(*) and by /stats. Statement-level triggers keep them in the
+-- writing transaction for every insert, update (an author or category
+-- change moves the count) and delete, single, batch or bulk import.
+-- Changes are applied in (scope, id) order so concurrent writers take
+-- the row locks in the same order. counts.py checks and repairs drift.
+-- migrate:up
+CREATE TABLE IF NOT EXISTS quote_counts (
+  scope TEXT NOT NULL,      -- 'author', 'category', or 'quotes'/'authors'/'categories' totals
+  id INTEGER NOT NULL,      -- author/category ID, 0 for the totals
+  count BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (scope, id)
+);
+CREATE INDEX IF NOT EXISTS quote_counts_top_idx ON quote_counts (scope, count DESC, id);
+
+CREATE OR REPLACE FUNCTION quote_counts_apply(old_authors INTEGER[], old_categories INTEGER[],
+                                              new_authors INTEGER[], new_categories INTEGER[])
+RETURNS void LANGUAGE sql AS $$
+  INSERT INTO quote_counts (scope, id, count)
+  SELECT scope, id, SUM(delta) FROM (
+    SELECT 'author' AS scope, author AS id, -1 AS delta FROM unnest(old_authors) AS author
+    UNION ALL SELECT 'category', category, -1 FROM unnest(old_categories) AS category
+    UNION ALL SELECT 'quotes', 0, -1 FROM unnest(old_authors)
+    UNION ALL SELECT 'author', author, 1 FROM unnest(new_authors) AS author
+    UNION ALL SELECT 'category', category, 1 FROM unnest(new_categories) AS category
+    UNION ALL SELECT 'quotes', 0, 1 FROM unnest(new_authors)
+  ) AS changes
+  GROUP BY scope, id
+  HAVING SUM(delta) <> 0
+  ORDER BY scope, id
+  ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+$$;
+
+CREATE OR REPLACE FUNCTION quote_counts_quotes() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM quote_counts_apply('{}', '{}',
+                               ARRAY(SELECT authorID FROM new_rows),
+                               ARRAY(SELECT categoryID FROM new_rows));
+  ELSIF TG_OP = 'UPDATE' THEN
+    PERFORM quote_counts_apply(ARRAY(SELECT authorID FROM old_rows),
+                               ARRAY(SELECT categoryID FROM old_rows),
+                               ARRAY(SELECT authorID FROM new_rows),
+                               ARRAY(SELECT categoryID FROM new_rows));
+  ELSE
+    PERFORM quote_counts_apply(ARRAY(SELECT authorID FROM old_rows),
+                               ARRAY(SELECT categoryID FROM old_rows), '{}', '{}');
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+-- TG_ARGV[0] is the total to change, 'authors' or 'categories'
+CREATE OR REPLACE FUNCTION quote_counts_names() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  INSERT INTO quote_counts (scope, id, count)
+  SELECT TG_ARGV[0], 0, CASE WHEN TG_OP = 'INSERT' THEN COUNT(*) ELSE -COUNT(*) END
+  FROM changed_rows
+  HAVING COUNT(*) > 0
+  ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS quote_counts_insert ON Quotes;
+CREATE TRIGGER quote_counts_insert AFTER INSERT ON Quotes
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_quotes();
+DROP TRIGGER IF EXISTS quote_counts_update ON Quotes;
+CREATE TRIGGER quote_counts_update AFTER UPDATE ON Quotes
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_quotes();
+DROP TRIGGER IF EXISTS quote_counts_delete ON Quotes;
+CREATE TRIGGER quote_counts_delete AFTER DELETE ON Quotes
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_quotes();
+
+DROP TRIGGER IF EXISTS quote_counts_insert ON Authors;
+CREATE TRIGGER quote_counts_insert AFTER INSERT ON Authors
+  REFERENCING NEW TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_names('authors');
+DROP TRIGGER IF EXISTS quote_counts_delete ON Authors;
+CREATE TRIGGER quote_counts_delete AFTER DELETE ON Authors
+  REFERENCING OLD TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_names('authors');
+
+DROP TRIGGER IF EXISTS quote_counts_insert ON Categories;
+CREATE TRIGGER quote_counts_insert AFTER INSERT ON Categories
+  REFERENCING NEW TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_names('categories');
+DROP TRIGGER IF EXISTS quote_counts_delete ON Categories;
+CREATE TRIGGER quote_counts_delete AFTER DELETE ON Categories
+  REFERENCING OLD TABLE AS changed_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION quote_counts_names('categories');
+
+-- The triggers' locks keep writers out until this commits, so the backfill
+-- and the triggers start from the same data
+TRUNCATE quote_counts;
+INSERT INTO quote_counts (scope, id, count)
+SELECT 'author', authorID, COUNT(*) FROM Quotes GROUP BY authorID
+UNION ALL SELECT 'category', categoryID, COUNT(*) FROM Quotes GROUP BY categoryID
+UNION ALL SELECT 'quotes', 0, COUNT(*) FROM Quotes
+UNION ALL SELECT 'authors', 0, COUNT(*) FROM Authors
+UNION ALL SELECT 'categories', 0, COUNT(*) FROM Categories;
+
+-- migrate:down
+DROP TRIGGER IF EXISTS quote_counts_insert ON Quotes;
+DROP TRIGGER IF EXISTS quote_counts_update ON Quotes;
+DROP TRIGGER IF EXISTS quote_counts_delete ON Quotes;
+DROP TRIGGER IF EXISTS quote_counts_insert ON Authors;
+DROP TRIGGER IF EXISTS quote_counts_delete ON Authors;
+DROP TRIGGER IF EXISTS quote_counts_insert ON Categories;
+DROP TRIGGER IF EXISTS quote_counts_delete ON Categories;
+DROP FUNCTION IF EXISTS quote_counts_quotes();
+DROP FUNCTION IF EXISTS quote_counts_names();
+DROP FUNCTION IF EXISTS quote_counts_apply(INTEGER[], INTEGER[], INTEGER[], INTEGER[]);
+DROP TABLE IF EXISTS quote_counts;
@@ -0,0 +1,15 @@
+-- Outcomes of quotes accepted with 202 by the write-behind queue (see ingest.py).
+-- A ticket's row is written in the transaction that commits its quote, so a
+-- journal replayed after a crash skips the tickets that made it.
+-- migrate:up
+CREATE TABLE IF NOT EXISTS ingest_tickets (
+  ticket TEXT NOT NULL PRIMARY KEY,
+  status TEXT NOT NULL,            -- created, duplicate, invalid or failed
+  result JSONB NOT NULL,
+  queued_at TIMESTAMPTZ NOT NULL,
+  committed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS ingest_tickets_committed_at_idx ON ingest_tickets (committed_at);
+
+-- migrate:down
+DROP TABLE IF EXISTS ingest_tickets;
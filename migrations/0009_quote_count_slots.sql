@@ -0,0 +1,75 @@
+-- Spreads the quotes/authors/categories totals of quote_counts over 16 rows
+-- (id 0 to 15, picked by pg_backend_pid()), read back with SUM. With a single
+-- totals row every transaction writing a quote held the same row lock until
+-- commit, so writers of unrelated authors and categories waited for each other.
+-- The existing totals stay in row 0.
+-- migrate:up
+CREATE OR REPLACE FUNCTION quote_counts_apply(old_authors INTEGER[], old_categories INTEGER[],
+                                              new_authors INTEGER[], new_categories INTEGER[])
+RETURNS void LANGUAGE sql AS $$
+  INSERT INTO quote_counts (scope, id, count)
+  SELECT scope, id, SUM(delta) FROM (
+    SELECT 'author' AS scope, author AS id, -1 AS delta FROM unnest(old_authors) AS author
+    UNION ALL SELECT 'category', category, -1 FROM unnest(old_categories) AS category
+    UNION ALL SELECT 'quotes', pg_backend_pid() % 16, -1 FROM unnest(old_authors)
+    UNION ALL SELECT 'author', author, 1 FROM unnest(new_authors) AS author
+    UNION ALL SELECT 'category', category, 1 FROM unnest(new_categories) AS category
+    UNION ALL SELECT 'quotes', pg_backend_pid() % 16, 1 FROM unnest(new_authors)
+  ) AS changes
+  GROUP BY scope, id
+  HAVING SUM(delta) <> 0
+  ORDER BY scope, id
+  ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+$$;
+
+CREATE OR REPLACE FUNCTION quote_counts_names() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  INSERT INTO quote_counts (scope, id, count)
+  SELECT TG_ARGV[0], pg_backend_pid() % 16,
+         CASE WHEN TG_OP = 'INSERT' THEN COUNT(*) ELSE -COUNT(*) END
+  FROM changed_rows
+  HAVING COUNT(*) > 0
+  ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+  RETURN NULL;
+END;
+$$;
+
+-- migrate:down
+CREATE OR REPLACE FUNCTION quote_counts_apply(old_authors INTEGER[], old_categories INTEGER[],
+                                              new_authors INTEGER[], new_categories INTEGER[])
+RETURNS void LANGUAGE sql AS $$
+  INSERT INTO quote_counts (scope, id, count)
+  SELECT scope, id, SUM(delta) FROM (
+    SELECT 'author' AS scope, author AS id, -1 AS delta FROM unnest(old_authors) AS author
+    UNION ALL SELECT 'category', category, -1 FROM unnest(old_categories) AS category
+    UNION ALL SELECT 'quotes', 0, -1 FROM unnest(old_authors)
+    UNION ALL SELECT 'author', author, 1 FROM unnest(new_authors) AS author
+    UNION ALL SELECT 'category', category, 1 FROM unnest(new_categories) AS category
+    UNION ALL SELECT 'quotes', 0, 1 FROM unnest(new_authors)
+  ) AS changes
+  GROUP BY scope, id
+  HAVING SUM(delta) <> 0
+  ORDER BY scope, id
+  ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+$$;
+
+CREATE OR REPLACE FUNCTION quote_counts_names() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  INSERT INTO quote_counts (scope, id, count)
+  SELECT TG_ARGV[0], 0, CASE WHEN TG_OP = 'INSERT' THEN COUNT(*) ELSE -COUNT(*) END
+  FROM changed_rows
+  HAVING COUNT(*) > 0
+  ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
+  RETURN NULL;
+END;
+$$;
+
+-- Folds the slots back into row 0
+WITH slots AS (
+  DELETE FROM quote_counts
+  WHERE scope IN ('quotes', 'authors', 'categories') AND id <> 0
+  RETURNING scope, count
+)
+INSERT INTO quote_counts (scope, id, count)
+SELECT scope, 0, SUM(count) FROM slots GROUP BY scope
+ON CONFLICT (scope, id) DO UPDATE SET count = quote_counts.count + EXCLUDED.count;
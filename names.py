@@ -0,0 +1,174 @@
+import sys
+import threading
+from concurrent.futures import Future
+
+import queries
+from queries import Query, Commit, Wait
+
+#--------------------------------------------------------
+# Author/category name to ID resolution for the writes. |
+#                                                       |
+# Every name is kept in a case-insensitive map, loaded  |
+# on first use and written through as names are added,  |
+# so resolving a known name costs no query. A miss is   |
+# one upsert on the lower(name) unique index (migration |
+# 0002), committed right away so the map only ever      |
+# holds committed IDs. Requests missing on the same     |
+# name at the same time wait for the first one's upsert |
+# instead of running their own.                         |
+#                                                       |
+# With a shared catalog (see catalog.py) names are      |
+# looked up there and the map isn't loaded, it only     |
+# keeps the names added by this worker, which resolve   |
+# from it until the catalog has them. Names the catalog |
+# lacks are queued for it once committed.               |
+#--------------------------------------------------------
+
+# Seconds a request waits for another one's upsert of the same name
+WAIT_TIMEOUT = 10.0
+
+class NameResolver:
+    PAGE_SIZE = 100000
+
+    def __init__(self, table, list_tag, upsert, catalog=None):
+        self.table = table
+        self.list_tag = list_tag
+        self._upsert = upsert
+        self.catalog = catalog
+        self._ids = {}
+        self._inflight = {}
+        self._loaded = False
+        self._loading = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    #--------------------------------------------------------
+    # Loads every name in pages along the primary key. A    |
+    # handler step (see queries.py), run with `yield from`. |
+    # Requests arriving during the load resolve through the |
+    # database until it is done.                            |
+    #--------------------------------------------------------
+    def load(self):
+        with self._lock:
+            if self._loaded or self._loading:
+                return
+            self._loading = True
+
+        try:
+            ids = {}
+            last = 0
+            while True:
+                rows = yield Query("SELECT ID, name FROM %s WHERE ID > %%s ORDER BY ID LIMIT %%s;"
+                                   % self.table, (last, self.PAGE_SIZE))
+                for name_id, name in rows:
+                    ids.setdefault(sys.intern(name.lower()), name_id)
+                if len(rows) < self.PAGE_SIZE:
+                    break
+                last = rows[-1][0]
+        finally:
+            with self._lock:
+                self._loading = False
+
+        with self._lock:
+            # Names added while loading are already in the map
+            ids.update(self._ids)
+            self._ids = ids
+            self._loaded = True
+
+    #--------------------------------------------------------
+    # Returns the ID of `name`, adding it if it doesn't     |
+    # exist, and whether this call added it. A handler step |
+    #--------------------------------------------------------
+    def resolve(self, name):
+        if self.catalog is None:
+            yield from self.load()
+        else:
+            name_id = self.catalog.id_for_name(self.list_tag, name)
+            if name_id is not None:
+                self.hits += 1
+                return name_id, False
+        key = name.lower()
+        with self._lock:
+            name_id = self._ids.get(key)
+            if name_id is not None:
+                self.hits += 1
+                return name_id, False
+            self.misses += 1
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            name_id, _ = yield Wait(future, WAIT_TIMEOUT)
+            return name_id, False
+
+        try:
+            name_id, created = yield Query(self._upsert, (name,), fetch='one')
+            yield Commit()
+        except BaseException as error:
+            if not future.done():
+                future.set_exception(error if isinstance(error, Exception) else
+                                     RuntimeError("name lookup abandoned"))
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+        self.remember(name, name_id)
+        if self.catalog is not None:
+            self.catalog.publish({self.list_tag: [(name_id, name)]})
+        # Cancelled futures are done too, the upsert is committed either way
+        if not future.done():
+            future.set_result((name_id, created))
+        return name_id, created
+
+    #--------------------------------------------------------
+    # Records a committed name, e.g. from a batch insert    |
+    #--------------------------------------------------------
+    def remember(self, name, name_id):
+        with self._lock:
+            self._ids.setdefault(sys.intern(name.lower()), name_id)
+
+    def stats(self):
+        return {"names": len(self._ids), "loaded": self._loaded, "hits": self.hits,
+                "misses": self.misses, "coalesced": self.coalesced}
+
+#--------------------------------------------------------
+# The resolvers of the app, one per table               |
+#--------------------------------------------------------
+class Names:
+    def __init__(self, catalog=None):
+        self.catalog = catalog
+        self.authors = NameResolver('Authors', 'authors', queries.UPSERT_AUTHOR, catalog)
+        self.categories = NameResolver('Categories', 'categories', queries.UPSERT_CATEGORY,
+                                       catalog)
+
+    #--------------------------------------------------------
+    # Records the names of committed quotes, (author ID,    |
+    # author, category ID, category) rows, in both maps and |
+    # the catalog                                           |
+    #--------------------------------------------------------
+    def remember(self, rows):
+        for author_id, author_name, category_id, category_name in rows:
+            self.authors.remember(author_name, author_id)
+            self.categories.remember(category_name, category_id)
+        if self.catalog is not None and rows:
+            self.catalog.publish({
+                'authors': [(author_id, author_name) for author_id, author_name, _, _ in rows],
+                'categories': [(category_id, category_name)
+                               for _, _, category_id, category_name in rows],
+            })
+
+    def stats(self):
+        stats = {"authors": self.authors.stats(), "categories": self.categories.stats()}
+        if self.catalog is not None:
+            stats["catalog"] = self.catalog.stats()
+        return stats
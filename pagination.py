@@ -0,0 +1,105 @@
+import base64
+import binascii
+import json
+from urllib.parse import quote, urlencode
+
+#--------------------------------------------------------
+# Keyset pagination for the list routes.                |
+#                                                       |
+# A page is read from the position of a key instead of  |
+# an OFFSET: (name, ID) for /authors and /categories,   |
+# the quote ID for the per author/category listings.    |
+# The cursor handed out in the next/prev links is that  |
+# key plus the direction, base64 encoded, so fetching   |
+# page 1000 costs the same as page 1. Clients should    |
+# treat it as opaque.                                   |
+#--------------------------------------------------------
+class CursorError(ValueError):
+    pass
+
+# Keys before every real row, used for the first page
+FIRST_NAME_KEY = ('', 0)
+FIRST_ID_KEY = (0,)
+
+# IDs are INTEGER columns
+MAX_ID = 2 ** 31 - 1
+
+def encode_cursor(direction, key):
+    raw = json.dumps([direction] + list(key), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+#--------------------------------------------------------
+# Returns (direction, key) where direction is 'next' or |
+# 'prev', raises CursorError for anything else          |
+#--------------------------------------------------------
+def decode_cursor(cursor, key_types):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value = json.loads(raw)
+    except (binascii.Error, ValueError):
+        raise CursorError("invalid cursor")
+
+    if not isinstance(value, list) or len(value) != len(key_types) + 1:
+        raise CursorError("invalid cursor")
+    direction, key = value[0], tuple(value[1:])
+    if direction not in ('next', 'prev'):
+        raise CursorError("invalid cursor")
+    # bool is an int, but never a valid key part
+    if any(type(part) is not kind for part, kind in zip(key, key_types)):
+        raise CursorError("invalid cursor")
+    if any(type(part) is int and not 0 <= part <= MAX_ID for part in key):
+        raise CursorError("invalid cursor")
+    return direction, key
+
+def parse_bool(value, default):
+    if value is None:
+        return default
+    return value.lower() not in ('0', 'false', 'no', 'off')
+
+#--------------------------------------------------------
+# The paging arguments of a list request: limit, cursor |
+# and count (count=false skips the total). `args` are   |
+# the query string pairs, used to build the links.      |
+#--------------------------------------------------------
+class Page:
+    def __init__(self, path, args, limit):
+        args = list(args)
+        self.path = path
+        self.args = [(name, value) for name, value in args if name != 'cursor']
+        self.limit = limit
+        self.cursor = None
+        self.with_count = True
+        for name, value in args:
+            if name == 'cursor' and value:
+                self.cursor = value
+            elif name == 'count':
+                self.with_count = parse_bool(value, True)
+
+    #--------------------------------------------------------
+    # Returns (backwards, key) for the query, raises        |
+    # CursorError if the cursor can't be decoded. The key   |
+    # must have the same shape as first_key.                |
+    #--------------------------------------------------------
+    def position(self, first_key):
+        if self.cursor is None:
+            return False, first_key
+        direction, key = decode_cursor(self.cursor, [type(part) for part in first_key])
+        return direction == 'prev', key
+
+    def link(self, direction, key):
+        args = self.args + [('cursor', encode_cursor(direction, key))]
+        return quote(self.path) + '?' + urlencode(args)
+
+    #--------------------------------------------------------
+    # Returns the (next, prev) links for a page of `keys`,  |
+    # in display order. The query fetched one row more than |
+    # the limit, `more` says whether it found it.           |
+    #--------------------------------------------------------
+    def links(self, keys, backwards, more):
+        if not keys:
+            return None, None
+        has_next = more if not backwards else True
+        has_prev = more if backwards else self.cursor is not None
+        next_link = self.link('next', keys[-1]) if has_next else None
+        prev_link = self.link('prev', keys[0]) if has_prev else None
+        return next_link, prev_link
@@ -0,0 +1,421 @@
+import re
+
+import psycopg2
+import psycopg2.errors
+
+from fields import QUOTE_FIELDS, SEARCH_FIELDS
+
+#--------------------------------------------------------
+# Queries run directly by the routes and helpers. Name  |
+# lookups compare lower(name) and duplicate checks      |
+# compare the fingerprint of the text (see dedupe.py)   |
+# so they can use the indexes added by the migrations   |
+# in migrations/.                                       |
+#--------------------------------------------------------
+QUOTE_BY_ID = """
+SELECT Quotes.text, Authors.name, Categories.name
+FROM Quotes
+JOIN Authors ON Quotes.authorID = Authors.ID
+JOIN Categories ON Quotes.categoryID = Categories.ID
+WHERE Quotes.ID = %s;
+"""
+
+QUOTES_BY_IDS = """
+SELECT Quotes.ID, Quotes.text, Authors.name, Categories.name
+FROM Quotes
+JOIN Authors ON Quotes.authorID = Authors.ID
+JOIN Categories ON Quotes.categoryID = Categories.ID
+WHERE Quotes.ID = ANY(%s);
+"""
+
+#--------------------------------------------------------
+# Sparse fieldsets (see fields.py). The author and      |
+# category of a quote cost a join each, queries taking  |
+# `fields` only make the joins of the fields asked for  |
+# and select NULL for the others, so their rows keep    |
+# the same shape.                                       |
+#--------------------------------------------------------
+QUOTES_FIELDS_BY_IDS = """
+SELECT Quotes.ID, Quotes.text, {author}, {category}
+FROM Quotes{joins}
+WHERE Quotes.ID = ANY(%s);
+"""
+
+def _name_columns(table, fields):
+    author, category = 'author' in fields, 'category' in fields
+    return {
+        'author': "Authors.name" if author else "NULL",
+        'category': "Categories.name" if category else "NULL",
+        'joins': ("\nJOIN Authors ON %s.authorID = Authors.ID" % table if author else "") +
+                 ("\nJOIN Categories ON %s.categoryID = Categories.ID" % table if category else ""),
+    }
+
+# QUOTES_BY_IDS for `fields`
+def quotes_by_ids(fields):
+    if 'author' in fields and 'category' in fields:
+        return QUOTES_BY_IDS
+    return QUOTES_FIELDS_BY_IDS.format(**_name_columns('Quotes', fields))
+
+AUTHOR_ID_BY_NAME = "SELECT ID FROM Authors WHERE lower(name) = lower(%s);"
+
+CATEGORY_ID_BY_NAME = "SELECT ID FROM Categories WHERE lower(name) = lower(%s);"
+
+# Race-free name inserts on the lower(name) unique indexes, used by names.py. The
+# no-op update locks and returns the row when the name already exists (even if
+# another transaction just added it); xmax = 0 tells whether this one inserted it.
+UPSERT_AUTHOR = """
+INSERT INTO Authors (name) VALUES (%s)
+ON CONFLICT ((lower(name))) DO UPDATE SET name = Authors.name
+RETURNING ID, xmax = 0;
+"""
+
+UPSERT_CATEGORY = """
+INSERT INTO Categories (name) VALUES (%s)
+ON CONFLICT ((lower(name))) DO UPDATE SET name = Categories.name
+RETURNING ID, xmax = 0;
+"""
+
+QUOTE_ID_BY_FINGERPRINT = "SELECT ID FROM Quotes WHERE fingerprint = %s;"
+
+# Unique index on the fingerprint (migration 0006)
+FINGERPRINT_KEY = 'quotes_fingerprint_key'
+
+#--------------------------------------------------------
+# Whether a psycopg2 or psycopg 3 error is a unique     |
+# violation of `constraint`                             |
+#--------------------------------------------------------
+def unique_violation(error, constraint):
+    code = getattr(error, 'pgcode', None) or getattr(error, 'sqlstate', None)
+    diag = getattr(error, 'diag', None)
+    return code == '23505' and getattr(diag, 'constraint_name', None) == constraint
+
+# Pages of fingerprints, with the texts for the near-duplicate index, loaded by dedupe.py
+QUOTE_FINGERPRINTS_PAGE = "SELECT ID, fingerprint FROM Quotes WHERE ID > %s ORDER BY ID LIMIT %s;"
+
+QUOTE_TEXTS_PAGE = "SELECT ID, fingerprint, text FROM Quotes WHERE ID > %s ORDER BY ID LIMIT %s;"
+
+# Inserts a quote unless one with the same fingerprint exists, then returns nothing
+INSERT_QUOTE = """
+INSERT INTO Quotes (text, authorID, categoryID, fingerprint) VALUES (%s, %s, %s, %s)
+ON CONFLICT (fingerprint) DO NOTHING
+RETURNING ID;
+"""
+
+#--------------------------------------------------------
+# Totals and the authors/categories with the most       |
+# quotes for GET /stats, from quote_counts (see         |
+# migrations/0007_quote_counts.sql). Each total is the  |
+# sum of its rows (migration 0009).                     |
+#--------------------------------------------------------
+QUOTE_TOTALS = """
+SELECT scope, SUM(count)::bigint FROM quote_counts
+WHERE scope IN ('quotes', 'authors', 'categories')
+GROUP BY scope;
+"""
+
+TOP_AUTHORS = """
+SELECT Authors.ID, Authors.name, quote_counts.count
+FROM quote_counts
+JOIN Authors ON Authors.ID = quote_counts.id
+WHERE quote_counts.scope = 'author' AND quote_counts.count > 0
+ORDER BY quote_counts.count DESC, quote_counts.id
+LIMIT %s;
+"""
+
+TOP_CATEGORIES = """
+SELECT Categories.ID, Categories.name, quote_counts.count
+FROM quote_counts
+JOIN Categories ON Categories.ID = quote_counts.id
+WHERE quote_counts.scope = 'category' AND quote_counts.count > 0
+ORDER BY quote_counts.count DESC, quote_counts.id
+LIMIT %s;
+"""
+
+#--------------------------------------------------------
+# Full-text search (GET /quotes/search) over the search |
+# column added by migrations/0005_quote_search.sql.     |
+#                                                       |
+# Matches are ranked with ts_rank and paged by (rank,   |
+# ID) like the other list routes; snippets are only    |
+# built for the rows of the page. The matched terms are |
+# wrapped in SEARCH_START/SEARCH_STOP, private use      |
+# characters the handler turns into markup after        |
+# escaping the text.                                    |
+#--------------------------------------------------------
+SEARCH_START = "\ue000"
+SEARCH_STOP = "\ue001"
+
+SEARCH_QUOTES = """
+WITH query AS (
+    SELECT websearch_to_tsquery('english', %(q)s) AS query
+),
+matches AS (
+    SELECT Quotes.ID, Quotes.text, Quotes.authorID, Quotes.categoryID,
+           ts_rank(Quotes.search, query.query) AS rank
+    FROM Quotes, query
+    WHERE Quotes.search @@ query.query{filters}
+    ORDER BY rank {order}, Quotes.ID {order}
+    LIMIT %(limit)s
+)
+SELECT matches.ID, matches.rank, matches.text, {snippet}, {author}, {category}
+FROM matches
+CROSS JOIN query{joins}
+ORDER BY matches.rank {order}, matches.ID {order};
+"""
+
+SEARCH_SNIPPET = "ts_headline('english', matches.text, query.query, %(headline)s)"
+
+SEARCH_HEADLINE = "StartSel=%s, StopSel=%s, MaxWords=35, MinWords=15, MaxFragments=2" % (
+    SEARCH_START, SEARCH_STOP)
+
+#--------------------------------------------------------
+# Returns the search query and its params. `after` is   |
+# the (rank, ID) key to continue from, results come     |
+# best match first unless `backwards` is set. Snippets  |
+# are only built when `fields` has them.                |
+#--------------------------------------------------------
+def search_quotes(text, limit, author=None, category=None, after=None, backwards=False,
+                  fields=SEARCH_FIELDS):
+    params = {'q': text, 'limit': limit}
+    if 'snippet' in fields:
+        params['headline'] = SEARCH_HEADLINE
+    filters = []
+    if author:
+        filters.append("Quotes.authorID = (SELECT ID FROM Authors WHERE lower(name) = lower(%(author)s))")
+        params['author'] = author
+    if category:
+        filters.append("Quotes.categoryID = "
+                       "(SELECT ID FROM Categories WHERE lower(name) = lower(%(category)s))")
+        params['category'] = category
+    if after is not None:
+        filters.append("(ts_rank(Quotes.search, query.query), Quotes.ID) %s (%%(rank)s::real, %%(id)s)"
+                       % ('>' if backwards else '<'))
+        params['rank'], params['id'] = after
+
+    sql = SEARCH_QUOTES.format(filters="".join("\n      AND " + f for f in filters),
+                               order='ASC' if backwards else 'DESC',
+                               snippet=SEARCH_SNIPPET if 'snippet' in fields else "NULL",
+                               **_name_columns('matches', fields))
+    return sql, params
+
+#--------------------------------------------------------
+# Export of the quotes (GET /quotes/export) in ID order |
+# for a server-side cursor, so it walks the primary key |
+# and can resume after the last ID a client received.   |
+#--------------------------------------------------------
+EXPORT_QUOTES = """
+SELECT Quotes.ID, Quotes.text, {author}, {category}
+FROM Quotes{joins}
+WHERE Quotes.ID > %(after_id)s{filters}
+ORDER BY Quotes.ID
+"""
+
+def export_quotes(author=None, category=None, after_id=0, fields=QUOTE_FIELDS):
+    params = {'after_id': after_id}
+    filters = []
+    if author:
+        filters.append("Quotes.authorID = (SELECT ID FROM Authors WHERE lower(name) = lower(%(author)s))")
+        params['author'] = author
+    if category:
+        filters.append("Quotes.categoryID = "
+                       "(SELECT ID FROM Categories WHERE lower(name) = lower(%(category)s))")
+        params['category'] = category
+    return EXPORT_QUOTES.format(filters="".join("\n  AND " + f for f in filters),
+                                **_name_columns('Quotes', fields)), params
+
+#--------------------------------------------------------
+# Server-side prepared statements for the list routes.  |
+#                                                       |
+# Each statement returns a single row holding the total |
+# count (NULL unless the last parameter is true, read   |
+# from quote_counts, see migrations/0007), the          |
+# resolved author/category name and the page as two     |
+# arrays, values and their IDs, so a request needs one  |
+# EXECUTE. Pages start after the key given in the first |
+# parameters (see pagination.py) and every statement    |
+# has a *_before variant that reads backwards from it.  |
+# Statements are prepared once per pooled connection    |
+# and reused by every request that borrows it.          |
+#--------------------------------------------------------
+NAMES_PAGE = """
+    WITH page AS (
+        SELECT ID, name FROM {table}
+        WHERE (name, ID) {cmp} ($1, $2)
+        ORDER BY name {order}, ID {order}
+        LIMIT $3
+    )
+    SELECT CASE WHEN $4 THEN COALESCE((SELECT SUM(count)::bigint FROM quote_counts
+                                       WHERE scope = '{total}'), 0) END,
+           NULL,
+           ARRAY(SELECT name FROM page ORDER BY name {order}, ID {order}),
+           ARRAY(SELECT ID FROM page ORDER BY name {order}, ID {order})
+    """
+
+QUOTES_BY_NAME_PAGE = """
+    WITH owner AS (
+        SELECT ID, name FROM {table}
+        WHERE lower(name) = lower($1)
+        LIMIT 1
+    ),
+    page AS (
+        SELECT ID, text FROM Quotes
+        WHERE {column} = (SELECT ID FROM owner) AND ID {cmp} $2
+        ORDER BY ID {order}
+        LIMIT $3
+    )
+    SELECT CASE WHEN $4 THEN COALESCE((SELECT count FROM quote_counts
+                                       WHERE scope = '{scope}' AND id = (SELECT ID FROM owner)), 0) END,
+           (SELECT name FROM owner),
+           ARRAY(SELECT text FROM page ORDER BY ID {order}),
+           ARRAY(SELECT ID FROM page ORDER BY ID {order})
+    """
+
+QUOTES_BY_ID_PAGE = """
+    WITH page AS (
+        SELECT ID, text FROM Quotes
+        WHERE {column} = $1 AND ID {cmp} $2
+        ORDER BY ID {order}
+        LIMIT $3
+    )
+    SELECT CASE WHEN $4 THEN COALESCE((SELECT count FROM quote_counts
+                                       WHERE scope = '{scope}' AND id = $1), 0) END,
+           (SELECT name FROM {table} WHERE ID = $1),
+           ARRAY(SELECT text FROM page ORDER BY ID {order}),
+           ARRAY(SELECT ID FROM page ORDER BY ID {order})
+    """
+
+def _both_directions(statements):
+    result = {}
+    for name, (types, query, names) in statements.items():
+        result[name] = (types, query.format(cmp='>', order='ASC', **names))
+        result[name + '_before'] = (types, query.format(cmp='<', order='DESC', **names))
+    return result
+
+STATEMENTS = _both_directions({
+    'authors_page': ("(text, integer, integer, boolean)", NAMES_PAGE,
+                     {'table': 'Authors', 'total': 'authors'}),
+
+    'categories_page': ("(text, integer, integer, boolean)", NAMES_PAGE,
+                        {'table': 'Categories', 'total': 'categories'}),
+
+    'quotes_by_author_name': ("(text, integer, integer, boolean)", QUOTES_BY_NAME_PAGE,
+                              {'table': 'Authors', 'column': 'authorID', 'scope': 'author'}),
+
+    'quotes_by_author_id': ("(integer, integer, integer, boolean)", QUOTES_BY_ID_PAGE,
+                            {'table': 'Authors', 'column': 'authorID', 'scope': 'author'}),
+
+    'quotes_by_category_name': ("(text, integer, integer, boolean)", QUOTES_BY_NAME_PAGE,
+                                {'table': 'Categories', 'column': 'categoryID',
+                                 'scope': 'category'}),
+
+    'quotes_by_category_id': ("(integer, integer, integer, boolean)", QUOTES_BY_ID_PAGE,
+                              {'table': 'Categories', 'column': 'categoryID',
+                               'scope': 'category'}),
+})
+
+#--------------------------------------------------------
+# Runs a prepared statement, preparing it first if this |
+# connection has not seen it yet                        |
+#--------------------------------------------------------
+def execute_prepared(cursor, name, params):
+    conn = cursor.connection
+    prepared = conn.prepared_statements
+    execute_query = "EXECUTE %s (%s);" % (name, ", ".join(["%s"] * len(params)))
+
+    if name not in prepared:
+        types, query = STATEMENTS[name]
+        cursor.execute("PREPARE %s %s AS %s;" % (name, types, query))
+        prepared.add(name)
+
+    try:
+        cursor.execute(execute_query, params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # The server lost the statement (e.g. DISCARD ALL), prepare it again
+        conn.rollback()
+        prepared.discard(name)
+        return execute_prepared(cursor, name, params)
+
+#--------------------------------------------------------
+# Returns the SQL of a statement with $1, $2... written |
+# as %(p1)s, %(p2)s... and its params as a dict, for    |
+# drivers that prepare statements themselves (asgi.py)  |
+#--------------------------------------------------------
+def portable_statement(name, params):
+    query = re.sub(r'\$(\d+)', r'%(p\1)s', STATEMENTS[name][1])
+    return query, {"p%d" % (i + 1): value for i, value in enumerate(params)}
+
+#--------------------------------------------------------
+# Database operations yielded by the handlers in        |
+# handlers.py, batch.py, sampler.py and names.py        |
+#--------------------------------------------------------
+class Query:
+    def __init__(self, sql, params=(), fetch='all'):
+        self.sql = sql
+        self.params = params
+        self.fetch = fetch   # 'one', 'all' or None
+
+class Statement:
+    # A prepared statement from queries.STATEMENTS, returns its single row
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+
+class Commit:
+    pass
+
+class Rollback:
+    pass
+
+class Wait:
+    # Waits for a concurrent.futures.Future set by another request, returns its result
+    def __init__(self, future, timeout=None):
+        self.future = future
+        self.timeout = timeout
+
+#--------------------------------------------------------
+# Runs a handler on the psycopg2 connection returned by |
+# connect(), called at the handler's first database     |
+# operation: a handler answering from memory never      |
+# checks a connection out. Database errors are thrown   |
+# back into the handler so it can turn them into an     |
+# error response.                                       |
+#--------------------------------------------------------
+def run(handler, connect):
+    cursor = None
+    try:
+        op = next(handler)
+        while True:
+            if cursor is None and not isinstance(op, Wait):
+                conn = connect()
+                cursor = conn.cursor()
+            try:
+                if isinstance(op, Query):
+                    cursor.execute(op.sql, op.params)
+                    if op.fetch == 'one':
+                        result = cursor.fetchone()
+                    elif op.fetch == 'all':
+                        result = cursor.fetchall()
+                    else:
+                        result = cursor.rowcount
+                elif isinstance(op, Statement):
+                    execute_prepared(cursor, op.name, op.params)
+                    result = cursor.fetchone()
+                elif isinstance(op, Commit):
+                    conn.commit()
+                    result = None
+                elif isinstance(op, Rollback):
+                    conn.rollback()
+                    result = None
+                elif isinstance(op, Wait):
+                    result = op.future.result(op.timeout)
+                else:
+                    raise TypeError("unknown database operation %r" % (op,))
+            except Exception as error:
+                op = handler.throw(error)
+            else:
+                op = handler.send(result)
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        if cursor is not None:
+            cursor.close()
@@ -0,0 +1,178 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+#--------------------------------------------------------
+# Read/write splitting across read replicas.            |
+#                                                       |
+# GET requests read from a replica picked round-robin   |
+# among the healthy ones whose replication lag is at    |
+# most max_lag seconds; writes, and reads when no       |
+# replica qualifies, use the primary. Replicas are      |
+# checked every check_interval seconds by one of the    |
+# requests (db.py and asgi.py run the checks).          |
+#                                                       |
+# Read-your-writes: a successful write sets a cookie    |
+# that sends that client's reads to the primary for     |
+# write_window seconds. For the same window after any   |
+# write through this process, reads that fill the       |
+# response cache go to the primary too, so the cache is |
+# not refilled from a replica that hasn't caught up.    |
+#--------------------------------------------------------
+
+# Seconds a replica is behind: 0 when it replayed everything it received (an idle
+# primary doesn't make it lag), and always 0 on a server that isn't a standby
+LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END;
+"""
+
+STICKY_COOKIE = 'quotes_api_primary'
+
+READ_METHODS = ('GET', 'HEAD')
+
+# Connection strings are separated by ";" since key=value strings contain spaces
+def parse_dsns(value):
+    return [dsn.strip() for dsn in (value or '').split(';') if dsn.strip()]
+
+#--------------------------------------------------------
+# Per-request routing state, context variables so they  |
+# follow both Flask's threads and asyncio tasks         |
+#--------------------------------------------------------
+_replica_reads = contextvars.ContextVar('replica_reads', default=False)
+_filling_cache = contextvars.ContextVar('filling_cache', default=False)
+
+# Whether this request may read from a replica: a read by a client that didn't just write
+def allow_replica_reads(method, sticky_cookie):
+    _replica_reads.set(method in READ_METHODS and not is_sticky(sticky_cookie))
+
+@contextlib.contextmanager
+def filling_cache():
+    token = _filling_cache.set(True)
+    try:
+        yield
+    finally:
+        _filling_cache.reset(token)
+
+def is_sticky(cookie):
+    try:
+        return float(cookie) > time.time()
+    except (TypeError, ValueError):
+        return False
+
+# Value and max age of the cookie set after a write
+def sticky_cookie(window):
+    return "%.3f" % (time.time() + window), max(1, int(window + 0.999))
+
+class Replica:
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.healthy = False
+        self.lag = None
+        self.error = None
+        self.checked_at = None
+        self.reads = 0
+
+    def stats(self):
+        return {"healthy": self.healthy, "lag": self.lag, "error": self.error,
+                "checked at": self.checked_at, "reads": self.reads}
+
+class ReplicaRouter:
+    def __init__(self, replicas, max_lag=5.0, check_interval=2.0, write_window=5.0):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.write_window = write_window
+        self._next = 0
+        self._checking = False
+        self._checked = None
+        self._last_write = None
+        self._lock = threading.Lock()
+        self.primary_reads = 0
+        self.fallbacks = 0
+
+    #--------------------------------------------------------
+    # True if the replicas should be checked now, in which  |
+    # case the caller runs the check and calls checked().   |
+    # Other requests meanwhile route on the last results.   |
+    #--------------------------------------------------------
+    def check_due(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._checking:
+                return False
+            if self._checked is not None and now - self._checked < self.check_interval:
+                return False
+            self._checking = True
+            return True
+
+    def checked(self):
+        with self._lock:
+            self._checking = False
+            self._checked = time.monotonic()
+
+    def record(self, replica, lag=None, error=None):
+        with self._lock:
+            replica.checked_at = round(time.time(), 3)
+            if error is not None:
+                replica.healthy = False
+                replica.lag = None
+                replica.error = str(error).strip() or type(error).__name__
+            else:
+                replica.healthy = True
+                replica.lag = float(lag)
+                replica.error = None
+
+    def wrote(self):
+        with self._lock:
+            self._last_write = time.monotonic()
+
+    #--------------------------------------------------------
+    # Returns the replica this request should read from,    |
+    # or None for the primary                               |
+    #--------------------------------------------------------
+    def choose(self):
+        with self._lock:
+            if not _replica_reads.get():
+                return None
+            if _filling_cache.get() and self._last_write is not None and \
+                    time.monotonic() - self._last_write < self.write_window:
+                self.primary_reads += 1
+                return None
+            usable = [replica for replica in self.replicas
+                      if replica.healthy and replica.lag <= self.max_lag]
+            if not usable:
+                self.fallbacks += 1
+                return None
+            replica = usable[self._next % len(usable)]
+            self._next += 1
+            replica.reads += 1
+            return replica
+
+    def stats(self):
+        with self._lock:
+            return {
+                "replicas": {replica.name: replica.stats() for replica in self.replicas},
+                "max lag": self.max_lag,
+                "primary reads after writes": self.primary_reads,
+                "fallbacks to primary": self.fallbacks,
+            }
+
+    def metrics(self):
+        with self._lock:
+            return [
+                ('quotes_api_replica_healthy', 'gauge', "1 if the replica passed its last check",
+                 [({'replica': r.name}, int(r.healthy)) for r in self.replicas]),
+                ('quotes_api_replica_lag_seconds', 'gauge', "Replication lag at the last check",
+                 [({'replica': r.name}, r.lag) for r in self.replicas if r.lag is not None]),
+                ('quotes_api_replica_reads_total', 'counter', "Requests that read from the replica",
+                 [({'replica': r.name}, r.reads) for r in self.replicas]),
+                ('quotes_api_replica_fallbacks_total', 'counter',
+                 "Reads sent to the primary because no replica was usable",
+                 [({}, self.fallbacks)]),
+            ]
@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from array import array
+
+from queries import Query
+
+#--------------------------------------------------------
+# Keeps a compact array of live quote IDs so random     |
+# quotes can be picked without sorting the whole table. |
+#                                                       |
+# The array is loaded once and then extended with the   |
+# IDs above the highest one seen (refresh) or that this |
+# process just inserted (add). A full reload runs every |
+# full_reload_interval seconds, or after a sampled ID   |
+# turned out to be gone, to drop deleted quotes and to  |
+# catch inserts that committed out of ID order.         |
+#--------------------------------------------------------
+class QuoteSampler:
+    PAGE_SIZE = 100000
+
+    def __init__(self, refresh_interval=30.0, full_reload_interval=3600.0):
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self._ids = array('q')
+        self._recent = set()
+        self._watermark = 0
+        self._loaded = False
+        self._refreshing = False
+        self._last_refresh = None
+        self._last_full_reload = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _due(self, now):
+        if self._stale:
+            return True
+        return now - self._last_refresh >= self.refresh_interval
+
+    #--------------------------------------------------------
+    # Brings the ID array up to date if a refresh is due.   |
+    # This is a handler step (see queries.py): it yields    |
+    # the queries and is run with `yield from`. IDs are     |
+    # read in pages of PAGE_SIZE along the primary key.     |
+    # While one request refreshes, others keep sampling     |
+    # from the current array.                               |
+    #--------------------------------------------------------
+    def refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            if not self._due(now) or (self._refreshing and self._loaded):
+                return
+            self._refreshing = True
+            full = (self._stale or self._last_full_reload is None
+                    or now - self._last_full_reload >= self.full_reload_interval)
+            start = 0 if full else self._watermark
+
+        try:
+            ids = array('q')
+            last = start
+            while True:
+                rows = yield Query("SELECT ID FROM Quotes WHERE ID > %s ORDER BY ID LIMIT %s;",
+                                   (last, self.PAGE_SIZE))
+                ids.extend(row[0] for row in rows)
+                if len(rows) < self.PAGE_SIZE:
+                    break
+                last = rows[-1][0]
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+        with self._lock:
+            if full:
+                self._ids = ids
+                self._recent.clear()
+                self._watermark = ids[-1] if ids else 0
+                self._last_full_reload = now
+                self._stale = False
+            else:
+                self._ids.extend(i for i in ids if i not in self._recent)
+                if ids:
+                    self._watermark = max(self._watermark, ids[-1])
+            self._recent = {i for i in self._recent if i > self._watermark}
+            self._loaded = True
+            self._last_refresh = now
+
+    #--------------------------------------------------------
+    # Records a quote inserted by this process              |
+    #--------------------------------------------------------
+    def add(self, quote_id):
+        with self._lock:
+            if quote_id > self._watermark and quote_id not in self._recent:
+                self._recent.add(quote_id)
+                self._ids.append(quote_id)
+
+    #--------------------------------------------------------
+    # Called when sampled IDs no longer exist, the next     |
+    # refresh reloads the full array                        |
+    #--------------------------------------------------------
+    def invalidate(self):
+        self._stale = True
+
+    #--------------------------------------------------------
+    # Picks `limit` distinct IDs without replacement. For   |
+    # small limits this draws random slots and skips        |
+    # repeats, so the cost depends on limit and not on the |
+    # number of quotes.                                     |
+    #--------------------------------------------------------
+    def sample(self, limit):
+        ids = self._ids
+        total = len(ids)
+        limit = min(limit, total)
+
+        if limit * 4 > total:
+            return random.sample(list(ids), limit)
+
+        picked = set()
+        result = []
+        while len(result) < limit:
+            quote_id = ids[random.randrange(total)]
+            if quote_id not in picked:
+                picked.add(quote_id)
+                result.append(quote_id)
+        return result
@@ -0,0 +1,249 @@
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#--------------------------------------------------------
+# Response serialization.                               |
+#                                                       |
+# dumps() produces exactly what json.dumps() does, but  |
+# copies Fragment values (JSON encoded earlier) as they |
+# are, so a list of cached quotes is joined instead of  |
+# encoded again. JSON_ENCODER=orjson switches to the    |
+# orjson package, which is faster but writes compact    |
+# JSON with UTF-8 text, so responses are no longer byte |
+# for byte the same as before (the data is).            |
+#--------------------------------------------------------
+class Fragment:
+    __slots__ = ('json',)
+
+    def __init__(self, json_text):
+        self.json = json_text
+
+_orjson = None
+
+def configure(encoder):
+    global _orjson
+    if encoder == 'orjson':
+        import orjson
+
+        _orjson = orjson
+    elif encoder == 'json':
+        _orjson = None
+    else:
+        raise ValueError("unknown JSON encoder %r" % encoder)
+
+def _dumps_plain(value):
+    if _orjson is not None:
+        return _orjson.dumps(value).decode('utf-8')
+    return json.dumps(value)
+
+def _scalar(value):
+    return not isinstance(value, (dict, list, tuple, Fragment))
+
+def dumps(value):
+    if isinstance(value, Fragment):
+        return value.json
+    item_separator, key_separator = (',', ':') if _orjson is not None else (', ', ': ')
+    if isinstance(value, dict):
+        if all(_scalar(item) for item in value.values()):
+            return _dumps_plain(value)
+        return '{' + item_separator.join(
+            _dumps_plain(str(key)) + key_separator + dumps(item)
+            for key, item in value.items()) + '}'
+    if isinstance(value, (list, tuple)):
+        if all(_scalar(item) for item in value):
+            return _dumps_plain(value)
+        return '[' + item_separator.join(dumps(item) for item in value) + ']'
+    return _dumps_plain(value)
+
+def dumps_bytes(value):
+    return dumps(value).encode('utf-8')
+
+# An encoded object with the scalar `values` put before its keys, what dumps() of
+# the merged dict would give
+def extend(values, fragment):
+    head = _dumps_plain(values)
+    if fragment.json == '{}':
+        return Fragment(head)
+    item_separator = ',' if _orjson is not None else ', '
+    return Fragment(head[:-1] + item_separator + fragment.json[1:])
+
+#--------------------------------------------------------
+# Pre-encoded quotes ({"quote", "author", "category"}), |
+# keyed by their cache tag so ResponseCache.invalidate  |
+# drops them together with the responses showing them.  |
+# Kept per process, entries expire after `ttl` seconds  |
+# like the local response cache.                        |
+#--------------------------------------------------------
+class FragmentCache:
+    def __init__(self, max_entries=100000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now:
+                    self._entries.move_to_end(key)
+                    found[key] = entry[0]
+                elif entry is not None:
+                    del self._entries[key]
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, fragment):
+        with self._lock:
+            self._entries[key] = (fragment, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._entries.pop(tag, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+#--------------------------------------------------------
+# Content-Encoding negotiation. Brotli is offered when  |
+# the brotli package is installed.                      |
+#--------------------------------------------------------
+COMPRESSORS = {'gzip': lambda body: gzip.compress(body, compresslevel=6, mtime=0)}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda body: brotli.compress(body, quality=5)
+
+# Server preference when the client accepts several equally
+PREFERENCE = ['br', 'gzip']
+
+#--------------------------------------------------------
+# Returns the encoding to use for an Accept-Encoding    |
+# header, or None for identity                          |
+#--------------------------------------------------------
+def negotiate(accept_encoding):
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        name = name.strip().lower()
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+
+    best, best_weight = None, 0.0
+    for encoding in PREFERENCE:
+        if encoding not in COMPRESSORS:
+            continue
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+def compress(body, encoding):
+    return COMPRESSORS[encoding](body)
+
+#--------------------------------------------------------
+# ETags are per representation, the compressed ones get |
+# the encoding appended                                 |
+#--------------------------------------------------------
+def encoded_etag(etag, encoding):
+    if not etag or not encoding or not etag.endswith('"'):
+        return etag
+    return etag[:-1] + '-' + encoding + '"'
+
+def base_etag(etag):
+    for encoding in COMPRESSORS:
+        suffix = '-' + encoding + '"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+#--------------------------------------------------------
+# Response compression. Bodies of at least `min_size`   |
+# bytes are compressed with the encoding the client     |
+# prefers (see negotiate()). ResponseCache keeps the    |
+# compressed variants of its entries, so a cached       |
+# response is compressed once, not on every request.    |
+#--------------------------------------------------------
+class Compression:
+    def __init__(self, enabled=True, min_size=1024):
+        self.enabled = enabled
+        self.min_size = min_size
+
+    def choose(self, accept_encoding, body, content_type):
+        if not self.enabled or len(body) < self.min_size:
+            return None
+        if not (content_type or '').startswith('application/json'):
+            return None
+        return negotiate(accept_encoding)
+
+    #--------------------------------------------------------
+    # Framework independent: compresses a response unless   |
+    # it already is and fixes up its headers, a list of     |
+    # (name, value). Returns (body, headers).               |
+    #--------------------------------------------------------
+    def finish(self, status, body, content_type, headers, accept_encoding):
+        if not self.enabled:
+            return body, headers
+        encoding = None
+        for name, value in headers:
+            if name.lower() == 'content-encoding':
+                encoding = value
+        headers = list(headers)
+        if encoding is None and status == 200:
+            encoding = self.choose(accept_encoding, body, content_type)
+            if encoding:
+                body = compress(body, encoding)
+                headers.append(('Content-Encoding', encoding))
+        if status == 304 or (content_type or '').startswith('application/json'):
+            headers.append(('Vary', 'Accept-Encoding'))
+        if encoding:
+            headers = [(name, encoded_etag(value, encoding) if name.lower() == 'etag' else value)
+                       for name, value in headers]
+        return body, headers
+
+    def init_app(self, app):
+        from flask import request
+
+        @app.after_request
+        def compress_response(response):
+            if response.is_streamed or response.direct_passthrough:
+                return response
+            body = response.get_data()
+            compressed, headers = self.finish(response.status_code, body, response.content_type,
+                                              list(response.headers.items()),
+                                              request.headers.get('Accept-Encoding'))
+            if compressed is not body:
+                response.set_data(compressed)
+            for name, value in headers:
+                if name.lower() in ('content-encoding', 'etag'):
+                    response.headers[name] = value
+                elif name.lower() == 'vary':
+                    response.vary.add(value)
+            return response
@@ -0,0 +1,746 @@
+import argparse
+import bisect
+import csv
+import heapq
+import json
+import math
+import mmap
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from array import array
+
+from markupsafe import escape
+
+from fields import QUOTE_FIELDS, SEARCH_FIELDS, select_fields
+from handlers import limit_error, cursor_error
+from pagination import CursorError, FIRST_NAME_KEY, FIRST_ID_KEY
+
+#--------------------------------------------------------
+# Database-free serving from a snapshot file.           |
+#                                                       |
+# A snapshot is an immutable copy of the quotes,        |
+# authors and categories laid out as columns:           |
+#                                                       |
+#   quote_ids, quote_authors, quote_categories  int32,  |
+#       one entry per quote in ID order (authors and    |
+#       categories are indexes into their tables)       |
+#   quote_text_offsets + quote_texts  UTF-8 blob        |
+#   author_ids, author_name_offsets + author_names      |
+#       authors in (name, ID) order, each name stored   |
+#       once however many quotes point at it. An export |
+#       keeps the database's order, so pages follow its |
+#       collation like NAMES_PAGE does.                 |
+#   author_quote_offsets + author_quotes  the quote     |
+#       positions of every author, in ID order          |
+#   (and the same for categories)                       |
+#                                                       |
+# The file is an 8 byte magic, the length of a JSON     |
+# header and the sections, 8 byte aligned. It is opened |
+# with mmap and the columns are memoryviews over it, so |
+# loading is instant and pre-forked workers share the   |
+# pages. The GET endpoints are answered from it with    |
+# the same responses as handlers.py.                    |
+#--------------------------------------------------------
+MAGIC = b'QSNAP001'
+FORMAT_VERSION = 1
+
+class SnapshotError(Exception):
+    pass
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def string_column(strings):
+    offsets = array('q', [0])
+    blob = bytearray()
+    for value in strings:
+        blob += value.encode('utf-8')
+        offsets.append(len(blob))
+    return offsets, blob
+
+def _grouped(groups, keys):
+    # CSR layout: positions of group g are values[offsets[g]:offsets[g + 1]]
+    counts = [0] * groups
+    for key in keys:
+        counts[key] += 1
+    offsets = array('i', [0])
+    for count in counts:
+        offsets.append(offsets[-1] + count)
+    values = array('i', bytes(4 * len(keys)))
+    fill = list(offsets[:-1])
+    for position, key in enumerate(keys):
+        values[fill[key]] = position
+        fill[key] += 1
+    return offsets, values
+
+#--------------------------------------------------------
+# Writes a snapshot of `authors` and `categories` ((ID, |
+# name) pairs) and `quotes` ((ID, text, author ID,      |
+# category ID) tuples) to `path`. The file is written   |
+# next to it and renamed, so readers never see half of  |
+# it. Names are sorted by code point (the C collation)  |
+# unless `ordered` says they come in the database's     |
+# (name, ID) order.                                     |
+#--------------------------------------------------------
+def write_snapshot(path, authors, categories, quotes, ordered=False):
+    if not ordered:
+        authors = sorted(authors, key=lambda row: (row[1], row[0]))
+        categories = sorted(categories, key=lambda row: (row[1], row[0]))
+    else:
+        authors, categories = list(authors), list(categories)
+    author_index = {author_id: i for i, (author_id, _) in enumerate(authors)}
+    category_index = {category_id: i for i, (category_id, _) in enumerate(categories)}
+
+    quote_ids, quote_authors, quote_categories = array('i'), array('i'), array('i')
+    texts = []
+    for quote_id, text, author_id, category_id in sorted(quotes, key=lambda row: row[0]):
+        if author_id not in author_index or category_id not in category_index:
+            raise SnapshotError("quote %s points at a missing author or category" % quote_id)
+        quote_ids.append(quote_id)
+        quote_authors.append(author_index[author_id])
+        quote_categories.append(category_index[category_id])
+        texts.append(text)
+
+    text_offsets, text_blob = string_column(texts)
+    author_name_offsets, author_names = string_column(name for _, name in authors)
+    category_name_offsets, category_names = string_column(name for _, name in categories)
+    author_quote_offsets, author_quotes = _grouped(len(authors), quote_authors)
+    category_quote_offsets, category_quotes = _grouped(len(categories), quote_categories)
+
+    sections = [
+        ('quote_ids', quote_ids),
+        ('quote_authors', quote_authors),
+        ('quote_categories', quote_categories),
+        ('quote_text_offsets', text_offsets),
+        ('quote_texts', text_blob),
+        ('author_ids', array('i', (author_id for author_id, _ in authors))),
+        ('author_name_offsets', author_name_offsets),
+        ('author_names', author_names),
+        ('author_quote_offsets', author_quote_offsets),
+        ('author_quotes', author_quotes),
+        ('category_ids', array('i', (category_id for category_id, _ in categories))),
+        ('category_name_offsets', category_name_offsets),
+        ('category_names', category_names),
+        ('category_quote_offsets', category_quote_offsets),
+        ('category_quotes', category_quotes),
+    ]
+    write_columns(path, MAGIC, {
+        'version': FORMAT_VERSION,
+        'created': time.time(),
+        'name_order': 'database' if ordered else 'code point',
+        'quotes': len(quote_ids),
+        'authors': len(authors),
+        'categories': len(categories),
+    }, sections)
+
+    return {'quotes': len(quote_ids), 'authors': len(authors), 'categories': len(categories)}
+
+#--------------------------------------------------------
+# The file layout, also used by catalog.py: `magic`, 8  |
+# bytes, the length of the JSON header and the          |
+# sections, 8 byte aligned. The file is written next to |
+# `path` and renamed, so readers never see half of it.  |
+#--------------------------------------------------------
+def write_columns(path, magic, header, sections):
+    # Section offsets are relative to the end of the header
+    table = {}
+    offset = 0
+    for name, data in sections:
+        typecode = data.typecode if isinstance(data, array) else 'B'
+        length = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        table[name] = [offset, length, typecode]
+        offset = _align(offset + length)
+
+    header = json.dumps(dict(header, byteorder=sys.byteorder, sections=table)).encode('utf-8')
+    header += b' ' * (_align(len(header) + 16) - len(header) - 16)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(magic)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            for name, data in sections:
+                start = table[name][0]
+                f.write(b'\0' * (start - (f.tell() - 16 - len(header))))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+#--------------------------------------------------------
+# Maps a file written by write_columns() and returns    |
+# (mapping, header, {section: memoryview}). `kind`      |
+# names the file in errors.                             |
+#--------------------------------------------------------
+def map_columns(path, magic, format_version, kind):
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapping)
+    if bytes(view[:8]) != magic:
+        raise SnapshotError("%s is not a %s" % (path, kind))
+    header_length = int.from_bytes(view[8:16], 'little')
+    header = json.loads(bytes(view[16:16 + header_length]))
+    if header.get('version') != format_version or header.get('byteorder') != sys.byteorder:
+        raise SnapshotError("%s has an unsupported %s format" % (path, kind))
+
+    base = 16 + header_length
+    columns = {}
+    for name, (offset, length, typecode) in header['sections'].items():
+        section = view[base + offset:base + offset + length]
+        columns[name] = section if typecode == 'B' else section.cast(typecode)
+    return mapping, header, columns
+
+#--------------------------------------------------------
+# Sources for write_snapshot                            |
+#--------------------------------------------------------
+def _csv_rows(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            yield {(key or '').strip().lower(): value for key, value in row.items()}
+
+def read_csv_source(quotes_path, authors_path, categories_path):
+    try:
+        authors = [(int(row['id']), row['name']) for row in _csv_rows(authors_path)]
+        categories = [(int(row['id']), row['name']) for row in _csv_rows(categories_path)]
+        quotes = [(int(row['id']), row['text'], int(row['authorid']), int(row['categoryid']))
+                  for row in _csv_rows(quotes_path)]
+    except (KeyError, ValueError) as error:
+        raise SnapshotError("bad CSV input: %s" % error)
+    return authors, categories, quotes
+
+# Authors and categories in the database's order, pass ordered=True to write_snapshot
+def read_db_source(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT ID, name FROM Authors ORDER BY name, ID;")
+        authors = cursor.fetchall()
+        cursor.execute("SELECT ID, name FROM Categories ORDER BY name, ID;")
+        categories = cursor.fetchall()
+        cursor.execute("SELECT ID, text, authorID, categoryID FROM Quotes ORDER BY ID;")
+        quotes = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.rollback()
+    return authors, categories, quotes
+
+class Strings:
+    # A string column read from the snapshot, decoded on access
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self._blob[self._offsets[i]:self._offsets[i + 1]], 'utf-8')
+
+class _Keys:
+    # Sequence view for bisect over a slice of positions
+    def __init__(self, positions, key):
+        self._positions = positions
+        self._key = key
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __getitem__(self, i):
+        return self._key(self._positions[i])
+
+#--------------------------------------------------------
+# A snapshot opened from a file                         |
+#--------------------------------------------------------
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        self._map, self.header, columns = map_columns(path, MAGIC, FORMAT_VERSION,
+                                                      'quotes snapshot')
+
+        self.quote_ids = columns['quote_ids']
+        self.quote_authors = columns['quote_authors']
+        self.quote_categories = columns['quote_categories']
+        self.quote_texts = Strings(columns['quote_text_offsets'], columns['quote_texts'])
+
+        # Names are small, they are decoded once and interned
+        self.authors = _Table(columns['author_ids'],
+                              Strings(columns['author_name_offsets'], columns['author_names']),
+                              columns['author_quote_offsets'], columns['author_quotes'])
+        self.categories = _Table(columns['category_ids'],
+                                 Strings(columns['category_name_offsets'],
+                                          columns['category_names']),
+                                 columns['category_quote_offsets'], columns['category_quotes'])
+        self._words = None
+        self._words_lock = threading.Lock()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'created': self.header['created'],
+            'quotes': self.header['quotes'],
+            'authors': self.header['authors'],
+            'categories': self.header['categories'],
+            'bytes': len(self._map),
+        }
+
+    def _position(self, quote_id):
+        i = bisect.bisect_left(self.quote_ids, quote_id)
+        if i < len(self.quote_ids) and self.quote_ids[i] == quote_id:
+            return i
+        return None
+
+    def _quote(self, position):
+        return {
+            'quote': self.quote_texts[position],
+            'author': self.authors.names[self.quote_authors[position]],
+            'category': self.categories.names[self.quote_categories[position]]
+        }
+
+    #--------------------------------------------------------
+    # The endpoints, returning (status, response data) like |
+    # the handlers in handlers.py                           |
+    #--------------------------------------------------------
+    def random_quotes(self, limit, fields=QUOTE_FIELDS):
+        if limit < 0:
+            return limit_error()
+        count = min(limit, len(self.quote_ids))
+        positions = random.sample(range(len(self.quote_ids)), count)
+        return 200, {'randomQuotes': [select_fields(self._quote(position), fields)
+                                      for position in positions]}
+
+    def quote_by_id(self, quote_id, fields=QUOTE_FIELDS):
+        position = self._position(quote_id)
+        if position is None:
+            return 404, {"error": "Quote not found"}
+        return 200, select_fields(self._quote(position), fields)
+
+    def quotes_by_ids(self, quote_ids, fields=QUOTE_FIELDS):
+        quotes = []
+        returned = 0
+        for quote_id in quote_ids:
+            position = self._position(quote_id)
+            if position is None:
+                quotes.append({"quoteID": quote_id, "error": "Quote not found"})
+            else:
+                quotes.append(dict({"quoteID": quote_id},
+                                   **select_fields(self._quote(position), fields)))
+                returned += 1
+        return 200, {"amount of quotes returned": returned, "quotes": quotes}
+
+    def authors_page(self, page):
+        return self._names_page(self.authors, page, "total number of authors",
+                                "number of authors returned", "authors")
+
+    def categories_page(self, page):
+        return self._names_page(self.categories, page, "total number of categories",
+                                "amount of categories returned", "categories")
+
+    def _names_page(self, table, page, total_key, returned_key, key):
+        if page.limit < 0:
+            return limit_error()
+        try:
+            rows, next_link, prev_link = _page(page, FIRST_NAME_KEY, len(table.ids), table.key,
+                                               table.locate)
+        except CursorError as error:
+            return cursor_error(error)
+
+        total = len(table.ids)
+        if page.with_count and total < 1:
+            return 200, {key: []}
+
+        response_data = {}
+        if page.with_count:
+            response_data[total_key] = total
+        names = [table.names[row] for row in rows]
+        response_data.update({
+            returned_key: len(names),
+            key: names,
+            "next": next_link,
+            "prev": prev_link
+        })
+        return 200, response_data
+
+    def quotes_by_author_name(self, author_name_raw, page):
+        return self._quotes_by_name(self.authors, 'author', author_name_raw, page)
+
+    def quotes_by_category_name(self, category_name_raw, page):
+        return self._quotes_by_name(self.categories, 'category', category_name_raw, page)
+
+    def quotes_by_author_id(self, author_id, page):
+        return self._quotes_by_id(self.authors, 'author', author_id, page)
+
+    def quotes_by_category_id(self, category_id, page):
+        return self._quotes_by_id(self.categories, 'category', category_id, page)
+
+    def _quotes_by_name(self, table, key, name_raw, page):
+        name = escape(name_raw)
+        if page.limit < 0:
+            return limit_error()
+        result = self._owner_quotes(table, table.by_name.get(str(name).lower()), page)
+        if result[0] != 200:
+            return result
+        count, quotes, next_link, prev_link = result[1]
+
+        response_data = {}
+        if count is not None:
+            response_data["total quotes available"] = count
+        response_data.update({
+            "amount of quotes returned": len(quotes),
+            key: name.title(),
+            "quotes": quotes,
+            "next": next_link,
+            "prev": prev_link
+        })
+        return 200, response_data
+
+    def _quotes_by_id(self, table, key, owner_id, page):
+        if page.limit < 0:
+            return limit_error()
+        owner = table.by_id.get(owner_id)
+        result = self._owner_quotes(table, owner, page)
+        if result[0] != 200:
+            return result
+        count, quotes, next_link, prev_link = result[1]
+
+        response_data = {}
+        if count is not None:
+            response_data["total quotes available"] = count
+        response_data.update({
+            "amount of quotes returned": len(quotes),
+            key + "ID": int(owner_id),
+            key + "Name": table.names[owner],
+            "quotes": quotes,
+            "next": next_link,
+            "prev": prev_link
+        })
+        return 200, response_data
+
+    def _owner_quotes(self, table, owner, page):
+        positions = table.quotes(owner) if owner is not None else ()
+        try:
+            rows, next_link, prev_link = _page(page, FIRST_ID_KEY, len(positions),
+                                               lambda i: (self.quote_ids[positions[i]],))
+        except CursorError as error:
+            return cursor_error(error)
+
+        count = len(positions) if page.with_count else None
+        if owner is None or (count is not None and count < 1) or \
+                (not rows and page.cursor is None):
+            return 404, {"error": "quotes not found!"}
+
+        quotes = [self.quote_texts[positions[row]] for row in rows]
+        return 200, (count, quotes, next_link, prev_link)
+
+    def quote_stats(self, limit):
+        if limit < 0:
+            return limit_error()
+        return 200, {
+            "total quotes": len(self.quote_ids),
+            "total authors": len(self.authors.ids),
+            "total categories": len(self.categories.ids),
+            "top authors": [{"authorID": owner_id, "author": name, "quotes": count}
+                            for owner_id, name, count in self.authors.top(limit)],
+            "top categories": [{"categoryID": owner_id, "category": name, "quotes": count}
+                               for owner_id, name, count in self.categories.top(limit)],
+        }
+
+    #--------------------------------------------------------
+    # Rows of GET /quotes/export: (ID, text, author,        |
+    # category) in ID order, after `after_id`               |
+    #--------------------------------------------------------
+    def export_rows(self, author=None, category=None, after_id=0):
+        start = bisect.bisect_right(self.quote_ids, after_id)
+        positions = range(start, len(self.quote_ids))
+        owners = []
+        for table, name, column in ((self.authors, author, self.quote_authors),
+                                    (self.categories, category, self.quote_categories)):
+            if not name:
+                continue
+            owner = table.by_name.get(name.lower())
+            if owner is None:
+                return
+            if not owners:
+                # Only walk the quotes of the first filter, they are in ID order too
+                quotes = table.quotes(owner)
+                positions = quotes[bisect.bisect_left(quotes, start):]
+            owners.append((column, owner))
+
+        for position in positions:
+            if all(column[position] == owner for column, owner in owners):
+                yield (self.quote_ids[position], self.quote_texts[position],
+                       self.authors.names[self.quote_authors[position]],
+                       self.categories.names[self.quote_categories[position]])
+
+    #--------------------------------------------------------
+    # Search without the database: every word of the query  |
+    # has to appear in the quote (whole words, no stemming) |
+    # and matches are ranked by how much of the quote the   |
+    # words make up. The word index is built on first use.  |
+    #--------------------------------------------------------
+    def _word_index(self):
+        with self._words_lock:
+            if self._words is None:
+                words = {}
+                for position in range(len(self.quote_ids)):
+                    for word in set(re.findall(r'\w+', self.quote_texts[position].lower())):
+                        words.setdefault(word, array('i')).append(position)
+                self._words = words
+            return self._words
+
+    def search_quotes(self, text, author, category, page, fields=SEARCH_FIELDS):
+        if not text or not text.strip():
+            return 400, {"error": "missing search query"}
+        if page.limit < 0:
+            return limit_error()
+        try:
+            backwards, key = page.position((0.0, 0))
+        except CursorError as error:
+            return cursor_error(error)
+
+        terms = set(re.findall(r'\w+', text.lower()))
+        words = self._word_index()
+        candidates = None
+        for term in terms:
+            postings = set(words.get(term, ()))
+            candidates = postings if candidates is None else candidates & postings
+        candidates = candidates or set()
+        for table, name in ((self.authors, author), (self.categories, category)):
+            if name:
+                owner = table.by_name.get(name.lower())
+                candidates &= set(table.quotes(owner)) if owner is not None else set()
+
+        # Best match first: ascending order of (-rank, -ID)
+        ranked = []
+        for position in candidates:
+            quote_words = re.findall(r'\w+', self.quote_texts[position].lower())
+            hits = sum(1 for word in quote_words if word in terms)
+            rank = round(hits / (1 + math.log(len(quote_words))), 6)
+            ranked.append((-rank, -self.quote_ids[position], position))
+        ranked.sort()
+
+        cursor_key = (-key[0], -key[1]) if page.cursor else None
+        rows, more = _slice(ranked, lambda i: ranked[i][:2], cursor_key, backwards, page.limit)
+
+        quotes = []
+        keys = []
+        for row in rows:
+            negative_rank, negative_id, position = ranked[row]
+            quote = self._quote(position)
+            quotes.append(dict({"quoteID": -negative_id}, **select_fields({
+                "quote": quote['quote'],
+                "snippet": _highlight(quote['quote'], terms) if 'snippet' in fields else None,
+                "author": quote['author'],
+                "category": quote['category'],
+                "rank": -negative_rank
+            }, fields)))
+            keys.append((-negative_rank, -negative_id))
+        next_link, prev_link = page.links(keys, backwards, more)
+        return 200, {
+            "amount of quotes returned": len(quotes),
+            "quotes": quotes,
+            "next": next_link,
+            "prev": prev_link
+        }
+
+class _Table:
+    # Authors or categories in (name, ID) order
+    def __init__(self, ids, names, quote_offsets, quotes):
+        self.ids = ids
+        self.names = [sys.intern(names[i]) for i in range(len(names))]
+        self._quote_offsets = quote_offsets
+        self._quotes = quotes
+        self.by_id = {owner_id: i for i, owner_id in enumerate(ids)}
+        self.by_name = {}
+        for i, name in enumerate(self.names):
+            self.by_name.setdefault(name.lower(), i)
+
+    def key(self, i):
+        return (self.names[i], self.ids[i])
+
+    #--------------------------------------------------------
+    # Row number of a page cursor's (name, ID). Found by ID |
+    # since Python can't compare names in the database's   |
+    # collation. A row this snapshot lacks goes between two |
+    # rows, after those sorting before it by code point.    |
+    #--------------------------------------------------------
+    def locate(self, cursor_key):
+        name, owner_id = cursor_key
+        i = self.by_id.get(owner_id)
+        if i is not None and self.names[i] == name:
+            return i
+        return sum(1 for i in range(len(self.ids)) if self.key(i) < cursor_key) - 0.5
+
+    def quotes(self, i):
+        return self._quotes[self._quote_offsets[i]:self._quote_offsets[i + 1]]
+
+    # (ID, name, number of quotes) of the `limit` with the most quotes, like TOP_AUTHORS
+    def top(self, limit):
+        counts = ((self._quote_offsets[i + 1] - self._quote_offsets[i], i)
+                  for i in range(len(self.ids)))
+        top = heapq.nsmallest(limit, ((-count, self.ids[i], i) for count, i in counts if count))
+        return [(owner_id, self.names[i], -count) for count, owner_id, i in top]
+
+#--------------------------------------------------------
+# Returns the row numbers of one page out of `length`   |
+# rows sorted by key(row), plus whether another page    |
+# follows in the direction read (like the *_before      |
+# statements, one row more than the limit is looked at) |
+#--------------------------------------------------------
+def _slice(rows, key, cursor_key, backwards, limit):
+    keys = _Keys(range(len(rows)), key)
+    if cursor_key is None:
+        start, end = 0, min(len(rows), limit + 1)
+    elif backwards:
+        end = bisect.bisect_left(keys, cursor_key)
+        start = max(0, end - limit - 1)
+    else:
+        start = bisect.bisect_right(keys, cursor_key)
+        end = min(len(rows), start + limit + 1)
+
+    selected = range(start, end)
+    more = len(selected) > limit
+    if more:
+        selected = selected[1:] if backwards else selected[:limit]
+    return list(selected), more
+
+# locate(cursor key) returns the cursor's row number, else rows are bisected by key
+def _page(page, first_key, length, key, locate=None):
+    backwards, cursor_key = page.position(first_key)
+    if page.cursor and locate:
+        rows, more = _slice(range(length), lambda row: row, locate(cursor_key),
+                            backwards, page.limit)
+    else:
+        rows, more = _slice(range(length), key, cursor_key if page.cursor else None,
+                            backwards, page.limit)
+    next_link, prev_link = page.links([key(row) for row in rows], backwards, more)
+    return rows, next_link, prev_link
+
+def _highlight(text, terms):
+    parts = []
+    last = 0
+    for match in re.finditer(r'\w+', text):
+        if match.group().lower() in terms:
+            parts.append(str(escape(text[last:match.start()])))
+            parts.append("<b>%s</b>" % escape(match.group()))
+            last = match.end()
+    parts.append(str(escape(text[last:])))
+    return "".join(parts)
+
+#--------------------------------------------------------
+# Holds the snapshot being served and swaps in a new    |
+# one when the file is replaced. Requests that started  |
+# on the old snapshot finish on it, its mapping is      |
+# released once nothing refers to it.                   |
+#--------------------------------------------------------
+class SnapshotStore:
+    def __init__(self, path, check_interval=10.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        self.last_error = None
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot(path)
+        self._file_id = self._stat()
+        self._checked = time.monotonic()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    #--------------------------------------------------------
+    # Returns the current snapshot, reloading it first if   |
+    # the file changed and check_interval has passed        |
+    #--------------------------------------------------------
+    def current(self):
+        now = time.monotonic()
+        if self.check_interval > 0 and now - self._checked >= self.check_interval:
+            self._checked = now
+            try:
+                if self._stat() != self._file_id:
+                    self.reload()
+            except (OSError, SnapshotError, ValueError):
+                pass
+        return self._snapshot
+
+    #--------------------------------------------------------
+    # Opens the file again and swaps it in. If it can't be  |
+    # read the current snapshot stays and the error is      |
+    # raised and kept in last_error.                        |
+    #--------------------------------------------------------
+    def reload(self):
+        with self._lock:
+            try:
+                file_id = self._stat()
+                snapshot = Snapshot(self.path)
+            except (OSError, SnapshotError, ValueError) as error:
+                self.last_error = str(error)
+                raise
+            self._snapshot = snapshot
+            self._file_id = file_id
+            self.last_error = None
+            self.reloads += 1
+        return snapshot
+
+    def stats(self):
+        stats = self._snapshot.stats()
+        stats['reloads'] = self.reloads
+        stats['last_error'] = self.last_error
+        return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build and inspect quote snapshots")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    export = commands.add_parser('export', help="snapshot the database")
+    export.add_argument('output')
+    export.add_argument('--dsn', default=os.environ.get('CONNECTION_STRING'),
+                        help="connection string (default: $CONNECTION_STRING)")
+
+    build = commands.add_parser('build', help="snapshot CSV files")
+    build.add_argument('output')
+    build.add_argument('--quotes', default='quotes.csv',
+                       help="ID,Text,AuthorID,CategoryID rows (default: quotes.csv)")
+    build.add_argument('--authors', required=True, help="ID,Name rows")
+    build.add_argument('--categories', required=True, help="ID,Name rows")
+
+    info = commands.add_parser('info', help="print a snapshot's header")
+    info.add_argument('path')
+
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'export':
+            if not args.dsn:
+                parser.error("no connection string, set CONNECTION_STRING or pass --dsn")
+            import psycopg2
+
+            conn = psycopg2.connect(args.dsn)
+            try:
+                summary = write_snapshot(args.output, *read_db_source(conn), ordered=True)
+            finally:
+                conn.close()
+        elif args.command == 'build':
+            summary = write_snapshot(args.output, *read_csv_source(
+                args.quotes, args.authors, args.categories))
+        else:
+            summary = Snapshot(args.path).stats()
+    except (OSError, SnapshotError) as error:
+        print("snapshot failed: %s" % error, file=sys.stderr)
+        return 1
+
+    print(json.dumps(summary, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from flask import Response, request
+
+from cache import ResponseCache, GLOBAL_TAG
+from serialize import base_etag
+
+#--------------------------------------------------------
+# Version counters kept in this process. The epoch is   |
+# part of every token, so two workers never hand out    |
+# the same ETag for what may be different data. Writes  |
+# made by other workers aren't seen here, so the epoch  |
+# also moves on every `window` seconds: like the local  |
+# response cache, a worker can answer 304 for old data  |
+# for at most that long.                                |
+#--------------------------------------------------------
+class LocalVersionStore:
+    def __init__(self, window=60.0):
+        self.window = window
+        self.since = time.time()
+        self._id = os.urandom(4).hex()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def _window_start(self):
+        if self.window <= 0:
+            return self.since
+        return max(self.since, time.time() // self.window * self.window)
+
+    @property
+    def epoch(self):
+        return "%s-%d" % (self._id, self._window_start())
+
+    def bump(self, tags, now):
+        with self._lock:
+            for tag in tags:
+                version, _ = self._versions.get(tag, (0, None))
+                self._versions[tag] = (version + 1, now)
+
+    def read(self, tags):
+        floor = self._window_start()
+        return [(version, max(modified, floor)) for version, modified in
+                (self._versions.get(tag, (0, floor)) for tag in tags)]
+
+#--------------------------------------------------------
+# Version counters in a Redis-compatible server, shared |
+# by every worker using it                              |
+#--------------------------------------------------------
+class RedisVersionStore:
+    def __init__(self, url, prefix='quotes-api:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.epoch = ''
+        self.client.setnx(prefix + 'versions-since', time.time())
+        self.since = float(self.client.get(prefix + 'versions-since'))
+
+    def bump(self, tags, now):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.hincrby(self.prefix + 'versions', tag, 1)
+            pipe.hset(self.prefix + 'modified', tag, now)
+        pipe.execute()
+
+    def read(self, tags):
+        pipe = self.client.pipeline()
+        pipe.hmget(self.prefix + 'versions', tags)
+        pipe.hmget(self.prefix + 'modified', tags)
+        versions, modified = pipe.execute()
+        return [(int(version or 0), float(stamp) if stamp else self.since)
+                for version, stamp in zip(versions, modified)]
+
+#--------------------------------------------------------
+# Data versions for conditional GETs.                   |
+#                                                       |
+# Routes depend on the same tags as their cache entries |
+# (see cache.py) plus GLOBAL_TAG. ResponseCache bumps   |
+# them on every invalidate()/clear(), so whatever a     |
+# write drops from the cache also changes the ETag and  |
+# Last-Modified of the routes that showed it. Clients   |
+# revalidating with If-None-Match / If-Modified-Since   |
+# get a 304 computed from the versions alone, without   |
+# running the route.                                    |
+#--------------------------------------------------------
+class DataVersions:
+    def __init__(self, store, cache_control=None, default_cache_control='no-cache'):
+        self.store = store
+        self.cache_control = cache_control or {}
+        self.default_cache_control = default_cache_control
+        self.not_modified = 0
+
+    def bump(self, *tags):
+        tags = [tag for tag in tags if tag]
+        if tags:
+            self.store.bump(tags, time.time())
+
+    def policy(self, route):
+        return self.cache_control.get(route, self.default_cache_control)
+
+    #--------------------------------------------------------
+    # Returns (ETag, Last-Modified as a timestamp) for the  |
+    # response stored under cache key `key`. Must be read   |
+    # before the route runs: a write landing in between     |
+    # then changes the ETag the client revalidates with.    |
+    #--------------------------------------------------------
+    def validators(self, key, tags):
+        tags = [GLOBAL_TAG] + [tag for tag in tags if tag]
+        versions = self.store.read(tags)
+        token = "%s|%s|%s" % (self.store.epoch, key,
+                              ",".join("%s=%d" % (tag, version)
+                                       for tag, (version, _) in zip(tags, versions)))
+        etag = '"%s"' % hashlib.sha1(token.encode('utf-8')).hexdigest()[:24]
+        last_modified = max(modified for _, modified in versions)
+        return etag, last_modified
+
+    # The version numbers of `tags`, they change whenever a write invalidates one
+    def generation(self, tags):
+        tags = [GLOBAL_TAG] + [tag for tag in tags if tag]
+        return [version for version, _ in self.store.read(tags)]
+
+    def conditional(self, route, tags=None):
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(**view_args):
+                key = ResponseCache.make_key(route, view_args, request.args.items(multi=True))
+                entry_tags = tags(**view_args) if tags else ()
+                etag, last_modified = self.validators(key, entry_tags)
+                headers = validator_headers(etag, last_modified, self.policy(route))
+
+                if is_not_modified(etag, last_modified, request.headers.get('If-None-Match'),
+                                   request.headers.get('If-Modified-Since')):
+                    self.not_modified += 1
+                    return Response(status=304, headers=not_modified_headers(
+                        headers, request.headers.get('If-None-Match')))
+
+                response = view(**view_args)
+                if isinstance(response, Response) and response.status_code == 200:
+                    response.headers.extend(headers)
+                return response
+            return wrapper
+        return decorator
+
+#--------------------------------------------------------
+# Versions of a snapshot (see snapshot.py): everything  |
+# changes together when a new snapshot is loaded        |
+#--------------------------------------------------------
+class SnapshotVersionStore:
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+
+    @property
+    def epoch(self):
+        return "%s:%r" % (self.snapshots.path, self.snapshots.current().header['created'])
+
+    def bump(self, tags, now):
+        pass
+
+    def read(self, tags):
+        created = self.snapshots.current().header['created']
+        return [(0, created) for _ in tags]
+
+def validator_headers(etag, last_modified, cache_control):
+    return [('ETag', etag),
+            ('Last-Modified', formatdate(last_modified, usegmt=True)),
+            ('Cache-Control', cache_control)]
+
+#--------------------------------------------------------
+# Returns the If-None-Match entry naming `etag`, in any |
+# of its encodings (see serialize.py), or None          |
+#--------------------------------------------------------
+def matching_etag(etag, if_none_match):
+    # "*" is never answered with 304, it would take a query to know the resource exists
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # Weak comparison, W/"x" matches "x"
+        if base_etag(tag[2:] if tag.startswith('W/') else tag) == etag:
+            return tag
+    return None
+
+#--------------------------------------------------------
+# Evaluates the conditional request headers. As the     |
+# HTTP spec requires, If-Modified-Since is only looked  |
+# at when there is no If-None-Match.                    |
+#--------------------------------------------------------
+def is_not_modified(etag, last_modified, if_none_match, if_modified_since):
+    if if_none_match:
+        return matching_etag(etag, if_none_match) is not None
+
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return False
+        # HTTP dates have whole seconds
+        return int(last_modified) <= since
+    return False
+
+#--------------------------------------------------------
+# Headers of a 304: the ETag is the one the client has, |
+# which names the encoding it was sent with             |
+#--------------------------------------------------------
+def not_modified_headers(headers, if_none_match):
+    if not if_none_match:
+        return headers
+    return [(name, matching_etag(value, if_none_match) or value if name == 'ETag' else value)
+            for name, value in headers]
+
+#--------------------------------------------------------
+# Builds the versions configured for the app            |
+#--------------------------------------------------------
+def create_versions(app, snapshots=None):
+    if snapshots:
+        store = SnapshotVersionStore(snapshots)
+    elif app.config['CACHE_BACKEND'] == 'redis':
+        store = RedisVersionStore(app.config['CACHE_REDIS_URL'])
+    else:
+        store = LocalVersionStore(app.config['CACHE_DEFAULT_TTL'])
+    return DataVersions(store, app.config['CACHE_CONTROL'],
+                        app.config['CACHE_CONTROL_DEFAULT'])